@@ -184,6 +184,11 @@ class ConfigureApp:
         self._pylint(self._tool_files, check=check, use_ba_tools=False)
         self._pylint(self._project_files, check=check, use_ba_tools=True)
 
+    def test(self) -> None:
+        subprocess.run([
+            self._python_path, '-m', 'unittest', 'discover', '-s', 'tests', '-t', '.'
+        ], check=True)
+
     def update(self) -> None:
         self._update_manifest()
         self._update_tool_manifest()
@@ -198,7 +203,7 @@ class ConfigureApp:
 
     @staticmethod
     def parse_args(args: Sequence[CommandLineArgument]) -> None:
-        targets = ('mypy', 'update', 'sync', 'pylint', 'build')
+        targets = ('mypy', 'update', 'sync', 'pylint', 'build', 'test')
         assert __doc__
         parser = argparse.ArgumentParser(
             description=__doc__.split('\n')[0])
@@ -1,9 +1,55 @@
-"""General bapman library. Provides API for package management"""
+"""General bapman library. Provides API for package management
 
-from .pkginfo import PkgInfo, Person, Version
-from .package import pack as genpkg, unpack as extract_pkg
-from .pkgcontrol import install, uninstall
-from .db import Database
-from . import repo
+Submodules are imported on first use of their attributes, so importing bap
+is cheap and touches neither the filesystem nor the game.
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import importlib
+
+from .pkginfo import PkgInfo, Person, Version, InvalidVersion
+
+if TYPE_CHECKING:
+    from typing import Any, List
+    from .package import pack as genpkg, unpack as extract_pkg, inspect
+    from .delta import pack as gendelta
+    from .pkgcontrol import install, uninstall, install_many, uninstall_many, owner, files
+    from .db import Database
+    from . import repo, consts, installed
 
 version = Version(0, 3, 2, 'dev')
+
+# attribute: (submodule, name in submodule or None for the submodule itself)
+_LAZY = {
+    'genpkg': ('.package', 'pack'),
+    'extract_pkg': ('.package', 'unpack'),
+    'inspect': ('.package', 'inspect'),
+    'gendelta': ('.delta', 'pack'),
+    'install': ('.pkgcontrol', 'install'),
+    'uninstall': ('.pkgcontrol', 'uninstall'),
+    'install_many': ('.pkgcontrol', 'install_many'),
+    'uninstall_many': ('.pkgcontrol', 'uninstall_many'),
+    'owner': ('.pkgcontrol', 'owner'),
+    'files': ('.pkgcontrol', 'files'),
+    'Database': ('.db', 'Database'),
+    'repo': ('.repo', None),
+    'consts': ('.consts', None),
+    'installed': ('.installed', None),
+}
+
+
+def __getattr__(name: str) -> Any:
+    try:
+        module_name, attr = _LAZY[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    module = importlib.import_module(module_name, __name__)
+    value = module if attr is None else getattr(module, attr)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(_LAZY))
@@ -0,0 +1,129 @@
+"""Cache of compressed package members for incremental genpkg rebuilds.
+
+Source files are remembered by path, size and mtime together with the
+sha256 of their contents; compressed members are stored by that hash and
+the compression settings. An unchanged file is then neither read nor
+compressed again, and a touched but identical one is only re-hashed.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import os
+import time
+
+from .db import connect
+from . import consts
+
+if TYPE_CHECKING:
+    from typing import Optional, List, Sequence, Tuple
+    import sqlite3
+
+BUILD_CACHE_NAME = 'build.db'
+
+# Additions are written once they hold this much compressed data
+FLUSH_BYTES = 16 * 1024 * 1024
+
+# Files modified this recently may change again within the same mtime tick,
+# so their stat is not trusted on the next build
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+_MIGRATIONS: List[Sequence[str]] = [
+    (
+        """CREATE TABLE files(
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sha256 TEXT NOT NULL
+        );""",
+        """CREATE TABLE members(
+            sha256 TEXT NOT NULL,
+            compression INTEGER NOT NULL,
+            compresslevel INTEGER NOT NULL,
+            crc INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            compress_type INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (sha256, compression, compresslevel)
+        );""",
+    ),
+]
+
+_SQL_FILE = 'SELECT sha256 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?'
+_SQL_MEMBER = ('SELECT crc, size, compress_type, data FROM members'
+               ' WHERE sha256 = ? AND compression = ? AND compresslevel = ?')
+_SQL_PUT_FILE = 'INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)'
+_SQL_PUT_MEMBER = ('INSERT OR REPLACE INTO members (sha256, compression, compresslevel,'
+                   ' crc, size, compress_type, data) VALUES (?, ?, ?, ?, ?, ?, ?)')
+_SQL_PATHS = 'SELECT path FROM files'
+_SQL_DELETE_FILE = 'DELETE FROM files WHERE path = ?'
+_SQL_PRUNE = 'DELETE FROM members WHERE sha256 NOT IN (SELECT sha256 FROM files)'
+
+
+class BuildCache:
+    """Compressed members for one compression method and level.
+
+    Lookups may be done from any thread. Additions are kept in memory and
+    written in batches of about FLUSH_BYTES, so concurrent builds hold the
+    database write lock only briefly.
+    """
+
+    def __init__(self, compression: int, compresslevel: Optional[int],
+                 path: Optional[str] = None) -> None:
+        if path is None:
+            path = os.path.join(consts.paths().cache_dir, BUILD_CACHE_NAME)
+        self._path = path
+        self._compression = compression
+        self._compresslevel = -1 if compresslevel is None else compresslevel
+        self._files: List[Tuple[str, int, int, str]] = []
+        self._members: List[Tuple[str, int, int, int, int, int, bytes]] = []
+        self._pending_bytes = 0
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        return connect(self._path, _MIGRATIONS)
+
+    def digest(self, path: str, st: os.stat_result) -> Optional[str]:
+        """Return sha256 of file contents if file is unchanged since it was cached"""
+        row = self._connection.execute(
+            _SQL_FILE, (os.path.abspath(path), st.st_size, st.st_mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def member(self, sha256: str) -> Optional[Tuple[int, int, int, bytes]]:
+        """Return (crc, size, compress_type, compressed data) of contents"""
+        row: Optional[Tuple[int, int, int, bytes]] = self._connection.execute(
+            _SQL_MEMBER, (sha256, self._compression, self._compresslevel)).fetchone()
+        return row
+
+    def add_file(self, path: str, st: os.stat_result, sha256: str) -> None:
+        if time.time_ns() - st.st_mtime_ns > RACY_WINDOW_NS:
+            self._files.append((os.path.abspath(path), st.st_size, st.st_mtime_ns, sha256))
+
+    def add_member(self, sha256: str, crc: int, size: int, compress_type: int,
+                   data: bytes) -> None:
+        self._members.append((sha256, self._compression, self._compresslevel,
+                              crc, size, compress_type, data))
+        self._pending_bytes += len(data)
+        if self._pending_bytes >= FLUSH_BYTES:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write additions in one short transaction"""
+        with self._connection as connection:
+            connection.executemany(_SQL_PUT_FILE, self._files)
+            connection.executemany(_SQL_PUT_MEMBER, self._members)
+        self._files.clear()
+        self._members.clear()
+        self._pending_bytes = 0
+
+    def commit(self) -> None:
+        """Write additions, forget files that no longer exist and drop members
+        no cached file refers to anymore"""
+        self.flush()
+        connection = self._connection
+        deleted = [(path,) for path, in connection.execute(_SQL_PATHS).fetchall()
+                   if not os.path.exists(path)]
+        with connection:
+            connection.executemany(_SQL_DELETE_FILE, deleted)
+            connection.execute(_SQL_PRUNE)
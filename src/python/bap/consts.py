@@ -1,16 +1,102 @@
+"""Filesystem locations used by bap.
+
+Nothing is resolved or created at import: the root is determined on first
+use (Ballistica user mods directory, or ~/.bap outside the game) and
+directories are created by the code that first writes into them. The root
+may be changed for the process with configure() or for the current thread
+or task with using().
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
 import os
+import contextlib
+import contextvars
+from dataclasses import dataclass
+
+if TYPE_CHECKING:
+    from typing import Optional, Iterator
+
+
+@dataclass(frozen=True)
+class Paths:
+    root: str
+    db_file: str
+    repo_dir: str
+    cache_dir: str
+
+    @classmethod
+    def for_root(cls, root: str, cache_dir: Optional[str] = None) -> Paths:
+        # Cache may be shared between several roots (e.g. game servers on one host)
+        return cls(root=root,
+                   db_file=os.path.join(root, '.bap.db'),
+                   repo_dir=os.path.join(root, '.baprepos'),
+                   cache_dir=cache_dir or os.path.join(root, '.bapcache'))
+
+
+_default: Optional[Paths] = None
+_override: contextvars.ContextVar[Optional[Paths]] = contextvars.ContextVar(
+    'bap_paths', default=None)
+
+
+def _default_root() -> str:
+    try:
+        import ba  # type: ignore # FIXME
+        root: str = ba.app.python_directory_user
+        return root
+    except (ImportError, AttributeError):  # Running not from BallisticaCore, just test
+        envval = os.getenv('HOME')
+        assert envval
+        return os.path.join(envval, '.bap')
+
+
+def paths() -> Paths:
+    """Return locations in effect for the current thread or task"""
+    global _default
+    override = _override.get()
+    if override is not None:
+        return override
+    if _default is None:
+        _default = Paths.for_root(_default_root(), os.getenv('BAP_CACHE_DIR'))
+    return _default
+
+
+def configure(root: str, cache_dir: Optional[str] = None) -> None:
+    """Manage packages under root for the rest of the process"""
+    global _default
+    _default = Paths.for_root(root, cache_dir or os.getenv('BAP_CACHE_DIR'))
+
+
+@contextlib.contextmanager
+def using(root: str, cache_dir: Optional[str] = None) -> Iterator[Paths]:
+    """Manage packages under root inside the with block (in this thread or task only)"""
+    token = _override.set(Paths.for_root(root, cache_dir or os.getenv('BAP_CACHE_DIR')))
+    try:
+        yield _override.get()  # type: ignore
+    finally:
+        _override.reset(token)
+
+
+def ensure_dir(path: str) -> str:
+    """Create directory if missing, return path"""
+    os.makedirs(path, exist_ok=True)
+    return path
+
 
-try:
-    import ba  # type: ignore # FIXME
-    ROOT_DIR = ba.app.python_directory_user
-except (ImportError, AttributeError):  # Running not from BallisticaCore, just test
-    _envval = os.getenv('HOME')
-    assert _envval
-    ROOT_DIR = os.path.join(_envval, '.bap')
+_ATTRIBUTES = {
+    'ROOT_DIR': 'root',
+    'DBFILE': 'db_file',
+    'REPO_DIR': 'repo_dir',
+    'CACHE_DIR': 'cache_dir',
+}
 
 
-DBFILE = os.path.join(ROOT_DIR, '.bap.db')
-REPO_DIR = os.path.join(ROOT_DIR, '.baprepos')
-CACHE_DIR = os.path.join(ROOT_DIR, '.bapcache')
-os.makedirs(REPO_DIR, exist_ok=True)
-os.makedirs(CACHE_DIR, exist_ok=True)
+def __getattr__(name: str) -> str:
+    """Old constants, now resolved from paths() on each access"""
+    try:
+        value: str = getattr(paths(), _ATTRIBUTES[name])
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    return value
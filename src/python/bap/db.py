@@ -3,10 +3,14 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 import os
+import threading
 import sqlite3
 
 from .pkginfo import PkgInfo, Person, Version
-from .consts import DBFILE
+from . import consts
+
+if TYPE_CHECKING:
+    from typing import Optional, List, Dict, Iterator, Sequence, Iterable, Tuple
 
 
 class PackageAlreadyExists(Exception):
@@ -17,96 +21,211 @@ class PackageNotFound(Exception):
     pass
 
 
-class Database:
-    def __init__(self, path: str = DBFILE):
-        self._dbfile = path
-        _setup_requered = not os.path.exists(self._dbfile)
-        self._connection = sqlite3.connect(self._dbfile)
-        self._cursor = self._connection.cursor()
-
-        if _setup_requered:
-            self._dbinit()
-    
-    def _dbinit(self) -> None:
-        self._cursor.execute("""CREATE TABLE packages(
+# Schema migrations, applied in order. ``PRAGMA user_version`` holds the
+# number of migrations already applied to a database file. Databases
+# created before migrations existed have user_version 0 and already contain
+# the tables, so every statement here must be safe to re-run.
+_MIGRATIONS: List[Sequence[str]] = [
+    (
+        """CREATE TABLE IF NOT EXISTS packages(
             name varchar(20) PRIMARY KEY,
             desc varchar(100) NOT NULL,
             version varchar(30) NOT NULL
-        );""")  # TODO: add depends
-        self._cursor.execute("""CREATE TABLE files(
+        );""",  # TODO: add depends
+        """CREATE TABLE IF NOT EXISTS files(
             path varchar(127) PRIMARY KEY,
             package INTEGER NOT NULL,
             FOREIGN KEY(package) REFERENCES packages (`name`)
-        );""")
-        # TODO: add default packages such as bap and ballisticacore
-        # self._cursor.execute("""INSERT INTO packages(`name`, `desc`, version) VALUES
-        #     ("bapack", "Ballistica mods packager", ?)""", (version.string(),))
-        # for file in BAPACK_FILES:
-        #     self._cursor.execute("""INSERT INTO files(path, package) VALUES
-        #         (?, "bapack")""", (file,))
-
-    
-    def query(self, name: str, with_files: bool = False) -> PkgInfo:
-        pkg = self._cursor.execute(
-            'SELECT `name`, `version`, `desc` FROM packages WHERE `name` = ?', (name,)).fetchone()
+        );""",
+        'CREATE INDEX IF NOT EXISTS files_package_idx ON files(package);',
+    ),
+    (
+        # CRC-32 and size of file contents as stored in the package archive,
+        # NULL for files installed before these were recorded
+        'ALTER TABLE files ADD COLUMN crc INTEGER;',
+        'ALTER TABLE files ADD COLUMN size INTEGER;',
+    ),
+]
+# TODO: add default packages such as bap and ballisticacore
+
+# Hot queries. Kept as constants so sqlite3's per-connection statement
+# cache always hits the same prepared statements.
+_SQL_QUERY_PACKAGE = 'SELECT `name`, `version`, `desc` FROM packages WHERE `name` = ?'
+_SQL_QUERY_FILES = 'SELECT path FROM files WHERE package = ?'
+_SQL_OWNER = 'SELECT package FROM files WHERE path = ?'
+_SQL_QUERY_DIGESTS = 'SELECT path, crc, size FROM files WHERE package = ?'
+_SQL_INSTALLED = 'SELECT `name`, `version`, `desc` FROM packages ORDER BY `name`'
+_SQL_ADD_PACKAGE = 'INSERT INTO `packages` (name, desc, version) VALUES (?, ?, ?)'
+_SQL_UPDATE_PACKAGE = 'UPDATE `packages` SET desc=?, version=? WHERE name=?'
+_SQL_ADD_FILE = 'INSERT INTO `files` (path, package, crc, size) VALUES (?, ?, ?, ?)'
+_SQL_REMOVE_FILES = 'DELETE FROM `files` WHERE `package` = ?'
+_SQL_REMOVE_PACKAGE = 'DELETE FROM `packages` WHERE `name` = ?'
+
+# Paths per ``IN (...)`` query; stays under SQLITE_MAX_VARIABLE_NUMBER of
+# old sqlite builds (999)
+_OWNERS_CHUNK = 500
+
+_STATEMENT_CACHE_SIZE = 256
+_BUSY_TIMEOUT = 30.0
+
+_local = threading.local()
+_migrated: Dict[str, int] = {}
+_migrate_lock = threading.Lock()
+
+
+def _migrate(connection: sqlite3.Connection, migrations: Sequence[Sequence[str]]) -> int:
+    schema_version: int = connection.execute('PRAGMA user_version').fetchone()[0]
+    if schema_version >= len(migrations):
+        return schema_version
+    with connection:
+        for statements in migrations[schema_version:]:
+            for statement in statements:
+                connection.execute(statement)
+        connection.execute(f'PRAGMA user_version = {len(migrations)}')
+    return len(migrations)
+
+
+def connect(path: Optional[str] = None,
+            migrations: Sequence[Sequence[str]] = _MIGRATIONS) -> sqlite3.Connection:
+    """Return the connection to database ``path`` owned by the current thread.
+
+    Connections are opened once per thread and reused by every Database
+    object afterwards. Schema ``migrations`` run on first open in the process.
+    The installed packages database of the current root is used by default.
+    """
+    if path is None:
+        path = consts.paths().db_file
+    connections: Optional[Dict[str, sqlite3.Connection]] = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    connection = connections.get(path)
+    if connection is not None:
+        return connection
+
+    if os.path.dirname(path):
+        consts.ensure_dir(os.path.dirname(path))
+    connection = sqlite3.connect(path, timeout=_BUSY_TIMEOUT,
+                                 cached_statements=_STATEMENT_CACHE_SIZE)
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute('PRAGMA synchronous = NORMAL')
+    if path not in _migrated:
+        with _migrate_lock:
+            if path not in _migrated:
+                _migrated[path] = _migrate(connection, migrations)
+    connections[path] = connection
+    return connection
+
+
+def close_all() -> None:
+    """Close every connection opened by the current thread."""
+    connections: Dict[str, sqlite3.Connection] = getattr(_local, 'connections', {})
+    while connections:
+        connections.popitem()[1].close()
+
+
+class Database:
+    def __init__(self, path: Optional[str] = None):
+        self._dbfile = path if path is not None else consts.paths().db_file
+        connect(self._dbfile)
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        return connect(self._dbfile)
+
+    def query(self, name: str, with_files: bool = False) -> Optional[PkgInfo]:
+        connection = self._connection
+        pkg = connection.execute(_SQL_QUERY_PACKAGE, (name,)).fetchone()
+        if not pkg:
+            return None
         files = None
         if with_files:
-            files = [i[0] for i in self._cursor.execute(
-                'SELECT * FROM files WHERE files.package = ?', (name,)).fetchall()]
-        if pkg:
-            return PkgInfo(
-                name=pkg[0],
-                version=Version.from_string(pkg[1]),
-                desc=pkg[2],
-                files=files)
-    
-    def installed(self):
-        result = self._cursor.execute(
-            'SELECT `name`, `version`, `desc` FROM packages').fetchall()
-        for pkg in result:
+            files = [i[0] for i in connection.execute(_SQL_QUERY_FILES, (name,))]
+        return PkgInfo(
+            name=pkg[0],
+            version=Version.from_stored(pkg[1]),
+            desc=pkg[2],
+            files=files)
+
+    def owner(self, path: str) -> Optional[str]:
+        row = self._connection.execute(_SQL_OWNER, (path,)).fetchone()
+        return row[0] if row else None
+
+    def owners(self, paths: Iterable[str]) -> Dict[str, str]:
+        """Return {path: package} for those of ``paths`` owned by any package"""
+        connection = self._connection
+        paths = list(paths)
+        result: Dict[str, str] = {}
+        for i in range(0, len(paths), _OWNERS_CHUNK):
+            chunk = paths[i:i + _OWNERS_CHUNK]
+            result.update(connection.execute(
+                'SELECT path, package FROM files WHERE path IN ('
+                + ', '.join('?' * len(chunk)) + ')', chunk))
+        return result
+
+    def installed(self) -> Iterator[PkgInfo]:
+        for pkg in self._connection.execute(_SQL_INSTALLED):
             yield PkgInfo(
                 name=pkg[0],
-                version=Version.from_string(pkg[1]),
+                version=Version.from_stored(pkg[1]),
                 desc=pkg[2],
                 files=None)
-    
-    def add(self, pkginfo: PkgInfo) -> None:
-        try:
-            self._cursor.execute('INSERT INTO `packages` (name, desc, version) VALUES (?, ?, ?)',
-                                 (pkginfo.name, pkginfo.desc, pkginfo.version.to_string()))
-        except sqlite3.IntegrityError as e:
-            if 'packages.name' in str(e):
-                raise PackageAlreadyExists(f'package {pkginfo.name} already exists in database')
-            raise e
 
+    def digests(self, name: str) -> Dict[str, Tuple[Optional[int], Optional[int]]]:
+        """Return {path: (crc, size)} of package files"""
+        return {path: (crc, size) for path, crc, size
+                in self._connection.execute(_SQL_QUERY_DIGESTS, (name,))}
+
+    def _add_files(self, pkginfo: PkgInfo,
+                   digests: Optional[Dict[str, Tuple[int, int]]]) -> None:
         assert pkginfo.files is not None
+        rows = []
         for file in pkginfo.files:
-            self._cursor.execute('INSERT INTO `files` (path, package) VALUES (?, ?)',
-                                 (file, pkginfo.name))
-    
-    def update(self, pkginfo: PkgInfo) -> None:
+            digest: Tuple[Optional[int], Optional[int]] = (None, None)
+            if digests and file in digests:
+                digest = digests[file]
+            rows.append((file, pkginfo.name) + digest)
+        self._connection.executemany(_SQL_ADD_FILE, rows)
+
+    def add(self, pkginfo: PkgInfo,
+            digests: Optional[Dict[str, Tuple[int, int]]] = None) -> None:
+        """Add package and its files, with (crc, size) of files from ``digests``"""
+        connection = self._connection
         try:
-            self._cursor.execute('UPDATE `packages` SET desc=?, version=? WHERE name=?',
-                                 (pkginfo.desc, pkginfo.version.to_string(), pkginfo.name))
+            connection.execute(_SQL_ADD_PACKAGE,
+                               (pkginfo.name, pkginfo.desc, pkginfo.version.to_string()))
         except sqlite3.IntegrityError as e:
             if 'packages.name' in str(e):
-                raise PackageNotFound(f'package {pkginfo.name} not found in database')
+                raise PackageAlreadyExists(f'package {pkginfo.name} already exists in database')
             raise e
+        self._add_files(pkginfo, digests)
+
+    def update(self, pkginfo: PkgInfo,
+               digests: Optional[Dict[str, Tuple[int, int]]] = None) -> None:
+        """Replace package info and file list, unregistering dropped files"""
+        connection = self._connection
+        cursor = connection.execute(_SQL_UPDATE_PACKAGE,
+                                    (pkginfo.desc, pkginfo.version.to_string(), pkginfo.name))
+        if cursor.rowcount == 0:
+            raise PackageNotFound(f'package {pkginfo.name} not found in database')
+        connection.execute(_SQL_REMOVE_FILES, (pkginfo.name,))
+        self._add_files(pkginfo, digests)
 
-        assert pkginfo.files is not None
-        for file in pkginfo.files:
-            self._cursor.execute('INSERT INTO `files` (path, package) VALUES (?, ?)'
-                                 ' ON CONFLICT DO NOTHING',
-                                 (file, pkginfo.name))
+    def remove(self, name: str) -> None:
+        connection = self._connection
+        connection.execute(_SQL_REMOVE_FILES, (name,))
+        connection.execute(_SQL_REMOVE_PACKAGE, (name,))
 
+    def begin(self) -> None:
+        """Start write transaction now rather than on first change.
+
+        Changes that depend on what was read before them (like conflict
+        checks) must start with it, so that concurrent writers in other
+        threads or processes wait instead of interleaving.
+        """
+        self._connection.execute('BEGIN IMMEDIATE')
 
-    def remove(self, name: str) -> None:
-        self._cursor.execute('DELETE FROM `files` WHERE `package` = ?', (name,))
-        self._cursor.execute('DELETE FROM `packages` WHERE `name` = ?', (name,))
-    
     def commit(self) -> None:
         self._connection.commit()
 
-    def __del__(self) -> None:
-        self._cursor.close()
-        self._connection.close()
+    def rollback(self) -> None:
+        self._connection.rollback()
@@ -0,0 +1,264 @@
+"""Delta packages: changes between two versions of a package.
+
+A delta package is a zip archive holding PKGINFO of the new version and a
+DELTA manifest (JSON) describing every file of the new version relative to
+the base version::
+
+    {"name": "foo", "base": "1.0.0", "version": "1.1.0",
+     "files": {"/foo/a.py": {"op": "keep", "crc": ..., "size": ...},
+               "/foo/b.py": {"op": "patch", "crc": ..., "size": ..., "base_crc": ...},
+               "/foo/c.py": {"op": "add", "crc": ..., "size": ...}}}
+
+Added files are stored whole as ``add/<path>``, changed ones as binary
+patches as ``patch/<path>``. Base files missing from ``files`` are dropped
+in the new version. Applying a delta to installed base files gives a full
+package archive of the new version.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import os
+import re
+import json
+import struct
+import zlib
+import hashlib
+import zipfile
+
+from . import package
+
+if TYPE_CHECKING:
+    from typing import Any, Optional, Dict, Tuple, Iterator
+
+DELTA_NAME = 'DELTA'
+PATCH_BLOCK = 64
+
+# Patch records: copy ``length`` bytes from ``offset`` of the base file, or
+# insert ``length`` literal bytes that follow the record
+_COPY = struct.Struct('>cQI')
+_DATA = struct.Struct('>cI')
+
+# Anchors are the starts and ends of runs of newline, 0x00 and 0xff bytes: frequent in
+# text and in binary data alike
+_ANCHOR = re.compile(rb'[\n\x00\xff][\n\x00\xff]*')
+
+
+class DeltaError(Exception):
+    pass
+
+
+def _anchors(data: bytes, block: int, pos: int = 0) -> Iterator[int]:
+    """Content-defined positions of data from pos that may start a block"""
+    last = len(data) - block
+    if pos <= last:
+        yield pos
+    for match in _ANCHOR.finditer(data, pos):
+        start, end = match.span()
+        if start > last:
+            return
+        if end - start > 1 and start > pos:
+            yield start
+        if end <= last:
+            yield end
+
+
+def _match_forward(old: bytes, new: bytes, end: int, shift: int, block: int) -> int:
+    """Extend match ending at end of new, where old is shifted by shift"""
+    step = block
+    while step:
+        if (end + step <= len(new) and end + step - shift <= len(old)
+                and new[end:end + step] == old[end - shift:end + step - shift]):
+            end += step
+            step *= 2
+        else:
+            step //= 2
+    return end
+
+
+def _match_backward(old: bytes, new: bytes, start: int, shift: int, block: int,
+                    limit: int) -> int:
+    """Extend match starting at start of new back to limit at most"""
+    step = block
+    while step:
+        if (start - step >= limit and start - step - shift >= 0
+                and new[start - step:start] == old[start - step - shift:start - shift]):
+            start -= step
+            step *= 2
+        else:
+            step //= 2
+    return start
+
+
+def make_patch(old: bytes, new: bytes, block: int = PATCH_BLOCK) -> bytes:
+    """Return patch turning old into new.
+
+    Blocks of old are looked up at content-defined anchors of new, so
+    insertions and removals do not break matching of the rest (as with the
+    rolling checksum of rsync), while anchors are found by a regular
+    expression scan instead of a loop over every byte. Matches are then
+    extended in both directions.
+    """
+    out = bytearray()
+
+    def literal(start: int, end: int) -> None:
+        if end > start:
+            out.extend(_DATA.pack(b'D', end - start))
+            out.extend(new[start:end])
+
+    blocks: Dict[bytes, int] = {}
+    for position in _anchors(old, block):
+        blocks.setdefault(old[position:position + block], position)
+
+    pending = 0
+    anchors = _anchors(new, block)
+    while True:
+        anchor = next(anchors, None)
+        if anchor is None:
+            break
+        offset = blocks.get(new[anchor:anchor + block])
+        if offset is None:
+            continue
+        shift = anchor - offset  # position in new minus position in old
+        start = _match_backward(old, new, anchor, shift, block, pending)
+        end = _match_forward(old, new, anchor + block, shift, block)
+        literal(pending, start)
+        out.extend(_COPY.pack(b'C', start - shift, end - start))
+        pending = end
+        anchors = _anchors(new, block, pending)  # skip anchors within the match
+    literal(pending, len(new))
+    return bytes(out)
+
+
+def apply_patch(old: bytes, patch: bytes) -> bytes:
+    out = bytearray()
+    pos = 0
+    try:
+        while pos < len(patch):
+            op = patch[pos:pos + 1]
+            if op == b'C':
+                _, offset, length = _COPY.unpack_from(patch, pos)
+                pos += _COPY.size
+                if offset + length > len(old):
+                    raise DeltaError('patch does not match base file')
+                out.extend(old[offset:offset + length])
+            elif op == b'D':
+                _, length = _DATA.unpack_from(patch, pos)
+                pos += _DATA.size
+                if pos + length > len(patch):
+                    raise DeltaError('truncated patch')
+                out.extend(patch[pos:pos + length])
+                pos += length
+            else:
+                raise DeltaError('corrupted patch')
+    except struct.error:
+        raise DeltaError('truncated patch')
+    return bytes(out)
+
+
+def read_manifest(zf: zipfile.ZipFile) -> Dict[str, Any]:
+    try:
+        manifest: Dict[str, Any] = json.loads(zf.read(DELTA_NAME).decode('utf-8'))
+    except KeyError:
+        raise DeltaError('DELTA file not found')
+    return manifest
+
+
+def pack(base_path: str, new_path: str, output_path: str) -> None:
+    """Generate delta package from archives of two versions of a package"""
+    with zipfile.ZipFile(base_path, 'r') as base_zf, zipfile.ZipFile(new_path, 'r') as new_zf:
+        base_info, base_members = package.read(base_zf)
+        new_info, new_members = package.read(new_zf)
+        if base_info.name != new_info.name:
+            raise DeltaError(f'{base_info.name} and {new_info.name} are different packages')
+        base_by_path = dict(zip(base_info.files or [], base_members))
+        files: Dict[str, Dict[str, Any]] = {}
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as out:
+            out.writestr(package.PKGINFO_NAME, new_zf.read(package.PKGINFO_NAME))
+            if package.MANIFEST_NAME in new_zf.NameToInfo:
+                out.writestr(package.MANIFEST_NAME, new_zf.read(package.MANIFEST_NAME))
+            for path, info in zip(new_info.files or [], new_members):
+                entry: Dict[str, Any] = {'op': 'add', 'crc': info.CRC, 'size': info.file_size}
+                base = base_by_path.get(path)
+                if base is not None and (base.CRC, base.file_size) == (info.CRC, info.file_size):
+                    entry['op'] = 'keep'
+                elif base is not None:
+                    data = new_zf.read(info)
+                    patch = make_patch(base_zf.read(base), data)
+                    if len(patch) < len(data):
+                        entry.update(op='patch', base_crc=base.CRC)
+                        out.writestr('patch' + path, patch)
+                    else:
+                        out.writestr('add' + path, data)
+                else:
+                    out.writestr('add' + path, new_zf.read(info))
+                files[path] = entry
+            out.writestr(DELTA_NAME, json.dumps({
+                'name': new_info.name,
+                'base': base_info.version.to_string(),
+                'version': new_info.version.to_string(),
+                'files': files}, indent=1))
+
+
+def _file_path(path: str) -> str:
+    """Check package file path taken from delta manifest"""
+    if not path.startswith('/'):
+        raise DeltaError(f'unsafe path in delta: {path}')
+    try:
+        return package._member_path(path[1:])  # pylint: disable=protected-access
+    except package.UnsafePath as e:
+        raise DeltaError(str(e))
+
+
+def _read_base(root: str, path: str, crc: int) -> bytes:
+    try:
+        with open(root + path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        raise DeltaError(f'base file {path} is not available: {e}')
+    if zlib.crc32(data) != crc:
+        raise DeltaError(f'base file {path} was modified')
+    return data
+
+
+def apply(delta_path: str, output_path: str, root: str) -> None:
+    """Rebuild full package archive from delta and base files installed under root.
+
+    Every file is checked against its size and sha256 in MANIFEST of the new
+    version (or against CRC-32 recorded in the delta if it has none);
+    DeltaError is raised (and nothing is left at output_path) if base files
+    do not match or the delta is malformed.
+    """
+    try:
+        with zipfile.ZipFile(delta_path, 'r') as zf, \
+                zipfile.ZipFile(output_path, 'w', zipfile.ZIP_STORED) as out:
+            manifest = read_manifest(zf)
+            out.writestr(package.PKGINFO_NAME, zf.read(package.PKGINFO_NAME))
+            expected: Optional[Dict[str, Tuple[int, str]]] = None
+            if package.MANIFEST_NAME in zf.NameToInfo:
+                manifest_data = zf.read(package.MANIFEST_NAME)
+                expected = package.parse_manifest(manifest_data.decode('utf-8'))
+                out.writestr(package.MANIFEST_NAME, manifest_data)
+            for path, entry in manifest['files'].items():
+                path = _file_path(path)
+                if entry['op'] == 'keep':
+                    data = _read_base(root, path, entry['crc'])
+                elif entry['op'] == 'patch':
+                    data = apply_patch(_read_base(root, path, entry['base_crc']),
+                                       zf.read('patch' + path))
+                else:
+                    data = zf.read('add' + path)
+                if expected is not None:
+                    if expected.pop(path, None) != (len(data), hashlib.sha256(data).hexdigest()):
+                        raise DeltaError(f'{path}: does not match MANIFEST after applying delta')
+                elif zlib.crc32(data) != entry['crc'] or len(data) != entry['size']:
+                    raise DeltaError(f'{path}: checksum mismatch after applying delta')
+                out.writestr(path[1:], data)
+            if expected:
+                raise DeltaError('files listed in MANIFEST are missing from delta: '
+                                 + ', '.join(expected))
+    except BaseException:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
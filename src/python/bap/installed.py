@@ -0,0 +1,141 @@
+"""Shared in-memory snapshot of installed packages.
+
+A Snapshot holds the packages table of one installed packages database and
+notices every change of it cheaply: sqlite increments ``PRAGMA
+data_version`` of a connection whenever another connection (in this
+process or another one) commits to the database, so checking for changes
+is a single query that reads no tables. install/uninstall refresh the
+snapshot of their root right after committing; changes made by other
+processes are picked up on the next refresh().
+
+Subscribers receive row-level Changes instead of the whole list.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+
+from . import consts
+from .db import connect
+from .pkginfo import PkgInfo, Version
+
+if TYPE_CHECKING:
+    from typing import Optional, List, Dict, Tuple, Callable
+
+_SQL_PACKAGES = 'SELECT `name`, `version`, `desc` FROM packages'
+
+
+@dataclass
+class Changes:
+    """Difference between two versions of a snapshot"""
+    version: int
+    added: List[PkgInfo] = field(default_factory=list)
+    changed: List[PkgInfo] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+
+
+class Snapshot:
+    """Installed packages of database at path, safe to use from any thread"""
+
+    def __init__(self, path: str) -> None:
+        connect(path)  # create and migrate database if needed
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._data_version: Optional[int] = None
+        self._rows: Dict[str, Tuple[str, str]] = {}
+        self._packages: Dict[str, PkgInfo] = {}
+        self._subscribers: List[Callable[[Changes], None]] = []
+        self.version = 0
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """Reload packages if database was changed, notifying subscribers.
+
+        Returns True if anything changed.
+        """
+        with self._lock:
+            data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self._data_version:
+                return False
+            self._data_version = data_version
+            rows = {name: (version, desc)
+                    for name, version, desc in self._conn.execute(_SQL_PACKAGES)}
+            changes = Changes(version=self.version + 1)
+            for name, row in rows.items():
+                old = self._rows.get(name)
+                if old == row:
+                    continue
+                pkginfo = PkgInfo(name=name, version=Version.from_stored(row[0]), desc=row[1])
+                self._packages[name] = pkginfo
+                (changes.added if old is None else changes.changed).append(pkginfo)
+            for name in self._rows.keys() - rows.keys():
+                del self._packages[name]
+                changes.removed.append(name)
+            self._rows = rows
+            if not (changes.added or changes.changed or changes.removed):
+                return False
+            self.version = changes.version
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(changes)
+            except Exception as e:  # pylint: disable=broad-except
+                print(f'warning: bap: installed packages subscriber failed: {e!r}')
+        return True
+
+    def packages(self) -> List[PkgInfo]:
+        """Return installed packages sorted by name"""
+        with self._lock:
+            return [self._packages[name] for name in sorted(self._packages)]
+
+    def get(self, name: str) -> Optional[PkgInfo]:
+        with self._lock:
+            return self._packages.get(name)
+
+    def subscribe(self, callback: Callable[[Changes], None]) -> Callable[[], None]:
+        """Call callback(changes) on every change; returns function to unsubscribe.
+
+        Callbacks run in the thread that refreshed the snapshot; exceptions
+        they raise are printed and ignored.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+        def unsubscribe() -> None:
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+
+_snapshots: Dict[str, Snapshot] = {}
+_snapshots_lock = threading.Lock()
+
+
+def snapshot(path: Optional[str] = None) -> Snapshot:
+    """Return the shared snapshot of database at path (of the current root by default)"""
+    if path is None:
+        path = consts.paths().db_file
+    with _snapshots_lock:
+        found = _snapshots.get(path)
+        if found is None:
+            found = _snapshots[path] = Snapshot(path)
+        return found
+
+
+def notify(path: str) -> None:
+    """Refresh snapshot of database at path, if anyone uses it, after changing it.
+
+    Never raises: the change is committed already, and the snapshot catches
+    up on its next refresh.
+    """
+    found = _snapshots.get(path)
+    if found is not None:
+        try:
+            found.refresh()
+        except sqlite3.Error as e:
+            print(f'warning: bap: refreshing installed packages failed: {e}')
@@ -3,35 +3,260 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 import os
+import zlib
+import struct
+import hashlib
 import shutil
 import zipfile
 import tempfile
-import traceback
+from collections import deque
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, Future
 
 from .pkginfo import PkgInfo, Person, Version
+from .buildcache import BuildCache
 
 
 if TYPE_CHECKING:
-    from typing import Optional, List, Any, Dict, Sequence, Union, Tuple
+    from typing import (Optional, List, Any, Dict, Sequence, Union, Tuple, Set, Callable, Deque,
+                        BinaryIO)
+
+    # (zip info, member data, sha256 of contents, whether member data is cached)
+    _Member = Tuple[zipfile.ZipInfo, bytes, str, bool]
+
+
+PKGINFO_NAME = 'PKGINFO'
+PKGINFO_SOURCE_NAME = 'pkginfo.py'
+MANIFEST_NAME = 'MANIFEST'
+_METADATA_NAMES = (PKGINFO_NAME, MANIFEST_NAME)
+COPY_BUFSIZE = 1024 * 1024
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)  # earliest date zip can store
+ZIP_FILE_MODE = 0o100644
+# Members being compressed or waiting to be written, per worker thread
+PACK_QUEUE_PER_WORKER = 2
+
+# Zip records written by _ArchiveWriter (see APPNOTE.TXT of PKWARE)
+_CENTRAL_HEADER = struct.Struct('<4s6H3I5H2I')
+_END_RECORD = struct.Struct('<4s4H2IH')
+_ZIP64_END_RECORD = struct.Struct('<4sQ2H2I4Q')
+_ZIP64_END_LOCATOR = struct.Struct('<4sIQI')
+_ZIP64_VERSION = 45
+_UINT32_MAX = 0xFFFFFFFF
+_UINT16_MAX = 0xFFFF
+
+# LZMA members start with LZMA SDK version and properties of the raw stream
+_LZMA_DICT_SIZE = 1 << 23
+_LZMA_HEADER = struct.pack('<BBHBI', 9, 4, 5,
+                           (2 * 5 + 0) * 9 + 3,  # pb=2 lp=0 lc=3
+                           _LZMA_DICT_SIZE)
 
 
 class PkgInfoNotFound(Exception):
     pass
 
 
-def _zipdir(path: str, zf: zipfile.ZipFile) -> None:
-    """Add directory to ZipFile"""
-    lastdir = os.getcwd()
-    os.chdir(path)
-    for root, dirs, files in os.walk('.'):
+class UnsafePath(Exception):
+    pass
+
+
+class ManifestMismatch(Exception):
+    pass
+
+
+@dataclass
+class FileEntry:
+    path: str
+    size: int
+    crc: int
+    sha256: Optional[str]  # None if package has no MANIFEST
+
+
+def _walk(path: str) -> List[str]:
+    """Return archive names of package files under path, sorted"""
+    names = []
+    for root, dirs, files in os.walk(path):
+        relroot = os.path.relpath(root, path)
         for file in files:
-            zf.write(os.path.join(root, file))
-    os.chdir(lastdir)
+            if relroot == os.curdir:
+                if file == PKGINFO_SOURCE_NAME or file in _METADATA_NAMES:
+                    continue
+                name = file
+            else:
+                name = os.path.join(relroot, file)
+            names.append(name.replace(os.sep, '/'))
+    return sorted(names)
+
+
+def _member_info(name: str, crc: int, size: int, compress_type: int,
+                 compress_size: int) -> zipfile.ZipInfo:
+    """Make zip member info with fixed metadata"""
+    info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+    info.create_system = 3  # unix, whatever system the package is built on
+    info.external_attr = ZIP_FILE_MODE << 16
+    info.CRC = crc
+    info.file_size = size
+    info.compress_type = compress_type
+    info.compress_size = compress_size
+    if compress_type == zipfile.ZIP_LZMA:
+        info.flag_bits |= 0x02  # as zipfile does for lzma (EOS marker)
+    return info
+
+
+def _compress(data: bytes, compression: int, compresslevel: Optional[int]) -> Tuple[int, bytes]:
+    """Return (compress type, compressed data); data that does not shrink is stored"""
+    if compression == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel,
+            zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    elif compression == zipfile.ZIP_BZIP2:
+        import bz2
+        compressed = bz2.compress(data, 9 if compresslevel is None else compresslevel)
+    elif compression == zipfile.ZIP_LZMA:
+        import lzma
+        compressed = _LZMA_HEADER + lzma.compress(data, lzma.FORMAT_RAW, filters=[{
+            'id': lzma.FILTER_LZMA1, 'dict_size': _LZMA_DICT_SIZE, 'lc': 3, 'lp': 0, 'pb': 2}])
+    else:
+        compressed = data
+    if len(compressed) < len(data):
+        return compression, compressed
+    return zipfile.ZIP_STORED, data  # e.g. textures and sounds, already compressed
+
+
+def _build_member(path: str, name: str, compression: int, compresslevel: Optional[int],
+                  cache: Optional[BuildCache]) -> _Member:
+    """Read file and return (zip info, member data, sha256, whether taken from cache)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    sha256 = hashlib.sha256(data).hexdigest()
+    cached = cache.member(sha256) if cache is not None else None
+    if cached is not None:
+        crc, size, compress_type, compressed = cached
+        return (_member_info(name, crc, size, compress_type, len(compressed)),
+                compressed, sha256, True)
+    compress_type, compressed = _compress(data, compression, compresslevel)
+    return (_member_info(name, zlib.crc32(data), len(data), compress_type, len(compressed)),
+            compressed, sha256, False)
+
+
+class _ArchiveWriter:
+    """Writes zip archive of precompressed members.
+
+    zipfile compresses members itself, in the writing thread, so packages
+    are written with this instead: local headers come from
+    ZipInfo.FileHeader, the central directory is written on close().
+    """
+
+    def __init__(self, f: BinaryIO) -> None:
+        self._f = f
+        self._members: List[zipfile.ZipInfo] = []
+
+    def append(self, info: zipfile.ZipInfo, data: bytes) -> None:
+        info.header_offset = self._f.tell()
+        self._f.write(info.FileHeader(info.file_size > zipfile.ZIP64_LIMIT
+                                      or info.compress_size > zipfile.ZIP64_LIMIT))
+        self._f.write(data)
+        self._members.append(info)
+
+    def close(self) -> None:
+        start = self._f.tell()
+        for info in self._members:
+            fields = [info.file_size, info.compress_size, info.header_offset]
+            large = [value for value in fields if value > zipfile.ZIP64_LIMIT]
+            extra = struct.pack(f'<2H{len(large)}Q', 1, 8 * len(large), *large) if large else b''
+            file_size, compress_size, header_offset = (
+                _UINT32_MAX if value > zipfile.ZIP64_LIMIT else value for value in fields)
+            version = max(info.extract_version, _ZIP64_VERSION if large else 0)
+            try:
+                name = info.filename.encode('ascii')
+                flag_bits = info.flag_bits
+            except UnicodeEncodeError:
+                name = info.filename.encode('utf-8')
+                flag_bits = info.flag_bits | 0x800
+            year, month, day, hour, minute, second = info.date_time
+            self._f.write(_CENTRAL_HEADER.pack(
+                b'PK\x01\x02', info.create_system << 8 | version, version, flag_bits,
+                info.compress_type, hour << 11 | minute << 5 | second // 2,
+                (year - 1980) << 9 | month << 5 | day, info.CRC, compress_size, file_size,
+                len(name), len(extra), 0, 0, 0, info.external_attr, header_offset))
+            self._f.write(name + extra)
+        end = self._f.tell()
+        count, size = len(self._members), end - start
+        if count > zipfile.ZIP_FILECOUNT_LIMIT or max(start, size) > zipfile.ZIP64_LIMIT:
+            self._f.write(_ZIP64_END_RECORD.pack(
+                b'PK\x06\x06', _ZIP64_END_RECORD.size - 12, _ZIP64_VERSION, _ZIP64_VERSION,
+                0, 0, count, count, size, start))
+            self._f.write(_ZIP64_END_LOCATOR.pack(b'PK\x06\x07', 0, end, 1))
+            count, size, start = (min(count, _UINT16_MAX), min(size, _UINT32_MAX),
+                                  min(start, _UINT32_MAX))
+        self._f.write(_END_RECORD.pack(b'PK\x05\x06', 0, 0, count, count, size, start, 0))
+
 
+def _pack(path: str, output_path: str, pkginfo_data: bytes,
+          compression: int = zipfile.ZIP_DEFLATED, compresslevel: Optional[int] = None,
+          workers: Optional[int] = None, cache: Optional[BuildCache] = None,
+          manifest: bool = True) -> None:
+    """Pack package directory into a reproducible archive.
 
-def _pack(path: str, output_path: str) -> None:
-    with zipfile.ZipFile(output_path, 'w') as zf:
-        _zipdir(path, zf)
+    Files are read straight from path, skipping pkginfo.py. Members are
+    compressed in a thread pool (zlib, bz2 and lzma release the GIL), a few
+    per worker ahead of the one being written, and written in sorted order,
+    PKGINFO first, with fixed timestamps and permissions, so the same files
+    always give the same archive byte for byte. Files unchanged since the
+    last build are taken from ``cache``. MANIFEST is written last unless
+    ``manifest`` is false.
+    """
+    names = _walk(path)
+    stats = [os.stat(os.path.join(path, name)) for name in names]
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)  # as ThreadPoolExecutor
+    queue: Deque[Tuple[Union[Future[_Member], _Member], os.stat_result]] = deque()
+    entries: List[Tuple[str, int, str]] = []
+
+    def write_next() -> None:
+        member, st = queue.popleft()
+        if not isinstance(member, Future):
+            info, data, sha256, _ = member
+            archive.append(info, data)
+            entries.append(('/' + info.filename, info.file_size, sha256))
+            return
+        info, data, sha256, cached_data = member.result()
+        archive.append(info, data)
+        entries.append(('/' + info.filename, info.file_size, sha256))
+        if cache is not None:
+            cache.add_file(os.path.join(path, info.filename), st, sha256)
+            if not cached_data:
+                cache.add_member(sha256, info.CRC, info.file_size, info.compress_type, data)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, open(output_path, 'wb') as f:
+        archive = _ArchiveWriter(f)
+        compress_type, data = _compress(pkginfo_data, compression, compresslevel)
+        archive.append(_member_info(PKGINFO_NAME, zlib.crc32(pkginfo_data), len(pkginfo_data),
+                                    compress_type, len(data)), data)
+        for name, st in zip(names, stats):
+            source = os.path.join(path, name)
+            digest = cache.digest(source, st) if cache is not None else None
+            cached = cache.member(digest) if cache is not None and digest else None
+            if cached is not None:
+                assert digest is not None
+                crc, size, compress_type, data = cached
+                queue.append(((_member_info(name, crc, size, compress_type, len(data)),
+                               data, digest, True), st))
+            else:
+                queue.append((pool.submit(_build_member, source, name, compression,
+                                          compresslevel, cache), st))
+            # bound memory: only a few members are held compressed at a time
+            while len(queue) > workers * PACK_QUEUE_PER_WORKER:
+                write_next()
+        while queue:
+            write_next()
+        if manifest:
+            manifest_data = gen_manifest(entries).encode('utf-8')
+            compress_type, data = _compress(manifest_data, compression, compresslevel)
+            archive.append(_member_info(MANIFEST_NAME, zlib.crc32(manifest_data),
+                                        len(manifest_data), compress_type, len(data)), data)
+        archive.close()
+    if cache is not None:
+        cache.commit()
 
 
 def gen_pkginfo(pkginfo: PkgInfo) -> str:
@@ -46,8 +271,38 @@ def gen_pkginfo(pkginfo: PkgInfo) -> str:
     return data
 
 
-def pack(dirpath: str, output_path: str) -> None:
-    pkginfopath = os.path.join(dirpath, 'pkginfo.py')
+def gen_manifest(entries: Sequence[Tuple[str, int, str]]) -> str:
+    """Make MANIFEST listing (path, size, sha256) of every package file"""
+    data = '# This file automatically generated by BAP. Format: <sha256> <size> <path>\n'
+    for path, size, sha256 in entries:
+        data += f'{sha256} {size} {path}\n'
+    return data
+
+
+def parse_manifest(data: str) -> Dict[str, Tuple[int, str]]:
+    """Return {path: (size, sha256)} from MANIFEST"""
+    files = {}
+    for line in data.split('\n'):
+        if line.strip().startswith('#') or not line.strip():
+            continue
+        sha256, size, path = line.split(' ', 2)
+        files[path] = (int(size), sha256)
+    return files
+
+
+def pack(dirpath: str, output_path: str, compression: int = zipfile.ZIP_DEFLATED,
+         compresslevel: Optional[int] = None, workers: Optional[int] = None,
+         use_cache: bool = True, manifest: bool = True) -> None:
+    """Build package from directory with pkginfo.py.
+
+    ``compression`` is one of zipfile.ZIP_* methods, ``compresslevel`` as in
+    zipfile; members are compressed by ``workers`` threads. With
+    ``use_cache``, compressed members are reused from previous builds.
+    Without ``manifest``, the package has no MANIFEST: bap before MANIFEST
+    was added installs it as a file /MANIFEST, which conflicts between
+    packages.
+    """
+    pkginfopath = os.path.join(dirpath, PKGINFO_SOURCE_NAME)
     if not os.path.exists(pkginfopath):
         raise PkgInfoNotFound('pkginfo.py file not found')
     f = open(pkginfopath)
@@ -57,17 +312,10 @@ def pack(dirpath: str, output_path: str) -> None:
     exec(data, {'PkgInfo': PkgInfo, 'Version': Version, 'Person': Person}, values)
 
     pkginfo = values['pkginfo']
-    pkginfo_data = gen_pkginfo(pkginfo)
-    builddir = tempfile.mkdtemp()
-    buildpkg = os.path.join(builddir, dirpath + '.pkgdir')
-    if os.path.exists(buildpkg):
-        shutil.rmtree(buildpkg)
-    shutil.copytree(dirpath, buildpkg)
-    os.remove(buildpkg + '/pkginfo.py')
-    f = open(buildpkg + '/PKGINFO', 'w')
-    f.write(pkginfo_data)
-    f.close()
-    _pack(buildpkg, output_path)
+    pkginfo_data = gen_pkginfo(pkginfo).encode('utf-8')
+    cache = BuildCache(compression, compresslevel) if use_cache else None
+    _pack(dirpath, output_path, pkginfo_data, compression, compresslevel, workers, cache,
+          manifest)
 
 
 def _parse_pkginfo(data: str) -> Dict[str, str]:
@@ -97,20 +345,96 @@ def parse_pkginfo(data: str) -> PkgInfo:
         maintainer=maintainer)
 
 
+def _member_path(name: str) -> str:
+    """Convert zip member name to package file path (e.g. '/bapman/ui/menu.py')"""
+    parts = name.split('/')
+    if name.startswith('/') or '..' in parts or '\\' in name or ':' in parts[0]:
+        raise UnsafePath(f'unsafe path in package: {name}')
+    return '/' + name
+
+
+def read(zf: zipfile.ZipFile) -> Tuple[PkgInfo, List[zipfile.ZipInfo]]:
+    """Read PKGINFO and the file list from the zip central directory.
+
+    Returns package info with ``files`` filled and the zip members holding
+    these files, in the same order.
+    """
+    try:
+        pkginfo_data = zf.read(PKGINFO_NAME).decode('utf-8')
+    except KeyError:
+        raise PkgInfoNotFound('PKGINFO file not found')
+    pkginfo = parse_pkginfo(pkginfo_data)
+    members = [info for info in zf.infolist()
+               if not info.is_dir() and info.filename not in _METADATA_NAMES]
+    pkginfo.files = [_member_path(info.filename) for info in members]
+    return pkginfo, members
+
+
+def member_digests(members: Sequence[zipfile.ZipInfo]) -> Dict[str, Tuple[int, int]]:
+    """Return {file path: (crc, size)} of members, taken from the central directory"""
+    return {_member_path(info.filename): (info.CRC, info.file_size) for info in members}
+
+
+def inspect(path: str) -> Tuple[PkgInfo, List[FileEntry]]:
+    """Read package info and files of package without extracting anything.
+
+    Everything comes from PKGINFO and the zip central directory; sha256 of
+    files is taken from MANIFEST if the package has one (packages built by
+    genpkg do), after checking it agrees with the central directory.
+    """
+    with zipfile.ZipFile(path, 'r') as zf:
+        pkginfo, members = read(zf)
+        try:
+            manifest: Optional[Dict[str, Tuple[int, str]]] = parse_manifest(
+                zf.read(MANIFEST_NAME).decode('utf-8'))
+        except KeyError:
+            manifest = None
+    assert pkginfo.files is not None
+    entries = []
+    for file, info in zip(pkginfo.files, members):
+        sha256 = None
+        if manifest is not None:
+            size, sha256 = manifest.pop(file, (None, None))
+            if size != info.file_size:
+                raise ManifestMismatch(f'{path}: {file} does not match MANIFEST')
+        entries.append(FileEntry(path=file, size=info.file_size, crc=info.CRC, sha256=sha256))
+    if manifest:
+        raise ManifestMismatch(f'{path}: files listed in MANIFEST are missing: '
+                               + ', '.join(manifest))
+    return pkginfo, entries
+
+
+def extract_members(zf: zipfile.ZipFile, members: Sequence[zipfile.ZipInfo], dest: str,
+                    before_write: Optional[Callable[[str], None]] = None) -> None:
+    """Stream each member once from the archive to its place under ``dest``.
+
+    Every file is written next to its target and renamed over it, so an
+    existing file is replaced atomically. ``before_write`` is called with
+    the target path before it is replaced.
+    """
+    made_dirs: Set[str] = set()
+    for info in members:
+        target = dest + _member_path(info.filename)
+        parent = os.path.dirname(target)
+        if parent not in made_dirs:
+            os.makedirs(parent, exist_ok=True)
+            made_dirs.add(parent)
+        tmp = target + '.bapnew'
+        try:
+            with zf.open(info, 'r') as src, open(tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+            if before_write is not None:
+                before_write(target)
+            os.replace(tmp, target)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
 def unpack(path: str) -> Tuple[PkgInfo, str]:
+    """Extract package files to a new temporary directory"""
     with zipfile.ZipFile(path, 'r') as zf:
-        pkginfo_file = zf.open('PKGINFO', 'r')
-        pkginfo_data = pkginfo_file.read().decode('utf-8')
-        pkginfo_file.close()
-        pkginfo = parse_pkginfo(pkginfo_data)
+        pkginfo, members = read(zf)
         pkgdir = tempfile.mkdtemp()
-        zf.extractall(pkgdir)
-        os.remove(os.path.join(pkgdir, 'PKGINFO'))
-        pkginfo.files = []
-        current_dir = os.getcwd()
-        os.chdir(pkgdir)
-        for root, dirs, files in os.walk('.'):
-            for file in files:
-                pkginfo.files.append(os.path.join(root, file)[1:])
-        os.chdir(current_dir)
+        extract_members(zf, members, pkgdir)
         return pkginfo, pkgdir
@@ -2,48 +2,312 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
-
-import distutils.dir_util
 import os
+import shutil
+import zipfile
+import tempfile
+import contextlib
+
 from .pkginfo import PkgInfo
 from . import package
-from .db import Database
-from .consts import ROOT_DIR, DBFILE
+from .db import Database, PackageNotFound, PackageAlreadyExists
+from . import consts, installed
 
 if TYPE_CHECKING:
-    from typing import Optional, List
+    from typing import Optional, List, Dict, Sequence, Tuple, Set
 
 
 class FileConflictError(Exception):
     pass
 
 
+def _db_path(path: str) -> str:
+    """Convert path under root (absolute or relative to root) to the form stored in database"""
+    root = consts.paths().root
+    if path.startswith(root + os.sep):
+        path = path[len(root):]
+    return '/' + path.replace(os.sep, '/').lstrip('/')
+
+
+def owner(path: str) -> Optional[str]:
+    """Return name of installed package owning file at path, if any"""
+    return Database().owner(_db_path(path))
+
+
+def files(name: str) -> List[str]:
+    """Return paths (relative to root, with leading '/') of installed package files"""
+    pkginfo = Database().query(name, with_files=True)
+    if pkginfo is None:
+        raise PackageNotFound(f'package {name} not found in database')
+    assert pkginfo.files is not None
+    return pkginfo.files
+
+
+def _upgrading(db: Database, pkginfos: Sequence[PkgInfo], upgrade: bool) -> Set[str]:
+    """Return names of pkginfos already installed, which are to be upgraded.
+
+    Raise PackageAlreadyExists if any is installed and not ``upgrade``, so
+    that a reinstall is not reported as a package conflicting with itself.
+    """
+    upgrading: Set[str] = set()
+    for pkginfo in pkginfos:
+        if db.query(pkginfo.name) is not None:
+            if not upgrade:
+                raise PackageAlreadyExists(f'package {pkginfo.name} already exists in database')
+            upgrading.add(pkginfo.name)
+    return upgrading
+
+
+def _check_conflicts(db: Database, pkginfos: Sequence[PkgInfo], upgrading: Set[str],
+                     root: str) -> None:
+    """Raise FileConflictError if files of pkginfos collide with each other or
+    with files of other packages or untracked files under root.
+
+    Ownership of all paths is looked up in the database at once; only paths
+    owned by no package are checked on disk.
+    """
+    new_owners: Dict[str, str] = {}
+    for pkginfo in pkginfos:
+        assert pkginfo.files is not None
+        for file in pkginfo.files:
+            if new_owners.setdefault(file, pkginfo.name) != pkginfo.name:
+                raise FileConflictError(f'{file} ({new_owners[file]}, {pkginfo.name})')
+    owners = db.owners(new_owners)
+    for file, name in new_owners.items():
+        current = owners.get(file)
+        if current is None:
+            if os.path.lexists(root + file):
+                raise FileConflictError(file)
+        elif current != name or name not in upgrading:
+            raise FileConflictError(f'{file} (owned by {current})')
+
+
+class _FileTransaction:
+    """Changes of files under root that can be rolled back.
+
+    Files about to be overwritten are backed up (hard-linked where the
+    filesystem allows) and files about to be removed are moved aside into a
+    private directory inside root. Backups are deleted on commit or moved
+    back on rollback. Directories made for new files are removed on
+    rollback if nothing else was put in them meanwhile.
+    """
+
+    def __init__(self, root: str) -> None:
+        self._root = root
+        self._backup_dir: Optional[str] = None
+        self._created: List[str] = []
+        self._created_dirs: List[str] = []
+        self._moved: List[Tuple[str, str]] = []
+
+    def _backup_path(self) -> str:
+        if self._backup_dir is None:
+            self._backup_dir = tempfile.mkdtemp(dir=self._root, prefix='.baptxn-')
+        return os.path.join(self._backup_dir, str(len(self._moved)))
+
+    def _move_aside(self, path: str) -> None:
+        backup = self._backup_path()
+        os.replace(path, backup)
+        self._moved.append((path, backup))
+
+    def before_write(self, path: str) -> None:
+        """Back up path, which is about to be replaced in place"""
+        if not os.path.lexists(path):
+            self._created.append(path)
+            return
+        backup = self._backup_path()
+        try:
+            os.link(path, backup)
+        except OSError:  # e.g. no hard links on Android shared storage
+            shutil.copy2(path, backup)
+        self._moved.append((path, backup))
+
+    def remove(self, path: str) -> None:
+        self._move_aside(path)
+
+    def makedirs(self, path: str) -> None:
+        """Create directory path and its missing parents"""
+        missing: List[str] = []
+        while not os.path.isdir(path):
+            missing.append(path)
+            path = os.path.dirname(path)
+        for directory in reversed(missing):
+            try:
+                os.mkdir(directory)
+            except FileExistsError:  # made by someone else meanwhile
+                continue
+            self._created_dirs.append(directory)
+
+    def commit(self) -> None:
+        if self._backup_dir is not None:
+            shutil.rmtree(self._backup_dir, ignore_errors=True)
+        self._backup_dir = None
+        self._created.clear()
+        self._created_dirs.clear()
+        self._moved.clear()
+
+    def rollback(self) -> None:
+        for path in reversed(self._created):
+            if os.path.lexists(path):
+                os.remove(path)
+        for path, backup in reversed(self._moved):
+            os.replace(backup, path)
+        for directory in reversed(self._created_dirs):
+            try:
+                os.rmdir(directory)
+            except OSError:  # not empty
+                pass
+        self.commit()
+
+
+def _unchanged(path: str, digest: Tuple[Optional[int], Optional[int]],
+               new_digest: Tuple[int, int]) -> bool:
+    """Whether installed file at path already has contents described by new_digest"""
+    if digest != new_digest:
+        return False
+    try:
+        return os.lstat(path).st_size == new_digest[1]
+    except OSError:
+        return False
+
+
+def _files_to_write(db: Database, pkginfo: PkgInfo, members: List[zipfile.ZipInfo],
+                    digests: Dict[str, Tuple[int, int]], upgrading: bool,
+                    root: str) -> List[Tuple[str, zipfile.ZipInfo]]:
+    """Return (path, member) of package files the archive must be extracted to.
+
+    When upgrading, files are compared by path, CRC-32 and size recorded at
+    install time, and only changed and new files are written.
+    """
+    assert pkginfo.files is not None
+    if not upgrading:
+        return list(zip(pkginfo.files, members))
+    old_digests = db.digests(pkginfo.name)
+    return [(file, info) for file, info in zip(pkginfo.files, members)
+            if not _unchanged(root + file, old_digests.get(file, (None, None)), digests[file])]
+
+
+def _write_files(txn: _FileTransaction, zf: zipfile.ZipFile,
+                 files: List[Tuple[str, zipfile.ZipInfo]], root: str, staging: str,
+                 staged: Set[str]) -> None:
+    """Move files staged under staging into place, extracting the ones not staged first"""
+    package.extract_members(zf, [info for file, info in files if file not in staged], staging)
+    made_dirs: Set[str] = set()
+    for file, _ in files:
+        parent = os.path.dirname(root + file)
+        if parent not in made_dirs:
+            txn.makedirs(parent)
+            made_dirs.add(parent)
+        txn.before_write(root + file)
+        os.replace(staging + file, root + file)
+        staged.discard(file)
+
+
+def _remove_old_files(db: Database, txn: _FileTransaction, pkginfo: PkgInfo,
+                      digests: Dict[str, Tuple[int, int]], root: str) -> None:
+    """Remove installed files of package that are no longer in the new archive"""
+    for file in db.digests(pkginfo.name):
+        if file not in digests and os.path.lexists(root + file):
+            txn.remove(root + file)
+
+
+def install_many(paths: Sequence[str], upgrade: bool = False) -> List[PkgInfo]:
+    """Install several packages at once, all or nothing.
+
+    Conflicts are checked over the combined file set before anything is
+    written; files and database rows of all packages are then changed in a
+    single pass and a single transaction. With ``upgrade``, packages that
+    are already installed are upgraded and the rest installed.
+
+    Safe to call from several threads and processes: archives are extracted
+    concurrently into a private staging directory (``.bapnew-*`` inside the
+    root), and the database write lock is held only for the conflict check,
+    the renames and the database changes. Files that turn out to be needed
+    only after the database changed meanwhile are extracted while holding it.
+    """
+    locations = consts.paths()
+    root = consts.ensure_dir(locations.root)
+    db = Database(locations.db_file)
+    staged: Set[str] = set()
+    with contextlib.ExitStack() as stack:
+        archives: List[Tuple[zipfile.ZipFile, PkgInfo, List[zipfile.ZipInfo],
+                             Dict[str, Tuple[int, int]]]] = []
+        for path in paths:
+            zf = stack.enter_context(zipfile.ZipFile(path, 'r'))
+            pkginfo, members = package.read(zf)
+            archives.append((zf, pkginfo, members, package.member_digests(members)))
+        pkginfos = [pkginfo for _, pkginfo, _, _ in archives]
+
+        staging = tempfile.mkdtemp(dir=root, prefix='.bapnew-')
+        try:
+            # Stage against the current state without the write lock; this
+            # check is repeated under the lock, it only avoids useless work
+            upgrading = _upgrading(db, pkginfos, upgrade)
+            _check_conflicts(db, pkginfos, upgrading, root)
+            for zf, pkginfo, members, digests in archives:
+                files = _files_to_write(db, pkginfo, members, digests,
+                                        pkginfo.name in upgrading, root)
+                package.extract_members(zf, [info for _, info in files], staging)
+                staged.update(file for file, _ in files)
+
+            txn = _FileTransaction(root)
+            db.begin()
+            try:
+                upgrading = _upgrading(db, pkginfos, upgrade)
+                _check_conflicts(db, pkginfos, upgrading, root)
+                for zf, pkginfo, members, digests in archives:
+                    files = _files_to_write(db, pkginfo, members, digests,
+                                            pkginfo.name in upgrading, root)
+                    _write_files(txn, zf, files, root, staging, staged)
+                    if pkginfo.name in upgrading:
+                        _remove_old_files(db, txn, pkginfo, digests, root)
+                        db.update(pkginfo, digests)
+                    else:
+                        db.add(pkginfo, digests)
+                db.commit()
+            except BaseException:
+                db.rollback()
+                txn.rollback()
+                raise
+            txn.commit()
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    installed.notify(locations.db_file)
+    return pkginfos
+
+
+def uninstall_many(names: Sequence[str]) -> None:
+    """Uninstall several packages at once, all or nothing"""
+    locations = consts.paths()
+    db = Database(locations.db_file)
+    txn = _FileTransaction(locations.root)
+    db.begin()
+    try:
+        pkginfos: List[PkgInfo] = []
+        for name in names:
+            pkginfo = db.query(name, with_files=True)
+            if pkginfo is None:
+                raise PackageNotFound(f'package {name} not found in database')
+            pkginfos.append(pkginfo)
+        for pkginfo in pkginfos:
+            assert pkginfo.files is not None
+            for file in pkginfo.files:
+                if os.path.lexists(locations.root + file):
+                    txn.remove(locations.root + file)
+                else:
+                    print(f'warning: bap: file not found: {file}')
+            db.remove(pkginfo.name)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        txn.rollback()
+        raise
+    txn.commit()
+    installed.notify(locations.db_file)
+
+
 def install(path: str, upgrade: bool = False) -> PkgInfo:
-    pkginfo, pkgdir = package.unpack(path)
-    if not upgrade:  # FIXME if new files
-        for root, dirs, files in os.walk(pkgdir):
-            for file in files:
-                fpath = os.path.join(root, file)
-                if os.path.exists(fpath[len(pkgdir) + 1:]):
-                    raise FileConflictError(fpath[len(pkgdir) + 1:])
-    distutils.dir_util.copy_tree(pkgdir, ROOT_DIR)
-    db = Database(DBFILE)
-    if upgrade:
-        db.update(pkginfo)
-    else:
-        db.add(pkginfo)
-    db.commit()
-    return pkginfo
+    return install_many([path], upgrade=upgrade)[0]
 
 
 def uninstall(name: str) -> None:
-    db = Database(DBFILE)
-    pkginfo = db.query(name, with_files=True)
-    assert pkginfo.files
-    for file in pkginfo.files:
-        if os.path.exists(ROOT_DIR + file):
-            os.remove(ROOT_DIR + file)
-        else:
-            print(f'warning: bap: file not found: {file}')
-    db.remove(name)
-    db.commit()
+    uninstall_many([name])
@@ -2,6 +2,9 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
+import re
+import functools
+
 # use it instead? but what about android devices?
 # from packaging.version import Version
 
@@ -9,7 +12,59 @@ if TYPE_CHECKING:
     from typing import Optional, List
 
 
+# https://semver.org/#is-there-a-suggested-regular-expression-regex-to-check-a-semver-string
+_VERSION_RE = re.compile(
+    r'(0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)'
+    r'(?:-((?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*)'
+    r'(?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*))*))?'
+    r'(?:\+([0-9a-zA-Z-]+(?:\.[0-9a-zA-Z-]+)*))?')
+
+# Versions stored by bap before they were validated: any x.y.z with
+# arbitrary prerelease and build parts
+_LOOSE_VERSION_RE = re.compile(r'(\d+)\.(\d+)\.(\d+)(?:-([^+]*))?(?:\+(.*))?', re.ASCII)
+
+_VERSION_CACHE_SIZE = 8192
+
+
+class InvalidVersion(ValueError):
+    pass
+
+
+def _key_number(number: int) -> str:
+    digits = str(number)
+    return f'{len(digits):02d}{digits}'
+
+
+def _version_key(major: int, minor: int, patch: int,
+                 prerelease: Optional[str], buildinfo: Optional[str]) -> str:
+    """Make string that sorts (as plain bytes, e.g. in sqlite) in version order.
+
+    Numbers are length-prefixed; a release sorts after its prereleases ('~'
+    after '-'); prerelease identifiers compare numerically or by ASCII as
+    SemVer says, with ' ' ending the list and '!' separating identifiers
+    (both lower than any identifier character). Build metadata, ignored by
+    SemVer, only breaks ties so that the order is total.
+    """
+    key = _key_number(major) + _key_number(minor) + _key_number(patch)
+    if prerelease:
+        key += '-' + '!'.join('0' + _key_number(int(part)) if part.isdecimal() else '1' + part
+                              for part in prerelease.split('.')) + ' '
+    else:
+        key += '~'
+    if buildinfo:
+        key += '+' + buildinfo
+    return key
+
+
 class Version:
+    """Semantic version. Immutable, hashable and totally ordered.
+
+    Ordered by SemVer precedence, with build metadata as the final
+    tiebreak. ``key`` is a string with the same order.
+    """
+
+    __slots__ = ('major', 'minor', 'patch', 'prerelease', 'buildinfo', 'key')
+
     def __init__(self, major: int, minor: int, patch: int,
                  prerelease: Optional[str] = None, buildinfo: Optional[str] = None) -> None:
         self.major = major
@@ -17,6 +72,7 @@ class Version:
         self.patch = patch
         self.prerelease = prerelease
         self.buildinfo = buildinfo
+        self.key = _version_key(major, minor, patch, prerelease, buildinfo)
 
     def to_string(self) -> str:
         return f'{self.major}.{self.minor}.{self.patch}' \
@@ -25,29 +81,85 @@ class Version:
 
     @classmethod
     def from_string(cls, string: str) -> Version:
-        try:
-            major, minor, patch = string.split('.')
-        except ValueError:
-            return Version(
-                major=0,
-                minor=0,
-                patch=0,
-                prerelease='error',
-                buildinfo='error')
-        patch = patch.split('-', 1)[0]
-        prerelease = string.split('-', 1)[1].split('+', 1)[0] if '-' in string else None
-        buildinfo = string.split('+', 1)[1] if '+' in string else None
-        return Version(
-            major=int(major),
-            minor=int(minor),
-            patch=int(patch),
-            prerelease=prerelease,
-            buildinfo=buildinfo)
+        """Parse version, raising InvalidVersion if string is not a SemVer version.
+
+        Results are cached, so parsing the same string again returns the
+        same object.
+        """
+        return _parse_version(string)
+
+    @classmethod
+    def from_stored(cls, string: str) -> Version:
+        """Parse version read back from a database of installed packages.
+
+        Versions installed by older bap were not validated, so strings that
+        are not SemVer do not raise: they are parsed as leniently as they
+        were then, down to 0.0.0-error+error. New input (PKGINFO,
+        repositories) must go through from_string.
+        """
+        return _parse_stored_version(string)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key == other.key
+
+    def __ne__(self, other: object) -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key != other.key
+
+    def __lt__(self, other: Version) -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key < other.key
+
+    def __le__(self, other: Version) -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key <= other.key
+
+    def __gt__(self, other: Version) -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key > other.key
+
+    def __ge__(self, other: Version) -> bool:
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key >= other.key
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+    def __str__(self) -> str:
+        return self.to_string()
 
     def __repr__(self) -> str:
         return f'<bapack.Version object {self.to_string()}>'
 
 
+@functools.lru_cache(maxsize=_VERSION_CACHE_SIZE)
+def _parse_version(string: str) -> Version:
+    match = _VERSION_RE.fullmatch(string.strip())
+    if match is None:
+        raise InvalidVersion(f'invalid version: {string!r}')
+    major, minor, patch, prerelease, buildinfo = match.groups()
+    return Version(int(major), int(minor), int(patch), prerelease, buildinfo)
+
+
+@functools.lru_cache(maxsize=_VERSION_CACHE_SIZE)
+def _parse_stored_version(string: str) -> Version:
+    try:
+        return _parse_version(string)
+    except InvalidVersion:
+        pass
+    match = _LOOSE_VERSION_RE.fullmatch(string.strip())
+    if match is None:
+        return Version(0, 0, 0, 'error', 'error')
+    major, minor, patch, prerelease, buildinfo = match.groups()
+    return Version(int(major), int(minor), int(patch), prerelease or None, buildinfo or None)
+
 
 class Person:
     def __init__(self, fullname: str, email: str, website: Optional[str] = None) -> None:
@@ -1,3 +1,5 @@
-from .download import download
-from .search import get_available_packages
-from .sync import sync
\ No newline at end of file
+from .download import download, cache_path
+from .search import (get_available_packages, get_download_url, get_provider,
+                     get_package_info, get_versions, search)
+from .sync import sync, SyncResult
+from .resolve import resolve, install
@@ -0,0 +1,273 @@
+"""asyncio client for package repositories.
+
+Mirrors the blocking API (bap.repo.sync, download, get_available_packages,
+get_download_url) for programs running an event loop, e.g. tools fetching
+many packages at once. HTTP is spoken over asyncio streams, so requests
+are cancelled like any other task and cost no threads. At most
+``max_connections`` requests of a Client run at once; ``timeout`` limits
+connecting and every single read.
+
+Local index queries run in the default executor. Unlike the blocking
+download, this one does not resume partial downloads or use deltas.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import io
+import os
+import ssl
+import asyncio
+import hashlib
+import tempfile
+import contextlib
+import contextvars
+import http.client
+import urllib.parse
+
+from bap import consts
+from bap.repo import index, changelog
+from bap.repo.download import HashMismatch, DOWNLOAD_BUFSIZE, Archive, find_archive
+from bap.repo.search import (get_available_packages as _get_available_packages,
+                             get_download_url as _get_download_url)
+from bap.repo.sync import (Repository, SyncResult, UPDATED, NOT_MODIFIED, FAILED,
+                           get_repositories, conditional_headers, apply_changelog,
+                           replace_database, load_meta)
+
+if TYPE_CHECKING:
+    from typing import Any, Optional, List, Dict, Tuple, Callable, AsyncIterator
+    from bap.pkginfo import PkgInfo
+
+MAX_CONNECTIONS = 16
+TIMEOUT = 30.0
+MAX_REDIRECTS = 5
+
+
+class HTTPError(Exception):
+    def __init__(self, url: str, status: int) -> None:
+        super().__init__(f'{url}: HTTP {status}')
+        self.url = url
+        self.status = status
+
+
+class Response:
+    """Response whose body has not been read yet"""
+
+    def __init__(self, url: str, status: int, headers: http.client.HTTPMessage,
+                 reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 timeout: float) -> None:
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self._reader = reader
+        self._writer = writer
+        self._timeout = timeout
+
+    @property
+    def length(self) -> Optional[int]:
+        if self._chunked:
+            return None
+        try:
+            return int(self.headers['Content-Length'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    @property
+    def _chunked(self) -> bool:
+        return 'chunked' in self.headers.get('Transfer-Encoding', '').lower()
+
+    async def _read(self, coro: Any) -> Any:
+        return await asyncio.wait_for(coro, self._timeout)
+
+    async def iter_chunks(self, bufsize: int = DOWNLOAD_BUFSIZE) -> AsyncIterator[bytes]:
+        if self._chunked:
+            while True:
+                size = int((await self._read(self._reader.readline())).split(b';')[0], 16)
+                if size == 0:
+                    return
+                yield await self._read(self._reader.readexactly(size))
+                await self._read(self._reader.readexactly(2))  # CRLF after chunk
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            chunk = await self._read(self._reader.read(
+                bufsize if remaining is None else min(bufsize, remaining)))
+            if not chunk:
+                if remaining:
+                    raise IOError(f'{self.url}: connection closed, {remaining} bytes missing')
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+    async def read(self) -> bytes:
+        return b''.join([chunk async for chunk in self.iter_chunks()])
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class Client:
+    """Connection limit and timeout shared by requests.
+
+    Must be created in the event loop it is used in.
+    """
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS, timeout: float = TIMEOUT) -> None:
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_connections)
+        self._ssl: Optional[ssl.SSLContext] = None
+
+    async def _open(self, url: str, headers: Dict[str, str]) -> Response:
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'{url}: unsupported scheme')
+        tls = None
+        if parts.scheme == 'https':
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            tls = self._ssl
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, parts.port or (443 if tls else 80), ssl=tls),
+            self.timeout)
+        try:
+            target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            lines = [f'GET {target} HTTP/1.1', f'Host: {parts.netloc}',
+                     'Connection: close', 'Accept-Encoding: identity']
+            lines += [f'{name}: {value}' for name, value in headers.items()]
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            await writer.drain()
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+            status_line, _, header_data = head.partition(b'\r\n')
+            try:
+                status = int(status_line.split()[1])
+            except (IndexError, ValueError):
+                raise IOError(f'{url}: bad status line {status_line!r}')
+        except BaseException:
+            writer.close()
+            raise
+        return Response(url, status, http.client.parse_headers(io.BytesIO(header_data)),
+                        reader, writer, self.timeout)
+
+    @contextlib.asynccontextmanager
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None,
+                  ok: Tuple[int, ...] = (200,)) -> AsyncIterator[Response]:
+        """GET url, following redirects, as ``async with client.get(url) as response``.
+
+        Raises HTTPError unless the final status is one of ok. Holds one of
+        the client's connections until the block is left.
+        """
+        async with self._semaphore:
+            for _ in range(MAX_REDIRECTS + 1):
+                response = await self._open(url, headers or {})
+                try:
+                    location = response.headers.get('Location')
+                    if response.status in (301, 302, 303, 307, 308) and location:
+                        url = urllib.parse.urljoin(url, location)
+                        continue
+                    if response.status not in ok:
+                        raise HTTPError(url, response.status)
+                    yield response
+                    return
+                finally:
+                    response.close()
+            raise HTTPError(url, response.status)
+
+
+async def _run(func: Callable[..., Any], *args: Any) -> Any:
+    # in a copy of this context, so that root set by consts.using() applies
+    return await asyncio.get_running_loop().run_in_executor(
+        None, contextvars.copy_context().run, func, *args)
+
+
+async def _patch_repo(client: Client, repo: Repository,
+                      meta: Dict[str, str]) -> Optional[SyncResult]:
+    try:
+        async with client.get(changelog.changelog_url(repo.url_repo_database),
+                              conditional_headers(meta, 'changes_'), ok=(200, 304)) as response:
+            if response.status == 304:
+                return SyncResult(repo=repo, status=NOT_MODIFIED)
+            data = await response.read()
+    except HTTPError:
+        return None  # repository does not publish changelog
+    result: Optional[SyncResult] = await _run(apply_changelog, repo, meta, response, data)
+    return result
+
+
+async def _download_repo(client: Client, repo: Repository, meta: Dict[str, str]) -> SyncResult:
+    async with client.get(repo.url_repo_database, conditional_headers(meta),
+                          ok=(200, 304)) as response:
+        if response.status == 304:
+            return SyncResult(repo=repo, status=NOT_MODIFIED)
+        with replace_database(repo, response) as f:
+            async for chunk in response.iter_chunks():
+                f.write(chunk)
+    return SyncResult(repo=repo, status=UPDATED)
+
+
+async def _sync_repo(client: Client, repo: Repository) -> SyncResult:
+    meta = load_meta(repo)
+    try:
+        if meta:
+            result = await _patch_repo(client, repo, meta)
+            if result is not None:
+                return result
+        return await _download_repo(client, repo, meta)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:  # pylint: disable=broad-except
+        return SyncResult(repo=repo, status=FAILED, error=e)
+
+
+async def sync(client: Optional[Client] = None) -> List[SyncResult]:
+    """Fetch all repository databases concurrently, like bap.repo.sync"""
+    client = client or Client()
+    repos = await _run(get_repositories)
+    results = list(await asyncio.gather(*(_sync_repo(client, repo) for repo in repos)))
+    await _run(index.rebuild, repos)
+    return results
+
+
+async def get_available_packages() -> List[PkgInfo]:
+    packages: List[PkgInfo] = await _run(_get_available_packages)
+    return packages
+
+
+async def get_download_url(pkgname: str, version: Optional[str] = None) -> str:
+    url: str = await _run(_get_download_url, pkgname, version)
+    return url
+
+
+async def download(pkgname: str, version: Optional[str] = None,
+                   progress: Optional[Callable[[int], None]] = None,
+                   client: Optional[Client] = None) -> str:
+    """Download package archive to cache, like bap.repo.download.
+
+    Calls progress(percent) as data arrives. Returns path of the archive.
+    """
+    client = client or Client()
+    archive: Archive = await _run(find_archive, pkgname, version)
+    if await _run(archive.is_cached):
+        return archive.path
+    fd, partpath = tempfile.mkstemp(dir=consts.ensure_dir(os.path.dirname(archive.path)),
+                                    prefix=os.path.basename(archive.path), suffix='.part')
+    hasher = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            async with client.get(archive.url) as response:
+                length, nbytes, percent = response.length, 0, -1
+                async for chunk in response.iter_chunks():
+                    hasher.update(chunk)
+                    nbytes += f.write(chunk)
+                    if progress and length and 100 * nbytes // length != percent:
+                        percent = 100 * nbytes // length
+                        progress(percent)
+        if archive.sha256 and hasher.hexdigest() != archive.sha256.lower():
+            raise HashMismatch(f'{archive.url}: expected sha256 {archive.sha256}, '
+                               f'got {hasher.hexdigest()}')
+        os.replace(partpath, archive.path)
+    except BaseException:
+        os.remove(partpath)
+        raise
+    archive.save_meta()
+    return archive.path
@@ -0,0 +1,172 @@
+"""Incremental repository database updates.
+
+A repository may publish a changelog next to its database, at
+``<url_repo_database>.changes``. It is a JSON document::
+
+    {"seq": 12, "first": 3, "changes": [
+        {"seq": 11, "op": "put", "table": "packages", "row": {"name": "foo", ...}},
+        {"seq": 12, "op": "del", "table": "packages", "key": {"name": "bar"}}
+    ]}
+
+``seq`` is the sequence number of the published database, which also stores
+it in ``PRAGMA user_version``. ``first`` is the oldest sequence number whose
+changes are all present in the log, so a client holding database ``n`` can
+be patched when ``first <= n + 1``. Several changes may share a sequence
+number: every publish bumps it once.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import os
+import json
+import sqlite3
+import contextlib
+
+if TYPE_CHECKING:
+    from typing import Optional, List, Dict, Any, Tuple
+
+CHANGELOG_SUFFIX = '.changes'
+CHANGELOG_KEEP = 100  # sequence numbers kept in published changelog
+MAX_PATCH_GAP = 100  # download the full database when further behind
+
+
+class ChangelogError(Exception):
+    pass
+
+
+def changelog_url(url_repo_database: str) -> str:
+    return url_repo_database + CHANGELOG_SUFFIX
+
+
+def get_seq(dbpath: str) -> int:
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        seq: int = conn.execute('PRAGMA user_version').fetchone()[0]
+        return seq
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[Tuple[str, int]]:
+    """Return (column name, primary key position) pairs of table"""
+    return [(row[1], row[5]) for row in conn.execute(f'PRAGMA table_info(`{table}`)')]
+
+
+def _tables(conn: sqlite3.Connection) -> List[str]:
+    return [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+
+
+def _check_names(names: List[str], allowed: List[str]) -> None:
+    for name in names:
+        if name not in allowed:
+            raise ChangelogError(f'unknown column or table: {name}')
+
+
+def pending(changelog: Dict[str, Any], seq: int) -> Optional[List[Dict[str, Any]]]:
+    """Return changes needed to bring database ``seq`` up to date.
+
+    Returns None when the changelog can not do that and the full database
+    must be downloaded instead.
+    """
+    latest = changelog['seq']
+    if latest < seq or changelog['first'] > seq + 1 or latest - seq > MAX_PATCH_GAP:
+        return None
+    return [change for change in changelog['changes'] if change['seq'] > seq]
+
+
+def apply(dbpath: str, changes: List[Dict[str, Any]], seq: int) -> None:
+    """Apply changes to database and mark it as sequence number ``seq``.
+
+    Changes are applied in a single transaction: on any error the database
+    is left untouched.
+    """
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        with conn:
+            tables = _tables(conn)
+            columns: Dict[str, List[str]] = {}
+            for change in changes:
+                table = change.get('table', 'packages')
+                _check_names([table], tables)
+                if table not in columns:
+                    columns[table] = [name for name, _ in _columns(conn, table)]
+                if change['op'] == 'put':
+                    row: Dict[str, Any] = change['row']
+                    _check_names(list(row), columns[table])
+                    conn.execute(
+                        f'INSERT OR REPLACE INTO `{table}` ({", ".join(row)})'
+                        f' VALUES ({", ".join("?" * len(row))})', tuple(row.values()))
+                elif change['op'] == 'del':
+                    key: Dict[str, Any] = change['key']
+                    _check_names(list(key), columns[table])
+                    conn.execute(
+                        f'DELETE FROM `{table}` WHERE '
+                        + ' AND '.join(f'{name} = ?' for name in key), tuple(key.values()))
+                else:
+                    raise ChangelogError(f'unknown operation: {change["op"]}')
+            conn.execute(f'PRAGMA user_version = {int(seq)}')
+
+
+def _diff_table(old: sqlite3.Connection, new: sqlite3.Connection,
+                table: str) -> List[Dict[str, Any]]:
+    columns = _columns(new, table)
+    names = [name for name, _ in columns]
+    keys = [name for name, pk in sorted(columns, key=lambda c: c[1]) if pk] or names
+    select = f'SELECT {", ".join(names)} FROM `{table}`'
+
+    def rows(conn: sqlite3.Connection) -> Dict[Tuple[Any, ...], Tuple[Any, ...]]:
+        result: Dict[Tuple[Any, ...], Tuple[Any, ...]] = {}
+        for row in conn.execute(select):
+            record = dict(zip(names, row))
+            result[tuple(record[k] for k in keys)] = row
+        return result
+
+    old_rows: Dict[Tuple[Any, ...], Tuple[Any, ...]] = {}
+    if table in _tables(old) and [name for name, _ in _columns(old, table)] == names:
+        old_rows = rows(old)
+    new_rows = rows(new)
+    changes: List[Dict[str, Any]] = []
+    for key in old_rows.keys() - new_rows.keys():
+        changes.append({'op': 'del', 'table': table, 'key': dict(zip(keys, key))})
+    for key, row in new_rows.items():
+        if old_rows.get(key) != row:
+            changes.append({'op': 'put', 'table': table, 'row': dict(zip(names, row))})
+    return changes
+
+
+def publish(old_dbpath: str, new_dbpath: str, changelog_path: str,
+            keep: int = CHANGELOG_KEEP) -> int:
+    """Record changes from the published database to the new one.
+
+    Repository maintainers run it before uploading ``new_dbpath`` in place
+    of ``old_dbpath``. Stamps the new database with the next sequence number,
+    appends its changes to the changelog, drops changes older than ``keep``
+    sequence numbers and returns the new sequence number.
+    """
+    changelog: Dict[str, Any] = {'seq': 0, 'first': 1, 'changes': []}
+    if os.path.exists(changelog_path):
+        with open(changelog_path) as f:
+            changelog = json.load(f)
+
+    if not os.path.exists(old_dbpath):
+        old_dbpath = ':memory:'  # first publish: everything is new
+    with contextlib.closing(sqlite3.connect(old_dbpath)) as old, \
+            contextlib.closing(sqlite3.connect(new_dbpath)) as new:
+        seq: int = max(old.execute('PRAGMA user_version').fetchone()[0], changelog['seq']) + 1
+        if changelog['seq'] != seq - 1:
+            # Published database and changelog went out of sync: start over.
+            changelog = {'seq': seq - 1, 'first': seq, 'changes': []}
+        for table in _tables(new):
+            for change in _diff_table(old, new, table):
+                change['seq'] = seq
+                changelog['changes'].append(change)
+        new.execute(f'PRAGMA user_version = {seq}')
+        new.commit()
+
+    changelog['seq'] = seq
+    changelog['first'] = max(changelog['first'], seq - keep + 1)
+    changelog['changes'] = [c for c in changelog['changes'] if c['seq'] >= changelog['first']]
+    tmppath = changelog_path + '.tmp'
+    with open(tmppath, 'w') as f:
+        json.dump(changelog, f)
+    os.replace(tmppath, changelog_path)
+    return seq
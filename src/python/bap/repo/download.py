@@ -3,34 +3,370 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 import os
+import json
+import hashlib
+import zipfile
+import threading
+import contextvars
+import urllib.error
 import urllib.request
-from bap.repo.search import get_download_url
-from bap.consts import CACHE_DIR
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from dataclasses import dataclass, replace
+from bap import delta
+from bap.db import Database
+from bap.repo import index
+from bap.repo.search import PackageNotFoundError
+from bap import consts
 import datetime
 
 
 if TYPE_CHECKING:
-    from typing import Optional, List
+    from typing import Optional, List, Dict, Any, Iterator, Generator, Tuple
 
 
-def _download(url: str, dest: str, progress: bool = False) -> None:
+DOWNLOAD_BUFSIZE = 64 * 1024
+MIN_SEGMENT_SIZE = 1024 * 1024  # smaller files are not worth extra connections
+
+
+class HashMismatch(Exception):
+    pass
+
+
+class _RangeNotSupported(Exception):
+    pass
+
+
+def _load_part_meta(partpath: str, url: str) -> Optional[Dict[str, Any]]:
+    """Return validators of partially downloaded url if it can be resumed"""
+    if not os.path.exists(partpath):
+        return None
+    try:
+        with open(partpath + '.json') as f:
+            meta: Dict[str, Any] = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('url') != url:
+        return None
+    return meta
+
+
+def _if_range(meta: Dict[str, Any]) -> Optional[str]:
+    etag: Optional[str] = meta.get('etag')
+    if etag and not etag.startswith('W/'):  # weak ETags are not allowed in If-Range
+        return etag
+    last_modified: Optional[str] = meta.get('last_modified')
+    return last_modified
+
+
+def _content_range(header: Optional[str]) -> Tuple[int, Optional[int]]:
+    """Parse 'bytes <start>-<end>/<total>' to (start, total)"""
+    if not header or not header.startswith('bytes '):
+        return -1, None
+    spec, _, total = header[len('bytes '):].partition('/')
+    try:
+        return int(spec.split('-', 1)[0]), (None if total == '*' else int(total))
+    except ValueError:
+        return -1, None
+
+
+def _remove_part(partpath: str) -> None:
+    for path in (partpath, partpath + '.json'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _download(url: str, dest: str, progress: bool = False,
+              sha256: Optional[str] = None,
+              bufsize: int = DOWNLOAD_BUFSIZE) -> Iterator[int]:
+    """Download url to dest, verifying sha256 of the data if given.
+
+    Data goes to ``dest + '.part'`` first and is hashed while being written;
+    dest appears only when the download is complete and verified. An
+    interrupted download is resumed with a Range request on the next call
+    if the server supports it and the remote file (by ETag or Last-Modified
+    saved in ``.part.json``) has not changed meanwhile.
+    """
+    partpath = dest + '.part'
+    meta = _load_part_meta(partpath, url)
+    validator = _if_range(meta) if meta is not None else None
+    offset = os.path.getsize(partpath) if validator else 0
+    headers: Dict[str, str] = {}
+    if validator and offset:
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = validator
+
     opener = urllib.request.build_opener(
         urllib.request.HTTPSHandler())
-    data = opener.open(url)
-    nbytes = 0
-    length = data.length
-    last_info_time = int(datetime.datetime.now().timestamp())
-    with open(dest, 'wb') as f:
-        shatter = data.read(1024**2)
-        while shatter:
-            nbytes += f.write(shatter)
-            if progress and last_info_time != int(datetime.datetime.now().timestamp()):
-                last_info_time = int(datetime.datetime.now().timestamp())
-                yield (100 * nbytes // length)
-            shatter = data.read(1024)
-        f.close()
-
-
-def download(pkgname: str, progress: bool = False) -> None:
-    url = get_download_url(pkgname)
-    yield from _download(url, os.path.join(CACHE_DIR, pkgname + '.bap'), progress=progress)
+    try:
+        data = opener.open(urllib.request.Request(url, headers=headers))
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset:  # stale part, e.g. remote file got shorter
+            _remove_part(partpath)
+            yield from _download(url, dest, progress=progress, sha256=sha256, bufsize=bufsize)
+            return
+        raise
+
+    with data:
+        length = data.length
+        if offset and data.getcode() == 206:
+            start, total = _content_range(data.headers.get('Content-Range'))
+            assert meta is not None
+            if start != offset or (total is not None and meta.get('length') not in (None, total)):
+                data.close()
+                _remove_part(partpath)
+                yield from _download(url, dest, progress=progress, sha256=sha256, bufsize=bufsize)
+                return
+        else:
+            offset = 0  # full response: server can not resume or file was changed
+            with open(partpath + '.json', 'w') as f:
+                json.dump({'url': url, 'etag': data.headers.get('ETag'),
+                           'last_modified': data.headers.get('Last-Modified'),
+                           'length': length}, f)
+        length = offset + length if length is not None else None
+
+        hasher = hashlib.sha256()
+        if offset:
+            with open(partpath, 'rb') as f:
+                for chunk in iter(lambda: f.read(bufsize), b''):
+                    hasher.update(chunk)
+        nbytes = offset
+        last_info_time = int(datetime.datetime.now().timestamp())
+        with open(partpath, 'ab' if offset else 'wb') as f:
+            shatter = data.read(bufsize)
+            while shatter:
+                hasher.update(shatter)
+                nbytes += f.write(shatter)
+                now = int(datetime.datetime.now().timestamp())
+                if progress and length and last_info_time != now:
+                    last_info_time = now
+                    yield (100 * nbytes // length)
+                shatter = data.read(bufsize)
+
+    if length is not None and nbytes != length:
+        raise IOError(f'{url}: connection closed after {nbytes} of {length} bytes')
+    if sha256 and hasher.hexdigest() != sha256.lower():
+        _remove_part(partpath)
+        raise HashMismatch(f'{url}: expected sha256 {sha256}, got {hasher.hexdigest()}')
+    os.replace(partpath, dest)
+    os.remove(partpath + '.json')
+
+
+def _file_sha256(path: str, bufsize: int = DOWNLOAD_BUFSIZE) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(bufsize), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _probe(url: str) -> Tuple[Optional[int], Optional[str]]:
+    """Return (length, If-Range validator) of url if server accepts byte ranges"""
+    request = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(request) as response:
+        if response.headers.get('Accept-Ranges', '').strip().lower() != 'bytes':
+            return None, None
+        validator = _if_range({'etag': response.headers.get('ETag'),
+                               'last_modified': response.headers.get('Last-Modified')})
+        try:  # response.length is always 0 for HEAD
+            return int(response.headers['Content-Length']), validator
+        except (KeyError, TypeError, ValueError):
+            return None, None
+
+
+def _fetch_segment(url: str, path: str, start: int, end: int, validator: Optional[str],
+                   done: List[int], slot: int, stop: threading.Event, bufsize: int) -> None:
+    """Download bytes [start, end] of url into the same place of file at path"""
+    headers = {'Range': f'bytes={start}-{end}'}
+    if validator:
+        headers['If-Range'] = validator
+    with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as data:
+        if data.getcode() != 206 or _content_range(data.headers.get('Content-Range'))[0] != start:
+            raise _RangeNotSupported(url)
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0 and not stop.is_set():
+                shatter = data.read(min(bufsize, remaining))
+                if not shatter:
+                    raise IOError(f'{url}: connection closed in segment {start}-{end}')
+                remaining -= f.write(shatter)
+                done[slot] += len(shatter)
+
+
+def _download_segmented(url: str, dest: str, segments: int, progress: bool = False,
+                        sha256: Optional[str] = None,
+                        bufsize: int = DOWNLOAD_BUFSIZE) -> Iterator[int]:
+    """Download url to dest over several connections, each fetching a byte range.
+
+    Falls back to _download when the server does not support ranges or the
+    file is too small to split.
+    """
+    length, validator = _probe(url)
+    if not length or not validator or length < 2 * MIN_SEGMENT_SIZE:
+        yield from _download(url, dest, progress=progress, sha256=sha256, bufsize=bufsize)
+        return
+    segments = min(segments, length // MIN_SEGMENT_SIZE)
+    bounds = [length * i // segments for i in range(segments + 1)]
+
+    partpath = dest + '.segments'
+    with open(partpath, 'wb') as f:
+        f.truncate(length)
+    done = [0] * segments
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=segments)
+    try:
+        futures = [pool.submit(contextvars.copy_context().run, _fetch_segment, url, partpath,
+                               bounds[i], bounds[i + 1] - 1, validator, done, i, stop, bufsize)
+                   for i in range(segments)]
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout=1.0, return_when=FIRST_EXCEPTION)
+            for future in finished:
+                future.result()
+            if progress and pending:
+                yield 100 * sum(done) // length
+    except _RangeNotSupported:
+        stop.set()
+        pool.shutdown(wait=True)
+        os.remove(partpath)
+        yield from _download(url, dest, progress=progress, sha256=sha256, bufsize=bufsize)
+        return
+    except BaseException:
+        stop.set()
+        pool.shutdown(wait=True)
+        os.remove(partpath)
+        raise
+    pool.shutdown(wait=True)
+
+    if sha256:
+        digest = _file_sha256(partpath, bufsize)
+        if digest != sha256.lower():
+            os.remove(partpath)
+            raise HashMismatch(f'{url}: expected sha256 {sha256}, got {digest}')
+    os.replace(partpath, dest)
+
+
+@dataclass
+class Archive:
+    """Published archive of a package version and its place in the cache"""
+    name: str
+    version: str
+    url: str
+    sha256: str
+    path: str
+
+    def is_cached(self) -> bool:
+        """Return True if the cache holds this archive, complete and verified"""
+        if not self.sha256:
+            return False
+        try:
+            with open(self.path + '.json') as f:
+                meta: Dict[str, Any] = json.load(f)
+            if os.path.getsize(self.path) != meta['size']:
+                return False
+        except (OSError, ValueError, KeyError):
+            return False
+        return bool(meta.get('sha256') == self.sha256.lower())
+
+    def save_meta(self, rebuilt: bool = False) -> None:
+        """Record that path holds this archive, once it is downloaded and verified"""
+        if not self.sha256:
+            return  # nothing to verify the archive with next time
+        meta: Dict[str, Any] = {'sha256': self.sha256.lower(), 'size': os.path.getsize(self.path),
+                                'name': self.name, 'version': self.version, 'url': self.url}
+        if rebuilt:
+            meta['rebuilt'] = True
+        with open(self.path + '.json', 'w') as f:
+            json.dump(meta, f)
+
+
+def find_archive(pkgname: str, version: Optional[str] = None) -> Archive:
+    """Look up the archive download(pkgname, version=version) would fetch.
+
+    Archives are keyed by their sha256 when the repository publishes it, so
+    identical archives are downloaded only once.
+    """
+    found = index.lookup(pkgname, version)
+    if found is None:
+        raise PackageNotFoundError(f'package {pkgname} not found' if version is None
+                                   else f'package {pkgname} {version} not found')
+    _, version, url, sha256 = found
+    cache_dir = consts.paths().cache_dir
+    if sha256:
+        path = os.path.join(cache_dir, sha256.lower() + '.bap')
+    else:
+        path = os.path.join(cache_dir, f'{pkgname}-{version}.bap')
+    return Archive(name=pkgname, version=version, url=url, sha256=sha256, path=path)
+
+
+def cache_path(pkgname: str, version: Optional[str] = None) -> str:
+    """Return path download(pkgname, version=version) stores package archive at"""
+    return find_archive(pkgname, version).path
+
+
+def _download_delta(archive: Archive, base: str,
+                    progress: bool) -> Generator[int, None, Optional[str]]:
+    """Rebuild archive from delta against installed version base.
+
+    The rebuilt archive has the same files as the published one, verified
+    by the delta, but usually not the same bytes, so unless it hashes to
+    the published sha256 it is cached under its own hash. Returns its path,
+    or None if no delta is published or it can not be used.
+    """
+    found = index.delta(archive.name, base, archive.version)
+    if found is None or base == archive.version:
+        return None
+    url, sha256 = found
+    cache_dir = consts.ensure_dir(os.path.dirname(archive.path))
+    delta_path = os.path.join(cache_dir, f'{archive.name}-{base}-{archive.version}.bapdelta')
+    rebuilt_path = archive.path + '.rebuilt'
+    try:
+        yield from _download(url, delta_path, progress=progress, sha256=sha256 or None)
+        delta.apply(delta_path, rebuilt_path, consts.paths().root)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile, delta.DeltaError,
+            HashMismatch) as e:
+        print(f'warning: bap: delta for {archive.name} not used: {e!r}')
+        return None
+    finally:
+        if os.path.exists(delta_path):
+            os.remove(delta_path)
+    digest = _file_sha256(rebuilt_path)
+    rebuilt = archive
+    if digest != archive.sha256.lower():
+        rebuilt = replace(archive, sha256=digest,
+                          path=os.path.join(cache_dir, digest + '.bap'))
+    os.replace(rebuilt_path, rebuilt.path)
+    rebuilt.save_meta(rebuilt=rebuilt is not archive)
+    return rebuilt.path
+
+
+def download(pkgname: str, progress: bool = False, segments: int = 1,
+             version: Optional[str] = None) -> Generator[int, None, str]:
+    """Download package archive to cache, yielding percents if progress is set.
+
+    Skips the network entirely when the cache already holds an archive with
+    the published hash. With ``segments`` > 1 large archives are fetched over
+    that many parallel connections. When the repository publishes a delta
+    against the installed version, only the delta is downloaded and applied
+    to installed files, falling back to the full archive if that fails; the
+    rebuilt archive is returned then, cached under its own hash (see
+    _download_delta). Downloads the newest version available from any
+    repository unless ``version`` is given. Returns path of the archive.
+    """
+    archive = find_archive(pkgname, version)
+    if archive.is_cached():
+        return archive.path
+    installed = Database().query(pkgname)
+    if installed is not None:
+        rebuilt = yield from _download_delta(archive, installed.version.to_string(), progress)
+        if rebuilt is not None:
+            return rebuilt
+    consts.ensure_dir(os.path.dirname(archive.path))
+    if segments > 1:
+        yield from _download_segmented(archive.url, archive.path, segments,
+                                       progress=progress, sha256=archive.sha256)
+    else:
+        yield from _download(archive.url, archive.path, progress=progress,
+                             sha256=archive.sha256)
+    archive.save_meta()
+    return archive.path
@@ -0,0 +1,303 @@
+"""Merged index of packages available from all repositories.
+
+Built from the per-repository databases at sync time, so that lookups and
+listings are single indexed queries however many repositories are
+configured. Every version of every package is indexed with a sortable
+version key; when several are available, the newest wins, and of equal
+versions the one from the repository listed first in repolist.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import os
+import re
+import sqlite3
+import contextlib
+import threading
+
+from bap import consts
+from bap.db import connect
+from bap.pkginfo import Version, InvalidVersion
+from bap.repo.sync import get_repositories, Repository
+
+if TYPE_CHECKING:
+    from typing import Optional, List, Sequence, Tuple
+
+INDEX_NAME = '.index.db'
+
+_MIGRATIONS: List[Sequence[str]] = [
+    (
+        """CREATE TABLE repos(
+            name TEXT PRIMARY KEY,
+            priority INTEGER NOT NULL,
+            url_packages_root TEXT NOT NULL
+        );""",
+        """CREATE TABLE packages(
+            name TEXT PRIMARY KEY,
+            desc TEXT NOT NULL,
+            version TEXT NOT NULL,
+            repo TEXT NOT NULL,
+            url TEXT NOT NULL
+        );""",
+        'CREATE INDEX packages_repo_idx ON packages(repo);',
+        """CREATE TABLE state(
+            key TEXT PRIMARY KEY,
+            value
+        );""",
+    ),
+    (
+        "ALTER TABLE packages ADD COLUMN depends TEXT NOT NULL DEFAULT '';",
+    ),
+    (
+        "ALTER TABLE packages ADD COLUMN sha256 TEXT NOT NULL DEFAULT '';",
+    ),
+    (
+        """CREATE TABLE deltas(
+            repo TEXT NOT NULL,
+            name TEXT NOT NULL,
+            base TEXT NOT NULL,
+            version TEXT NOT NULL,
+            url TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            PRIMARY KEY (name, base, version, repo)
+        );""",
+    ),
+    (
+        # All available versions; ``packages`` holds the newest of each
+        """CREATE TABLE package_versions(
+            name TEXT NOT NULL,
+            version TEXT NOT NULL,
+            version_key TEXT NOT NULL,
+            desc TEXT NOT NULL,
+            depends TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            repo TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            PRIMARY KEY (name, version_key, priority)
+        );""",
+    ),
+]
+
+# Columns that databases of older repositories may lack. ``file`` is the
+# archive name under url_packages_root, '<name>.bap' if not given.
+_OPTIONAL_COLUMNS = ('depends', 'sha256', 'file')
+
+# Full-text index over name and description. Kept out of the migrations
+# because some sqlite builds (e.g. on Android) lack FTS5: search falls back
+# to LIKE there.
+_SQL_CREATE_FTS = """CREATE VIRTUAL TABLE IF NOT EXISTS packages_fts USING fts5(
+    name, desc, content='packages', content_rowid='rowid',
+    prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+);"""
+_SQL_SEARCH_FTS = (
+    'SELECT p.name, p.desc, p.version FROM packages_fts JOIN packages p'
+    ' ON p.rowid = packages_fts.rowid WHERE packages_fts MATCH ?'
+    ' ORDER BY bm25(packages_fts, 10.0, 1.0), p.name LIMIT ? OFFSET ?')
+_FTS_AVAILABLE = 'fts'
+
+_SQL_LOOKUP = 'SELECT repo, version, url, sha256 FROM packages WHERE name = ?'
+_SQL_DELTA = ('SELECT d.url, d.sha256 FROM deltas d JOIN repos r ON r.name = d.repo'
+              ' WHERE d.name = ? AND d.base = ? AND d.version = ? ORDER BY r.priority LIMIT 1')
+_SQL_ADD_VERSION = (
+    'INSERT OR IGNORE INTO package_versions (name, version, version_key, desc, depends,'
+    ' sha256, repo, priority, url) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+_SQL_SELECT_NEWEST = (
+    'INSERT INTO packages (name, desc, version, repo, url, depends, sha256)'
+    ' SELECT name, desc, version, repo, url, depends, sha256 FROM package_versions v'
+    ' WHERE v.rowid = (SELECT rowid FROM package_versions WHERE name = v.name'
+    ' ORDER BY version_key DESC, priority LIMIT 1)')
+_SQL_LOOKUP_VERSION = ('SELECT repo, version, url, sha256 FROM package_versions'
+                       ' WHERE name = ? AND version_key = ? ORDER BY priority LIMIT 1')
+_SQL_PACKAGE_VERSION = ('SELECT name, desc, version, depends FROM package_versions'
+                        ' WHERE name = ? AND version_key = ? ORDER BY priority LIMIT 1')
+_SQL_VERSIONS = ('SELECT version, repo FROM package_versions WHERE name = ?'
+                 ' ORDER BY version_key DESC, priority')
+_SQL_PACKAGE = 'SELECT name, desc, version, depends FROM packages WHERE name = ?'
+_SQL_LIST = 'SELECT name, desc, version FROM packages ORDER BY name'
+_SQL_LIST_PAGE = _SQL_LIST + ' LIMIT ? OFFSET ?'
+_SQL_GET_STATE = 'SELECT value FROM state WHERE key = ?'
+_SQL_SET_STATE = 'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)'
+
+_rebuild_lock = threading.Lock()
+
+
+def _connection() -> sqlite3.Connection:
+    return connect(os.path.join(consts.paths().repo_dir, INDEX_NAME), _MIGRATIONS)
+
+
+def _repolist_stamp() -> str:
+    """Identify current repolist contents without parsing it"""
+    try:
+        st = os.stat(os.path.join(consts.paths().repo_dir, 'repolist'))
+    except FileNotFoundError:
+        return ''
+    return f'{st.st_mtime_ns}:{st.st_size}'
+
+
+def _read_repo(repo: Repository) -> List[Tuple[str, str, str, str, str, str]]:
+    """Read (name, desc, version, *_OPTIONAL_COLUMNS) rows from repository database"""
+    dbpath = os.path.join(consts.paths().repo_dir, repo.name + '.db')
+    if not os.path.exists(dbpath):
+        return []
+    with contextlib.closing(sqlite3.connect(f'file:{dbpath}?mode=ro', uri=True)) as conn:
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(packages)')}
+        if not columns:
+            return []
+        optional = ', '.join(f"COALESCE({column}, '')" if column in columns else "''"
+                             for column in _OPTIONAL_COLUMNS)
+        rows: List[Tuple[str, str, str, str, str, str]] = conn.execute(
+            f'SELECT name, desc, version, {optional} FROM packages').fetchall()
+        return rows
+
+
+def _read_repo_deltas(repo: Repository) -> List[Tuple[str, str, str, str, str]]:
+    """Read (name, base, version, file, sha256) rows of delta packages from repository database"""
+    dbpath = os.path.join(consts.paths().repo_dir, repo.name + '.db')
+    if not os.path.exists(dbpath):
+        return []
+    with contextlib.closing(sqlite3.connect(f'file:{dbpath}?mode=ro', uri=True)) as conn:
+        try:
+            rows: List[Tuple[str, str, str, str, str]] = conn.execute(
+                'SELECT name, base, version, file, sha256 FROM deltas').fetchall()
+        except sqlite3.OperationalError:  # repository publishes no deltas
+            return []
+        return rows
+
+
+def rebuild(repos: Optional[List[Repository]] = None) -> None:
+    """Rebuild merged index from local repository databases"""
+    stamp = _repolist_stamp()
+    if repos is None:
+        repos = get_repositories()
+    conn = _connection()
+    with _rebuild_lock, conn:
+        conn.execute('DELETE FROM repos')
+        conn.execute('DELETE FROM packages')
+        conn.execute('DELETE FROM package_versions')
+        conn.execute('DELETE FROM deltas')
+        for priority, repo in enumerate(repos):
+            conn.execute('INSERT OR IGNORE INTO repos (name, priority, url_packages_root)'
+                         ' VALUES (?, ?, ?)', (repo.name, priority, repo.url_packages_root))
+            url_prefix = repo.url_packages_root.rstrip('/') + '/'
+            rows = []
+            for name, desc, version, depends, sha256, file in _read_repo(repo):
+                try:
+                    key = Version.from_string(version).key
+                except InvalidVersion:
+                    print(f'warning: bap: {repo.name}: {name} has invalid version {version!r}')
+                    continue
+                rows.append((name, version, key, desc, depends, sha256, repo.name, priority,
+                             url_prefix + (file or name + '.bap')))
+            conn.executemany(_SQL_ADD_VERSION, rows)
+            conn.executemany(
+                'INSERT OR IGNORE INTO deltas (repo, name, base, version, url, sha256)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                ((repo.name, name, base, version, url_prefix + file, sha256)
+                 for name, base, version, file, sha256 in _read_repo_deltas(repo)))
+        conn.execute(_SQL_SELECT_NEWEST)
+        conn.execute(_SQL_SET_STATE, ('repolist', stamp))
+        try:
+            conn.execute(_SQL_CREATE_FTS)
+            conn.execute("INSERT INTO packages_fts(packages_fts) VALUES ('rebuild')")
+            conn.execute(_SQL_SET_STATE, (_FTS_AVAILABLE, 1))
+        except sqlite3.OperationalError:
+            conn.execute(_SQL_SET_STATE, (_FTS_AVAILABLE, 0))
+
+
+def _ensure_fresh() -> sqlite3.Connection:
+    """Return index connection, rebuilding index if repolist was changed"""
+    conn = _connection()
+    row = conn.execute(_SQL_GET_STATE, ('repolist',)).fetchone()
+    if row is None or row[0] != _repolist_stamp():
+        rebuild()
+    return conn
+
+
+def lookup(name: str, version: Optional[str] = None) -> Optional[Tuple[str, str, str, str]]:
+    """Return (repository name, version, download url, sha256) of package.
+
+    Gives the newest version unless ``version`` is set. sha256 is an empty
+    string if the repository does not publish hashes.
+    """
+    conn = _ensure_fresh()
+    row: Optional[Tuple[str, str, str, str]]
+    if version is None:
+        row = conn.execute(_SQL_LOOKUP, (name,)).fetchone()
+    else:
+        row = conn.execute(_SQL_LOOKUP_VERSION,
+                           (name, Version.from_string(version).key)).fetchone()
+    return row
+
+
+def delta(name: str, base: str, version: str) -> Optional[Tuple[str, str]]:
+    """Return (download url, sha256) of delta package upgrading installed
+    version ``base`` of package to ``version``, if published"""
+    row: Optional[Tuple[str, str]] = _ensure_fresh().execute(
+        _SQL_DELTA, (name, base, version)).fetchone()
+    return row
+
+
+def package(name: str, version: Optional[str] = None) -> Optional[Tuple[str, str, str, str]]:
+    """Return (name, desc, version, depends) of the newest or given version of package"""
+    conn = _ensure_fresh()
+    row: Optional[Tuple[str, str, str, str]]
+    if version is None:
+        row = conn.execute(_SQL_PACKAGE, (name,)).fetchone()
+    else:
+        row = conn.execute(_SQL_PACKAGE_VERSION,
+                           (name, Version.from_string(version).key)).fetchone()
+    return row
+
+
+def versions(name: str) -> List[Tuple[str, str]]:
+    """Return (version, repository name) of every available version of package, newest first"""
+    rows: List[Tuple[str, str]] = _ensure_fresh().execute(_SQL_VERSIONS, (name,)).fetchall()
+    return rows
+
+
+def packages() -> List[Tuple[str, str, str]]:
+    """Return (name, desc, version) of every available package"""
+    rows: List[Tuple[str, str, str]] = _ensure_fresh().execute(_SQL_LIST).fetchall()
+    return rows
+
+
+def _like_pattern(term: str) -> str:
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def _search_like(conn: sqlite3.Connection, terms: List[str],
+                 limit: int, offset: int) -> List[Tuple[str, str, str]]:
+    """Fallback search for sqlite builds without FTS5"""
+    where = ' AND '.join("(name LIKE ? ESCAPE '\\' OR desc LIKE ? ESCAPE '\\')"
+                         for _ in terms)
+    params: List[object] = []
+    for term in terms:
+        params += ['%' + _like_pattern(term)] * 2
+    params += [_like_pattern(terms[0]), limit, offset]
+    rows: List[Tuple[str, str, str]] = conn.execute(
+        f'SELECT name, desc, version FROM packages WHERE {where}'
+        " ORDER BY name LIKE ? ESCAPE '\\' DESC, name LIMIT ? OFFSET ?", params).fetchall()
+    return rows
+
+
+def search(query: str, limit: int, offset: int = 0) -> List[Tuple[str, str, str]]:
+    """Return (name, desc, version) of packages matching every word of query.
+
+    Words match as prefixes of words in package name or description; best
+    matches (by bm25, name weighted over description) come first.
+    """
+    conn = _ensure_fresh()
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        rows: List[Tuple[str, str, str]] = conn.execute(
+            _SQL_LIST_PAGE, (limit, offset)).fetchall()
+        return rows
+    fts = conn.execute(_SQL_GET_STATE, (_FTS_AVAILABLE,)).fetchone()
+    if not fts or not fts[0]:
+        return _search_like(conn, terms, limit, offset)
+    match = ' '.join(f'"{term}"*' for term in terms)
+    rows = conn.execute(_SQL_SEARCH_FTS, (match, limit, offset)).fetchall()
+    return rows
@@ -0,0 +1,88 @@
+"""Tools for repository maintainers: fill repository database from packages"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import os
+import hashlib
+import sqlite3
+import zipfile
+import contextlib
+
+from bap import package, delta
+
+if TYPE_CHECKING:
+    from typing import Sequence
+
+HASH_BUFSIZE = 1024 * 1024
+
+_SQL_CREATE = """CREATE TABLE IF NOT EXISTS packages(
+    name varchar(20) NOT NULL,
+    desc varchar(100) NOT NULL,
+    version varchar(30) NOT NULL,
+    depends TEXT NOT NULL DEFAULT '',
+    sha256 TEXT NOT NULL DEFAULT '',
+    file TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (name, version)
+);"""
+_SQL_CREATE_DELTAS = """CREATE TABLE IF NOT EXISTS deltas(
+    name varchar(20) NOT NULL,
+    base varchar(30) NOT NULL,
+    version varchar(30) NOT NULL,
+    file TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (name, base, version)
+);"""
+
+
+def file_sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_BUFSIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def add_packages(dbpath: str, paths: Sequence[str], keep_versions: bool = False) -> None:
+    """Add or replace packages in repository database.
+
+    Package files must then be uploaded to ``url_packages_root`` under their
+    own file names. Other versions of the same packages are removed from
+    the database unless ``keep_versions`` is set.
+    """
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        with conn:
+            conn.execute(_SQL_CREATE)
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(packages)')}
+            if 'file' not in columns:  # database made before multiple versions
+                conn.execute("ALTER TABLE packages ADD COLUMN file TEXT NOT NULL DEFAULT ''")
+            for path in paths:
+                with zipfile.ZipFile(path, 'r') as zf:
+                    pkginfo, _ = package.read(zf)
+                if not keep_versions:
+                    conn.execute('DELETE FROM packages WHERE name = ?', (pkginfo.name,))
+                conn.execute(
+                    'INSERT OR REPLACE INTO packages (name, desc, version, depends, sha256, file)'
+                    ' VALUES (?, ?, ?, ?, ?, ?)',
+                    (pkginfo.name, pkginfo.desc, pkginfo.version.to_string(),
+                     ' '.join(pkginfo.depends), file_sha256(path), os.path.basename(path)))
+
+
+def add_deltas(dbpath: str, paths: Sequence[str]) -> None:
+    """Add or replace delta packages (see bap.gendelta) in repository database.
+
+    Delta files must then be uploaded to ``url_packages_root`` under their
+    own file names.
+    """
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        with conn:
+            conn.execute(_SQL_CREATE_DELTAS)
+            for path in paths:
+                with zipfile.ZipFile(path, 'r') as zf:
+                    manifest = delta.read_manifest(zf)
+                conn.execute(
+                    'INSERT OR REPLACE INTO deltas (name, base, version, file, sha256)'
+                    ' VALUES (?, ?, ?, ?, ?)',
+                    (manifest['name'], manifest['base'], manifest['version'],
+                     os.path.basename(path), file_sha256(path)))
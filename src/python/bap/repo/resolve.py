@@ -0,0 +1,187 @@
+"""Dependency resolution and installation from repositories"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import contextvars
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+from bap.db import Database
+from bap.pkginfo import Version, InvalidVersion
+from bap import pkgcontrol
+from bap.repo.search import get_package_info, PackageNotFoundError
+from bap.repo.download import download
+
+if TYPE_CHECKING:
+    from typing import Optional, List, Dict, Set, Sequence, Tuple, Callable
+    from concurrent.futures import Future
+    from bap.pkginfo import PkgInfo
+
+DOWNLOAD_WORKERS = 4
+
+
+class DependencyError(Exception):
+    pass
+
+
+class DependencyCycle(DependencyError):
+    pass
+
+
+class DependencyConflict(DependencyError):
+    pass
+
+
+@dataclass
+class PlannedInstall:
+    pkginfo: PkgInfo
+    upgrade: bool
+
+
+def parse_requirement(requirement: str) -> Tuple[str, Optional[str]]:
+    """Split 'name' or 'name=version' depends entry"""
+    name, _, version = requirement.partition('=')
+    return name.strip(), version.strip() or None
+
+
+def _parse_pin(requirement: str) -> Tuple[str, Optional[Version]]:
+    name, version = parse_requirement(requirement)
+    if version is None:
+        return name, None
+    try:
+        return name, Version.from_string(version)
+    except InvalidVersion as e:
+        raise DependencyError(f'{requirement}: {e}')
+
+
+class _Repin(Exception):
+    """Package was pinned after another version of it had been selected"""
+
+    def __init__(self, name: str, version: Version) -> None:
+        super().__init__(name, version)
+        self.name = name
+        self.version = version
+
+
+def resolve(requirements: Sequence[str]) -> List[PlannedInstall]:
+    """Make install plan for requested packages and their dependencies.
+
+    Requested packages are always (re)installed, dependencies only when
+    they are missing or a different version is pinned. The plan is ordered
+    so that every package comes after its dependencies. The newest version
+    of a package is selected unless some package pins it; when a pin is
+    found after another version was selected, resolution starts over with
+    the pinned version, so the plan does not depend on order of
+    requirements.
+    """
+    db = Database()
+    preferred: Dict[str, Version] = {}
+    tried: Set[Tuple[str, Version]] = set()
+    while True:
+        try:
+            return _resolve(db, requirements, preferred)
+        except _Repin as repin:
+            if (repin.name, repin.version) in tried:
+                raise DependencyConflict(
+                    f'{repin.name} {repin.version.to_string()} required, but packages '
+                    f'requiring it conflict with other requirements')
+            tried.add((repin.name, repin.version))
+            preferred[repin.name] = repin.version
+
+
+def _resolve(db: Database, requirements: Sequence[str],
+             preferred: Dict[str, Version]) -> List[PlannedInstall]:
+    """Make install plan selecting versions in preferred unless pinned otherwise"""
+    pins: Dict[str, Version] = {}
+    plan: List[PlannedInstall] = []
+    done: Dict[str, PlannedInstall] = {}
+    skipped: Set[str] = set()
+    visiting: List[str] = []
+
+    def visit(requirement: str, requested: bool) -> None:
+        name, version = _parse_pin(requirement)
+        if version is not None:
+            if pins.setdefault(name, version) != version:
+                raise DependencyConflict(f'{name} required as both '
+                                         f'{pins[name].to_string()} and {version.to_string()}')
+            if name in done and done[name].pkginfo.version != version:
+                raise _Repin(name, version)
+        if name in visiting:
+            cycle = visiting[visiting.index(name):] + [name]
+            raise DependencyCycle(' -> '.join(cycle))
+        if requested:
+            skipped.discard(name)  # reached before as installed dependency
+        if name in done or (name in skipped and version is None):
+            return
+        if version is None:
+            version = preferred.get(name)
+
+        installed = db.query(name)
+        if not requested and installed is not None and (
+                version is None or installed.version == version):
+            skipped.add(name)
+            return
+        try:
+            pkginfo = get_package_info(name, None if version is None else version.to_string())
+        except PackageNotFoundError:
+            if version is None:
+                raise
+            raise DependencyConflict(
+                f'{name} {version.to_string()} required, but it is not available')
+
+        visiting.append(name)
+        for dependency in pkginfo.depends:
+            visit(dependency, requested=False)
+        visiting.pop()
+        done[name] = PlannedInstall(pkginfo=pkginfo, upgrade=installed is not None)
+        plan.append(done[name])
+
+    for requirement in requirements:
+        visit(requirement, requested=True)
+    return plan
+
+
+def _fetch(name: str, version: str, progress: Optional[Callable[[str, int], None]],
+           segments: int) -> str:
+    """Download package, returning path of the archive"""
+    downloading = download(name, progress=progress is not None, segments=segments,
+                           version=version)
+    while True:
+        try:
+            percent = next(downloading)
+        except StopIteration as stop:
+            path: str = stop.value
+            return path
+        assert progress is not None
+        progress(name, percent)
+
+
+def install(requirements: Sequence[str],
+            progress: Optional[Callable[[str, int], None]] = None,
+            max_workers: int = DOWNLOAD_WORKERS,
+            segments: int = 1) -> List[PkgInfo]:
+    """Install packages with dependencies from repositories.
+
+    All archives of the plan are downloaded concurrently; each package is
+    installed as soon as it and everything before it in the plan is
+    downloaded. ``progress`` is called with package name and percent from
+    download threads. ``segments`` is passed to download().
+    """
+    plan = resolve(requirements)
+    installed: List[PkgInfo] = []
+    if not plan:
+        return installed
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(plan))) as pool:
+        futures: List[Future[str]] = [
+            pool.submit(contextvars.copy_context().run, _fetch, step.pkginfo.name,
+                        step.pkginfo.version.to_string(), progress, segments)
+            for step in plan]  # in copies of this context, for consts.using()
+        try:
+            for step, future in zip(plan, futures):
+                installed.append(pkgcontrol.install(future.result(), upgrade=step.upgrade))
+        finally:
+            for future in futures:
+                future.cancel()
+    return installed
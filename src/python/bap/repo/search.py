@@ -2,11 +2,8 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
-import os
-import sqlite3
-from bap.consts import REPO_DIR
 from bap.pkginfo import PkgInfo, Version
-from bap.repo.sync import get_repositories, Repository
+from bap.repo import index
 
 if TYPE_CHECKING:
     from typing import Optional, List
@@ -16,39 +13,62 @@ class PackageNotFoundError(Exception):
     pass
 
 
-# TODO: add multi-repository support
-# TODO: add version to file
-# TODO: move search to function
-def get_download_url(pkgname: str) -> str:
-    founds: List[Repository] = []
-    for repo in get_repositories():
-        conn = sqlite3.connect(os.path.join(REPO_DIR, repo.name + '.db'))
-        cur = conn.cursor()
-        res = cur.execute(
-            'SELECT name, desc, version FROM packages WHERE name = ?', (pkgname,)).fetchone()
-        if res:
-            founds.append(repo)
-    if not founds:
-        raise PackageNotFoundError(f'package {pkgname} not found')
-    return os.path.join(founds[0].url_packages_root, pkgname) + '.bap'
+def _not_found(pkgname: str, version: Optional[str]) -> PackageNotFoundError:
+    return PackageNotFoundError(
+        f'package {pkgname} not found' if version is None
+        else f'package {pkgname} {version} not found')
+
+
+def get_download_url(pkgname: str, version: Optional[str] = None) -> str:
+    found = index.lookup(pkgname, version)
+    if found is None:
+        raise _not_found(pkgname, version)
+    return found[2]
+
+
+def get_provider(pkgname: str, version: Optional[str] = None) -> str:
+    """Return name of repository package will be downloaded from"""
+    found = index.lookup(pkgname, version)
+    if found is None:
+        raise _not_found(pkgname, version)
+    return found[0]
+
+
+def get_package_info(pkgname: str, version: Optional[str] = None) -> PkgInfo:
+    """Return info of the newest or given version of package"""
+    found = index.package(pkgname, version)
+    if found is None:
+        raise _not_found(pkgname, version)
+    name, desc, version, depends = found
+    return PkgInfo(
+        name=name,
+        desc=desc,
+        version=Version.from_string(version),
+        depends=depends.split())
+
+
+def get_versions(pkgname: str) -> List[Version]:
+    """Return every version of package available from any repository, newest first"""
+    versions: List[Version] = []
+    for version, _ in index.versions(pkgname):
+        parsed = Version.from_string(version)
+        if not versions or versions[-1] != parsed:
+            versions.append(parsed)
+    return versions
+
 
 def get_available_packages() -> List[PkgInfo]:
-    packages: List[PkgInfo] = []
-    for repo in get_repositories():
-        try:
-            conn = sqlite3.connect(os.path.join(REPO_DIR, repo.name + '.db'))
-            cur = conn.cursor()
-            res = cur.execute(
-                'SELECT name, desc, version FROM packages').fetchall()
-            for name, desc, version in res:
-                packages.append(PkgInfo(
-                    name=name,
-                    desc=desc,
-                    version=Version.from_string(version)
-                ))  # TODO: add another info to database
-        except sqlite3.OperationalError as e:
-            if 'no such table' in str(e):
-                pass
-            else:
-                raise e
-    return packages
+    return [PkgInfo(
+        name=name,
+        desc=desc,
+        version=Version.from_string(version)
+    ) for name, desc, version in index.packages()]  # TODO: add another info to database
+
+
+def search(query: str, limit: int = 50, offset: int = 0) -> List[PkgInfo]:
+    """Search available packages by name and description, best matches first"""
+    return [PkgInfo(
+        name=name,
+        desc=desc,
+        version=Version.from_string(version)
+    ) for name, desc, version in index.search(query, limit, offset)]
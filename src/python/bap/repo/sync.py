@@ -3,15 +3,35 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 import os
+import json
+import shutil
+import sqlite3
+import tempfile
+import contextlib
+import contextvars
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from bap.consts import REPO_DIR
+from bap import consts
+from bap.repo import changelog
 
 if TYPE_CHECKING:
-    from typing import Optional, List
+    from typing import Optional, List, Dict, Any, Iterator, BinaryIO
+
+
+SYNC_WORKERS = 4
+SYNC_TIMEOUT = 30.0
+COPY_BUFSIZE = 256 * 1024
+
+# SyncResult.status values
+UPDATED = 'updated'
+NOT_MODIFIED = 'not modified'
+FAILED = 'failed'
 
 
 def check_for_repolist() -> None:
-    repolist_path = os.path.join(REPO_DIR, 'repolist')
+    repolist_path = os.path.join(consts.ensure_dir(consts.paths().repo_dir), 'repolist')
     if not os.path.exists(repolist_path):
         with open(repolist_path, 'w') as f:
             f.write('# bap repositories list\n')
@@ -30,7 +50,7 @@ class Repository:
 def get_repositories() -> List[Repository]:
     check_for_repolist()
     repositories: List[Repository] = []
-    with open(os.path.join(REPO_DIR, 'repolist')) as f:
+    with open(os.path.join(consts.paths().repo_dir, 'repolist')) as f:
         for line in f.read().splitlines():
             line = line.split('#', 1)[0].strip()
             if not line:
@@ -44,9 +64,172 @@ def get_repositories() -> List[Repository]:
     return repositories
 
 
+@dataclass
+class SyncResult:
+    repo: Repository
+    status: str
+    error: Optional[Exception] = None
+    incremental: bool = False
+
+
+def db_path(repo: Repository) -> str:
+    """Path of the local copy of repo database"""
+    return os.path.join(consts.paths().repo_dir, repo.name + '.db')
+
+
+def _meta_path(repo: Repository) -> str:
+    return os.path.join(consts.paths().repo_dir, repo.name + '.meta.json')
+
+
+def load_meta(repo: Repository) -> Dict[str, str]:
+    """Load HTTP validators saved by the last successful sync of repo"""
+    if not os.path.exists(db_path(repo)):
+        return {}
+    try:
+        with open(_meta_path(repo)) as f:
+            meta: Dict[str, str] = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if meta.get('url') != repo.url_repo_database:
+        return {}
+    return meta
+
+
+def save_meta(repo: Repository, meta: Dict[str, str]) -> None:
+    """Save HTTP validators of the local copy of repo database"""
+    with open(_meta_path(repo), 'w') as f:
+        json.dump(meta, f)
+
+
+def conditional_headers(meta: Dict[str, str], prefix: str = '') -> Dict[str, str]:
+    """Request headers revalidating the copy described by validators saved under prefix"""
+    headers = {}
+    if prefix + 'etag' in meta:
+        headers['If-None-Match'] = meta[prefix + 'etag']
+    if prefix + 'last_modified' in meta:
+        headers['If-Modified-Since'] = meta[prefix + 'last_modified']
+    return headers
+
+
+def _open(url: str, meta: Dict[str, str], prefix: str = '') -> Optional[Any]:
+    """Open url conditionally using validators saved under prefix in meta.
+
+    Returns None when the server answers 304 Not Modified.
+    """
+    request = urllib.request.Request(url, headers=conditional_headers(meta, prefix))
+    try:
+        return urllib.request.urlopen(request, timeout=SYNC_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            e.close()
+            return None
+        raise
+
+
+def _store_validators(response: Any, meta: Dict[str, str], prefix: str = '') -> None:
+    for key, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')):
+        meta.pop(prefix + key, None)
+        if response.headers.get(header):
+            meta[prefix + key] = response.headers[header]
+
+
+def _patch_repo(repo: Repository, meta: Dict[str, str]) -> Optional[SyncResult]:
+    """Try to bring local repo database up to date with published changelog.
+
+    Returns None when the full database must be downloaded instead.
+    """
+    try:
+        response = _open(changelog.changelog_url(repo.url_repo_database), meta, 'changes_')
+    except urllib.error.HTTPError as e:
+        e.close()
+        return None  # repository does not publish changelog
+    if response is None:
+        return SyncResult(repo=repo, status=NOT_MODIFIED)
+    with response:
+        return apply_changelog(repo, meta, response, response.read())
+
+
+def apply_changelog(repo: Repository, meta: Dict[str, str], response: Any,
+                     data: bytes) -> Optional[SyncResult]:
+    """Patch local repo database with changelog data received in response"""
+    try:
+        log = json.loads(data.decode('utf-8'))
+        changes = changelog.pending(log, changelog.get_seq(db_path(repo)))
+        if changes is None:
+            return None
+        if changes:
+            changelog.apply(db_path(repo), changes, log['seq'])
+    except (ValueError, KeyError, sqlite3.Error, changelog.ChangelogError):
+        return None
+    _store_validators(response, meta, 'changes_')
+    save_meta(repo, meta)
+    if not changes:
+        return SyncResult(repo=repo, status=NOT_MODIFIED)
+    return SyncResult(repo=repo, status=UPDATED, incremental=True)
+
+
+@contextlib.contextmanager
+def replace_database(repo: Repository, response: Any) -> Iterator[BinaryIO]:
+    """Write full database of repo received in response to the yielded file.
+
+    The local database is replaced, and validators of response saved, only
+    when the block completes.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=consts.ensure_dir(consts.paths().repo_dir),
+                                   prefix=repo.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(tmppath, db_path(repo))
+    except BaseException:
+        os.remove(tmppath)
+        raise
+    meta = {'url': repo.url_repo_database}
+    _store_validators(response, meta)
+    save_meta(repo, meta)
+
+
+def _download_repo(repo: Repository, meta: Dict[str, str]) -> SyncResult:
+    response = _open(repo.url_repo_database, meta)
+    if response is None:
+        return SyncResult(repo=repo, status=NOT_MODIFIED)
+    with response, replace_database(repo, response) as f:
+        shutil.copyfileobj(response, f, COPY_BUFSIZE)
+    return SyncResult(repo=repo, status=UPDATED)
+
+
+def _sync_repo(repo: Repository) -> SyncResult:
+    meta = load_meta(repo)
+    try:
+        if meta:
+            result = _patch_repo(repo, meta)
+            if result is not None:
+                return result
+        return _download_repo(repo, meta)
+    except Exception as e:  # pylint: disable=broad-except
+        if isinstance(e, urllib.error.HTTPError):
+            e.close()  # keep the error, not its connection
+        return SyncResult(repo=repo, status=FAILED, error=e)
+
+
+def sync(max_workers: int = SYNC_WORKERS) -> List[SyncResult]:
+    """Fetch all repository databases in parallel.
 
-def sync() -> None:
-    from bap.repo.download import _download as download_file
+    Returns one result per repository, in repolist order. Unchanged
+    repositories cost one conditional request answered with 304. Outdated
+    ones are patched from the published changelog when possible (see
+    bap.repo.changelog) and downloaded in full otherwise. The merged
+    package index (bap.repo.index) is rebuilt afterwards.
+    """
+    from bap.repo import index
     repos = get_repositories()
-    for repo in repos:
-        download_file(repo.url_repo_database, os.path.join(REPO_DIR, repo.name + '.db'))
+    results: List[SyncResult] = []
+    if repos:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(repos))) as pool:
+            # tasks run in copies of this context, so that root set by
+            # consts.using() applies to them too
+            futures = [pool.submit(contextvars.copy_context().run, _sync_repo, repo)
+                       for repo in repos]
+            results = [future.result() for future in futures]
+    index.rebuild(repos)
+    return results
@@ -3,11 +3,24 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import Optional
+    from typing import Optional, List, Tuple, Callable
 
 import ba
 import bap
 import threading
+from bapman.ui.loader import Loader
+
+ENTRY_HEIGHT = 35
+ICON_SIZE = 35
+# Seconds between checks for packages changed by other processes
+POLL_INTERVAL = 2.0
+
+
+def _load_snapshot():
+    """Return up to date snapshot of installed packages (on loader thread)"""
+    snapshot = bap.installed.snapshot()
+    snapshot.refresh()
+    return snapshot
 
 
 class InstalledBrowserWindow(ba.Window):
@@ -54,36 +67,49 @@ class InstalledBrowserWindow(ba.Window):
                 on_activate_call=self._back)
             ba.containerwidget(edit=self._root_widget, cancel_button=btn)
         
+        self._status_text = ba.textwidget(
+            parent=self._root_widget,
+            position=(self._width * 0.5, self._height * 0.5),
+            size=(0, 0),
+            color=(1, 1, 1),
+            h_align='center',
+            v_align='center',
+            text='',
+            maxwidth=210)
+
         self._scrollwidget: Optional[ba.Widget] = None
+        self._entries: List[bap.PkgInfo] = []
+        self._rows: List[Tuple[ba.Widget, ba.Widget, ba.Widget]] = []
+        self._loaded = False
+        self._loader = Loader()
+        self._poller = Loader()
+        self._unsubscribe: Optional[Callable[[], None]] = None
+        self._poll_timer: Optional[ba.Timer] = None
 
-        self._refresh()
-    
-    def _push_refresh(self):
-        ba.pushcall(self._refresh, from_other_thread=True)
-    
-    def _refresh(self):
-        if self._scrollwidget:
-            self._scrollwidget.delete()
-        if self._subcontainer:
-            self._subcontainer.delete()
+        ba.textwidget(edit=self._status_text, text='Loading...')
+        self._loader.load(_load_snapshot, ba.WeakCall(self._on_loaded))
+
+    def _push_changes(self, changes):
+        ba.pushcall(ba.WeakCall(self._on_changes, changes), from_other_thread=True)
+
+    def _poll(self):
+        """Pick up packages (un)installed by other processes"""
+        self._poller.load(lambda: bap.installed.snapshot().refresh(), lambda changed: None)
 
+    def _on_loaded(self, snapshot):
+        # subscribed here, on logic thread, so that _back() always sees it;
+        # changes made meanwhile are in packages() already
+        self._unsubscribe = snapshot.subscribe(ba.WeakCall(self._push_changes))
+        entries = snapshot.packages()
+        ba.textwidget(edit=self._status_text, text='')
         self._scrollwidget = ba.scrollwidget(
             parent=self._root_widget,
             position=((self._width - self._scroll_width) * 0.5,
                       self._height - self._scroll_height - 119),
             size=(self._scroll_width, self._scroll_height))
-        
-        db = bap.Database()
-        entries = tuple(db.installed())
-        entry_height = 35
-        icon_size = 35
-        
-        self._subcontainerheight = entry_height * len(entries)
-        v = self._subcontainerheight
-        
         self._subcontainer = ba.containerwidget(
             parent=self._scrollwidget,
-            size=(self._scroll_width, self._subcontainerheight),
+            size=(self._scroll_width, 0),
             background=False)
         
         ba.containerwidget(edit=self._scrollwidget,
@@ -95,53 +121,95 @@ class InstalledBrowserWindow(ba.Window):
                            selection_loops=False,
                            print_list_exit_instructions=False)
         ba.widget(edit=self._subcontainer, up_widget=self._back_button)
+        self._loaded = True
+        self._show(entries)
+        self._poll_timer = ba.Timer(POLL_INTERVAL, ba.WeakCall(self._poll), repeat=True,
+                                    timetype=ba.TimeType.REAL)
 
-        for num, entry in enumerate(entries):
-            cnt = ba.containerwidget(
-                parent=self._subcontainer,
-                position=(0, v - entry_height),
-                size=(self._scroll_width, entry_height),
-                root_selectable=True,
-                background=False,
-                click_activate=True,
-                on_activate_call=ba.Call(self._on_entry_activated, entry))
-            if num == 0:
-                ba.widget(edit=cnt, up_widget=self._back_button)
-            ba.imagewidget(parent=cnt,
-                           size=(icon_size, icon_size),
-                           position=(10, 0.5 * entry_height -
-                                     icon_size * 0.5),
-                           opacity=1.0,
-                           draw_controller=cnt,
-                           texture=ba.gettexture('file'),
-                           color=(0.1, 0.9, 0.1))
-            ba.textwidget(parent=cnt,
-                          draw_controller=cnt,
-                          text=entry.name,
-                          h_align='left',
-                          v_align='center',
-                          position=(10 + icon_size * 1.05,
-                                    entry_height * 0.5),
-                          size=(0, 0),
-                          maxwidth=self._scroll_width * 0.93 - 50,
-                          color=(1, 1, 1, 1))
-            ba.textwidget(parent=cnt,
-                          draw_controller=cnt,
-                          text=entry.version.to_string(),
-                          h_align='left',
-                          v_align='center',
-                          position=(self._scroll_width * 0.93 - 50, entry_height * 0.5),
-                          size=(0, 0),
-                          maxwidth=self._scroll_width * 0.93 - 50,
-                          color=(1, 1, 1, 1))
-            v -= entry_height
-    
-    def _on_entry_activated(self, pkginfo):
-        ShowPkgInfoWindow(pkginfo, parent=self)
+    def _on_changes(self, changes):
+        """Patch the list with changes of installed packages"""
+        if not self._loaded:  # whole list is still to come
+            return
+        entries = {entry.name: entry for entry in self._entries}
+        for name in changes.removed:
+            entries.pop(name, None)
+        for entry in changes.added + changes.changed:
+            entries[entry.name] = entry
+        self._show([entries[name] for name in sorted(entries)])
+
+    def _make_row(self, num):
+        cnt = ba.containerwidget(
+            parent=self._subcontainer,
+            size=(self._scroll_width, ENTRY_HEIGHT),
+            root_selectable=True,
+            background=False,
+            click_activate=True,
+            on_activate_call=ba.Call(self._on_row_activated, num))
+        if num == 0:
+            ba.widget(edit=cnt, up_widget=self._back_button)
+        ba.imagewidget(parent=cnt,
+                       size=(ICON_SIZE, ICON_SIZE),
+                       position=(10, 0.5 * ENTRY_HEIGHT -
+                                 ICON_SIZE * 0.5),
+                       opacity=1.0,
+                       draw_controller=cnt,
+                       texture=ba.gettexture('file'),
+                       color=(0.1, 0.9, 0.1))
+        name = ba.textwidget(parent=cnt,
+                             draw_controller=cnt,
+                             text='',
+                             h_align='left',
+                             v_align='center',
+                             position=(10 + ICON_SIZE * 1.05,
+                                       ENTRY_HEIGHT * 0.5),
+                             size=(0, 0),
+                             maxwidth=self._scroll_width * 0.93 - 50,
+                             color=(1, 1, 1, 1))
+        version = ba.textwidget(parent=cnt,
+                                draw_controller=cnt,
+                                text='',
+                                h_align='left',
+                                v_align='center',
+                                position=(self._scroll_width * 0.93 - 50, ENTRY_HEIGHT * 0.5),
+                                size=(0, 0),
+                                maxwidth=self._scroll_width * 0.93 - 50,
+                                color=(1, 1, 1, 1))
+        return cnt, name, version
+
+    def _show(self, entries):
+        """Show entries, editing only rows whose package changed"""
+        old = self._entries
+        self._entries = entries
+        resized = len(entries) != len(self._rows)
+        while len(self._rows) < len(entries):
+            self._rows.append(self._make_row(len(self._rows)))
+        while len(self._rows) > len(entries):
+            self._rows.pop()[0].delete()
+        if resized:
+            self._subcontainerheight = ENTRY_HEIGHT * len(entries)
+            ba.containerwidget(edit=self._subcontainer,
+                               size=(self._scroll_width, self._subcontainerheight))
+            for num, (cnt, _, _) in enumerate(self._rows):
+                ba.containerwidget(edit=cnt, position=(
+                    0, self._subcontainerheight - ENTRY_HEIGHT * (num + 1)))
+        for num, (entry, (_, name, version)) in enumerate(zip(entries, self._rows)):
+            if num < len(old) and old[num] is entry:
+                continue
+            ba.textwidget(edit=name, text=entry.name)
+            ba.textwidget(edit=version, text=entry.version.to_string())
+
+    def _on_row_activated(self, num):
+        if num < len(self._entries):
+            ShowPkgInfoWindow(self._entries[num], parent=self)
     
     def _back(self):
         from bapman.ui.menu import MenuWindow
         # self._save_state()  # FIXME
+        self._loader.cancel()
+        self._poller.cancel()
+        self._poll_timer = None
+        if self._unsubscribe is not None:
+            self._unsubscribe()
         ba.containerwidget(edit=self._root_widget,
                            transition='out_right')
         ba.app.main_menu_window = (MenuWindow(
@@ -245,8 +313,6 @@ class ShowPkgInfoWindow(ba.Window):
             else:
                 ba.pushcall(ba.Call(ba.screenmessage, 'Done', color=(0, 1, 0)),
                             from_other_thread=True)
-                if self._parent:
-                    self._parent._push_refresh()
         threading.Thread(target=_uninstall_target).start()
         self._back()
     
@@ -0,0 +1,74 @@
+"""Running bap queries off the game logic thread"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import ba
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Optional
+    from concurrent.futures import Future
+
+# One worker for all windows: queries are short, and its sqlite connections
+# (which bap keeps per thread) are reused between loads
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bapman-loader')
+        return _executor
+
+
+class Loader:
+    """Runs one query at a time for a window.
+
+    Starting a new load or calling cancel() makes the result of the previous
+    one be dropped, so a window never sees stale data or gets called after
+    it is closed.
+    """
+
+    def __init__(self) -> None:
+        self._generation = 0
+        self._future: Optional[Future[None]] = None
+
+    def load(self, query: Callable[[], Any], callback: Callable[[Any], None]) -> None:
+        """Run query on worker thread, then callback(result) on logic thread"""
+        self.cancel()
+        generation = self._generation
+
+        def _target() -> None:
+            if generation != self._generation:
+                return
+            try:
+                result = query()
+            except Exception as e:  # pylint: disable=broad-except
+                ba.pushcall(ba.Call(self._fail, generation, e), from_other_thread=True)
+            else:
+                ba.pushcall(ba.Call(self._deliver, generation, callback, result),
+                            from_other_thread=True)
+
+        self._future = _get_executor().submit(contextvars.copy_context().run, _target)
+
+    def cancel(self) -> None:
+        self._generation += 1
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+
+    def _deliver(self, generation: int, callback: Callable[[Any], None], result: Any) -> None:
+        if generation == self._generation:
+            self._future = None
+            callback(result)
+
+    def _fail(self, generation: int, error: Exception) -> None:
+        if generation == self._generation:
+            self._future = None
+            ba.screenmessage(f'Error: {error}', color=(1, 0, 0))
@@ -228,9 +228,9 @@ class MenuWindow(ba.Window):
             valid_file_extensions=['bap'])
     
     def _do_browse_repos(self):
-        from bap.consts import REPO_DIR
+        from bap import consts
         ba.screenmessage('Coming soon...')
-        ba.screenmessage(f'repolist file in {REPO_DIR}')
+        ba.screenmessage(f'repolist file in {consts.paths().repo_dir}')
     
     def _do_back(self):
         from bastd.ui import mainmenu
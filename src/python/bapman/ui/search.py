@@ -3,11 +3,17 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import Optional
+    from typing import Optional, List, Tuple
 
 import ba
 import bap
 import threading
+from bapman.ui.loader import Loader
+
+# Packages read from the index and shown at once
+PAGE_SIZE = 20
+ENTRY_HEIGHT = 35
+ICON_SIZE = 35
 
 
 class SearchWindow(ba.Window):
@@ -62,51 +68,80 @@ class SearchWindow(ba.Window):
             label="Sync",
             on_activate_call=self._sync)
         
+        self._prev_button = ba.buttonwidget(
+            parent=self._root_widget,
+            position=(40 + x_inset, 10),
+            size=(100, 40),
+            scale=0.8,
+            text_scale=0.8,
+            label='Prev',
+            on_activate_call=self._prev_page)
+        self._next_button = ba.buttonwidget(
+            parent=self._root_widget,
+            position=(self._width - x_inset - 120, 10),
+            size=(100, 40),
+            scale=0.8,
+            text_scale=0.8,
+            label='Next',
+            on_activate_call=self._next_page)
+        self._page_text = ba.textwidget(
+            parent=self._root_widget,
+            position=(self._width * 0.5, 30),
+            size=(0, 0),
+            color=(1, 1, 1),
+            h_align='center',
+            v_align='center',
+            text='',
+            maxwidth=150)
+
         self._scrollwidget: Optional[ba.Widget] = None
+        self._page = 0
+        self._has_next = False
+        self._entries: List[bap.PkgInfo] = []
+        self._rows: List[Tuple[ba.Widget, ba.Widget, ba.Widget, ba.Widget]] = []
+        self._loader = Loader()
 
         self._refresh()
     
     def _sync_target(self):
+        from bap.repo.sync import FAILED
         try:
-            bap.repo.sync()
+            results = bap.repo.sync()
         except Exception as e:
             ba.pushcall(ba.Call(ba.screenmessage, f"Error: {e}", color=(1, 0, 0)),
                         from_other_thread=True)
-        else:
-            ba.pushcall(ba.Call(ba.screenmessage, "Done", color=(0, 1, 0)),
-                        from_other_thread=True)
-            ba.pushcall(self._refresh,
-                        from_other_thread=True)
+            return
+        for result in results:
+            if result.status == FAILED:
+                ba.pushcall(ba.Call(ba.screenmessage,
+                                    f"{result.repo.name}: error: {result.error}",
+                                    color=(1, 0, 0)),
+                            from_other_thread=True)
+        ba.pushcall(ba.Call(ba.screenmessage, "Done", color=(0, 1, 0)),
+                    from_other_thread=True)
+        ba.pushcall(self._refresh,
+                    from_other_thread=True)
     
     def _sync(self):
         ba.screenmessage('Syncing...')
         threading.Thread(target=self._sync_target).start()
     
     def _refresh(self):
-        if self._scrollwidget:
-            self._scrollwidget.delete()
-        
-        if self._subcontainer:
-            self._subcontainer.delete()
+        self._show_page(self._page)
 
+    def _make_list(self):
         self._scrollwidget = ba.scrollwidget(
             parent=self._root_widget,
             position=((self._width - self._scroll_width) * 0.5,
                       self._height - self._scroll_height - 119),
-            size=(self._scroll_width, self._scroll_height))
-        
-        entries = bap.repo.get_available_packages()
-        entry_height = 35
-        icon_size = 35
-        
-        self._subcontainerheight = entry_height * len(entries)
-        v = self._subcontainerheight
-        
+            size=(self._scroll_width, self._scroll_height),
+            simple_culling_v=ENTRY_HEIGHT)
+        self._subcontainerheight = ENTRY_HEIGHT * PAGE_SIZE
         self._subcontainer = ba.containerwidget(
             parent=self._scrollwidget,
             size=(self._scroll_width, self._subcontainerheight),
             background=False)
-        
+
         ba.containerwidget(edit=self._scrollwidget,
                            claims_left_right=False,
                            claims_tab=False)
@@ -117,52 +152,103 @@ class SearchWindow(ba.Window):
                            print_list_exit_instructions=False)
         ba.widget(edit=self._subcontainer, up_widget=self._back_button)
 
-        for num, entry in enumerate(entries):
-            cnt = ba.containerwidget(
-                parent=self._subcontainer,
-                position=(0, v - entry_height),
-                size=(self._scroll_width, entry_height),
-                root_selectable=True,
-                background=False,
-                click_activate=True,
-                on_activate_call=ba.Call(self._on_entry_activated, entry))
-            if num == 0:
-                ba.widget(edit=cnt, up_widget=self._back_button)
-            ba.imagewidget(parent=cnt,
-                           size=(icon_size, icon_size),
-                           position=(10, 0.5 * entry_height -
-                                     icon_size * 0.5),
-                           opacity=1.0,
-                           draw_controller=cnt,
-                           texture=ba.gettexture('file'),
-                           color=(0.1, 0.9, 0.1))
-            ba.textwidget(parent=cnt,
-                          draw_controller=cnt,
-                          text=entry.name,
-                          h_align='left',
-                          v_align='center',
-                          position=(10 + icon_size * 1.05,
-                                    entry_height * 0.5),
-                          size=(0, 0),
-                          maxwidth=self._scroll_width * 0.93 - 50,
-                          color=(1, 1, 1, 1))
-            ba.textwidget(parent=cnt,
-                          draw_controller=cnt,
-                          text=entry.version.to_string(),
-                          h_align='left',
-                          v_align='center',
-                          position=(self._scroll_width * 0.93 - 50, entry_height * 0.5),
-                          size=(0, 0),
-                          maxwidth=self._scroll_width * 0.93 - 50,
-                          color=(1, 1, 1, 1))
-            v -= entry_height
-    
+    def _make_row(self, num):
+        """Create widgets of row num of the page; they are reused for every page"""
+        cnt = ba.containerwidget(
+            parent=self._subcontainer,
+            position=(0, self._subcontainerheight - ENTRY_HEIGHT * (num + 1)),
+            size=(self._scroll_width, ENTRY_HEIGHT),
+            root_selectable=True,
+            background=False,
+            click_activate=True,
+            on_activate_call=ba.Call(self._on_row_activated, num))
+        if num == 0:
+            ba.widget(edit=cnt, up_widget=self._back_button)
+        icon = ba.imagewidget(parent=cnt,
+                              size=(ICON_SIZE, ICON_SIZE),
+                              position=(10, 0.5 * ENTRY_HEIGHT -
+                                        ICON_SIZE * 0.5),
+                              opacity=1.0,
+                              draw_controller=cnt,
+                              texture=ba.gettexture('file'),
+                              color=(0.1, 0.9, 0.1))
+        name = ba.textwidget(parent=cnt,
+                             draw_controller=cnt,
+                             text='',
+                             h_align='left',
+                             v_align='center',
+                             position=(10 + ICON_SIZE * 1.05,
+                                       ENTRY_HEIGHT * 0.5),
+                             size=(0, 0),
+                             maxwidth=self._scroll_width * 0.93 - 50,
+                             color=(1, 1, 1, 1))
+        version = ba.textwidget(parent=cnt,
+                                draw_controller=cnt,
+                                text='',
+                                h_align='left',
+                                v_align='center',
+                                position=(self._scroll_width * 0.93 - 50, ENTRY_HEIGHT * 0.5),
+                                size=(0, 0),
+                                maxwidth=self._scroll_width * 0.93 - 50,
+                                color=(1, 1, 1, 1))
+        return cnt, icon, name, version
+
+    def _show_page(self, page):
+        """Show page of available packages.
+
+        Only one page is read from the package index, on the loader thread;
+        row widgets are created once (up to PAGE_SIZE) and edited to show the
+        rows of the next page.
+        """
+        ba.textwidget(edit=self._page_text, text='Loading...')
+        self._loader.load(lambda: bap.repo.search('', PAGE_SIZE + 1, page * PAGE_SIZE),
+                          ba.WeakCall(self._on_page_loaded, page))
+
+    def _on_page_loaded(self, page, entries):
+        if not entries and page > 0:  # index shrank after sync
+            self._show_page(page - 1)
+            return
+        self._page = page
+        self._has_next = len(entries) > PAGE_SIZE
+        self._entries = entries[:PAGE_SIZE]
+
+        if self._subcontainer is None:
+            self._make_list()
+        while len(self._rows) < len(self._entries):
+            self._rows.append(self._make_row(len(self._rows)))
+        for num, (_, icon, name, version) in enumerate(self._rows):
+            if num < len(self._entries):
+                entry = self._entries[num]
+                ba.imagewidget(edit=icon, opacity=1.0)
+                ba.textwidget(edit=name, text=entry.name)
+                ba.textwidget(edit=version, text=entry.version.to_string())
+            else:
+                ba.imagewidget(edit=icon, opacity=0.0)
+                ba.textwidget(edit=name, text='')
+                ba.textwidget(edit=version, text='')
+        if self._rows:
+            ba.containerwidget(edit=self._subcontainer, visible_child=self._rows[0][0])
+        ba.textwidget(edit=self._page_text, text=f'Page {page + 1}')
+
+    def _prev_page(self):
+        if self._page > 0:
+            self._show_page(self._page - 1)
+
+    def _next_page(self):
+        if self._has_next:
+            self._show_page(self._page + 1)
+
+    def _on_row_activated(self, num):
+        if num < len(self._entries):
+            self._on_entry_activated(self._entries[num])
+
     def _on_entry_activated(self, pkginfo):
         ShowPkgInfoWindow(pkginfo)
     
     def _back(self):
         from bapman.ui.menu import MenuWindow
         # self._save_state()  # FIXME
+        self._loader.cancel()
         ba.containerwidget(edit=self._root_widget,
                            transition='out_right')
         ba.app.main_menu_window = (MenuWindow(
@@ -200,9 +286,6 @@ class ShowPkgInfoWindow(ba.Window):
                 on_activate_call=self._back)
             ba.containerwidget(edit=self._root_widget, cancel_button=btn)
         
-        db = bap.Database()
-        existing = db.query(self.pkginfo.name)
-
         self._install_button = btn = ba.buttonwidget(
             parent=self._root_widget,
             autoselect=False,
@@ -211,10 +294,11 @@ class ShowPkgInfoWindow(ba.Window):
             color=(0.2, 1.0, 0.2),
             scale=0.8,
             text_scale=0.8,
-            label="Install" if existing is None else "Reinstall"
-                            if existing.version.to_string() == self.pkginfo.version.to_string()
-                            else "Upgrade",
-            on_activate_call=self._on_install if existing is None else self._on_upgrade)
+            label="...")
+        self._loader = Loader()
+        name = pkginfo.name  # the query must not keep the window alive
+        self._loader.load(lambda: bap.installed.snapshot().get(name),
+                          ba.WeakCall(self._on_installed_loaded))
         
         # ba.imagewidget(
         #     parent=self._root_widget,
@@ -258,24 +342,31 @@ class ShowPkgInfoWindow(ba.Window):
             text=prepare(pkginfo.desc),
             maxwidth=210)
     
-    def _install(self, upgrade: bool = False):
+    def _on_installed_loaded(self, existing):
+        ba.buttonwidget(
+            edit=self._install_button,
+            label="Install" if existing is None else "Reinstall"
+                            if existing.version == self.pkginfo.version
+                            else "Upgrade",
+            on_activate_call=self._on_install if existing is None else self._on_upgrade)
+
+    def _install(self):
         ba.screenmessage('Downloading (0%)...')
+        def _progress(name, percent):
+            ba.pushcall(ba.Call(ba.screenmessage, f'Downloading {name} ({percent}%)...'),
+                        from_other_thread=True)
         def _install_target():
-            from bap.consts import CACHE_DIR
-            import os
             try:
-                for p in bap.repo.download(self.pkginfo.name, progress=True):
-                    ba.pushcall(ba.Call(ba.screenmessage, f'Downloading ({p}%)...'),
-                                from_other_thread=True)
-                ba.pushcall(ba.Call(ba.screenmessage, 'Installing...', color=(1, 1, 1)),
-                            from_other_thread=True)
-                bap.install(os.path.join(CACHE_DIR, self.pkginfo.name + '.bap'),
-                            upgrade=upgrade)
+                installed = bap.repo.install([self.pkginfo.name], progress=_progress,
+                                             segments=4)
             except Exception as e:
                 ba.print_exception()
                 ba.pushcall(ba.Call(ba.screenmessage, f'Error: {e}', color=(1, 0, 0)),
                             from_other_thread=True)
             else:
+                for pkginfo in installed:
+                    ba.pushcall(ba.Call(ba.screenmessage, f'{pkginfo.to_string()} installed'),
+                                from_other_thread=True)
                 ba.pushcall(ba.Call(ba.screenmessage, 'Done', color=(0, 1, 0)), from_other_thread=True)
         threading.Thread(target=_install_target).start()
         self._back()
@@ -288,8 +379,9 @@ class ShowPkgInfoWindow(ba.Window):
     def _on_upgrade(self):
         from bastd.ui.confirm import ConfirmWindow
         ConfirmWindow(text=f'Upgrade {self.pkginfo.to_string()}?',
-                      action=ba.WeakCall(self._install, upgrade=True))
+                      action=ba.WeakCall(self._install))
     
     def _back(self):
+        self._loader.cancel()
         ba.containerwidget(edit=self._root_widget,
                            transition='out_right')
@@ -0,0 +1,15 @@
+"""Tests of bap and bapman, run from the repository root with
+
+    python -m unittest discover -s tests -t .
+
+(or ``./configure.py test``). Nothing is written outside of temporary
+directories.
+"""
+
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       'src', 'python')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
@@ -0,0 +1,161 @@
+"""Stand-in for the game's ba module, enough to drive bapman windows.
+
+Widgets are plain objects that remember their settings; ``created``
+counts widgets made of every kind and ``widgets`` lists them. Closing a
+window (an ``out_*`` transition) deletes its widgets right away. Calls pushed from other threads are
+queued until process_calls() runs them, as the game does on its logic
+thread.
+"""
+
+import queue
+import weakref
+import collections
+from typing import Any, Callable, Dict, List
+
+created: Dict[str, int] = collections.Counter()
+widgets: List['Widget'] = []
+messages: List[str] = []
+_calls: 'queue.Queue[Callable[[], Any]]' = queue.Queue()
+
+
+class Widget:
+    def __init__(self, kind: str, settings: Dict[str, Any]) -> None:
+        self.kind = kind
+        self.settings = settings
+        self._alive = True
+
+    def delete(self) -> None:
+        """Delete widget and its children, dropping their calls"""
+        for child in widgets:
+            if child.settings.get('parent') is self:
+                child.delete()
+        self._alive = False
+        self.settings.clear()
+
+    def exists(self) -> bool:
+        return self._alive
+
+    def __bool__(self) -> bool:
+        return self._alive
+
+
+def _widget_function(kind: str) -> Callable[..., Any]:
+    def function(edit: Any = None, **settings: Any) -> Any:
+        if edit is not None:
+            edit.settings.update(settings)
+            if str(settings.get('transition', '')).startswith('out'):
+                edit.delete()  # as the game does when the transition ends
+            return None
+        created[kind] += 1
+        widgets.append(Widget(kind, settings))
+        return widgets[-1]
+    function.__name__ = kind + 'widget'
+    return function
+
+
+containerwidget = _widget_function('container')
+scrollwidget = _widget_function('scroll')
+textwidget = _widget_function('text')
+imagewidget = _widget_function('image')
+buttonwidget = _widget_function('button')
+
+
+def widget(edit: Any = None, **settings: Any) -> None:
+    edit.settings.update(settings)
+
+
+def gettexture(name: str) -> str:
+    return name
+
+
+class Lstr:
+    def __init__(self, **kwargs: Any) -> None:
+        self.kwargs = kwargs
+
+
+class _App:
+    small_ui = False
+    med_ui = False
+    toolbars = False
+    title_color = (1, 1, 1)
+    main_menu_window = None
+
+
+app = _App()
+
+
+class Window:
+    def __init__(self, root_widget: Widget) -> None:
+        self._root_widget = root_widget
+
+    def get_root_widget(self) -> Widget:
+        return self._root_widget
+
+
+class Call:
+    def __init__(self, function: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+
+    def __call__(self, *args: Any) -> Any:
+        return self._function(*self._args, *args, **self._kwargs)
+
+
+class WeakCall(Call):
+    """Call that does nothing once the object of a bound method is gone"""
+
+    def __init__(self, function: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        super().__init__(function, *args, **kwargs)
+        if hasattr(function, '__self__'):
+            method = weakref.WeakMethod(function)  # type: ignore
+            self._function = lambda *args, **kwargs: (
+                method()(*args, **kwargs) if method() is not None else None)
+
+
+class TimeType:
+    SIM = 'sim'
+    REAL = 'real'
+
+
+class Timer:
+    def __init__(self, time: float, call: Callable[[], Any], repeat: bool = False,
+                 timetype: str = TimeType.SIM) -> None:
+        self.call = call
+
+
+class TeamGameActivity:
+    pass
+
+
+def pushcall(call: Callable[[], Any], from_other_thread: bool = False) -> None:
+    _calls.put(call)
+
+
+def process_calls(timeout: float = 10.0) -> None:
+    """Wait for a pushed call, then run it and all others pushed meanwhile"""
+    call = _calls.get(timeout=timeout)
+    while True:
+        call()
+        try:
+            call = _calls.get_nowait()
+        except queue.Empty:
+            return
+
+
+def screenmessage(message: Any, color: Any = None) -> None:
+    messages.append(str(message))
+
+
+def print_exception() -> None:
+    import traceback
+    traceback.print_exc()
+
+
+def reset() -> None:
+    """Forget created widgets, messages and pushed calls"""
+    created.clear()
+    widgets.clear()
+    messages.clear()
+    while not _calls.empty():
+        _calls.get_nowait()
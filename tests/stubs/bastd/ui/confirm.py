@@ -0,0 +1,7 @@
+from typing import Any
+
+
+class ConfirmWindow:
+    def __init__(self, text: Any = None, action: Any = None, **kwargs: Any) -> None:
+        self.text = text
+        self.action = action
@@ -0,0 +1,6 @@
+from typing import Any
+
+
+class MainMenuWindow:
+    def _refresh_not_in_game(self, positions: Any) -> None:
+        pass
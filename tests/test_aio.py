@@ -0,0 +1,151 @@
+import os
+import shutil
+import asyncio
+import hashlib
+import unittest
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from bap import consts
+from bap.repo import aio, repodb
+from bap.repo.download import HashMismatch
+from bap.repo.sync import UPDATED, NOT_MODIFIED
+
+from tests.util import RootTestCase, make_package
+
+
+class _StandIn:
+    """Minimal HTTP server for a directory, running on the current event loop.
+
+    Answers If-None-Match with 304, sends bodies with Content-Length or, when
+    chunked is set, in chunks, and counts requests and concurrent connections.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.requests: List[Tuple[str, Dict[str, str]]] = []
+        self.active = 0
+        self.peak = 0
+        self.delay = 0.0
+        self.chunked = False
+        self._server: Any = None
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return f'http://127.0.0.1:{self._server.sockets[0].getsockname()[1]}'
+
+    async def close(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            lines = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+            path = lines[0].split()[1]
+            headers = {name.strip().lower(): value.strip()
+                       for name, _, value in (line.partition(':') for line in lines[1:] if line)}
+            self.requests.append((path, headers))
+            await asyncio.sleep(self.delay)
+            filepath = os.path.join(self.directory, path.lstrip('/'))
+            if not os.path.isfile(filepath):
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                return
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            etag = '"' + hashlib.sha256(data).hexdigest() + '"'
+            if headers.get('if-none-match') == etag:
+                writer.write(b'HTTP/1.1 304 Not Modified\r\n\r\n')
+                return
+            if self.chunked:
+                writer.write(f'HTTP/1.1 200 OK\r\nETag: {etag}\r\n'
+                             'Transfer-Encoding: chunked\r\n\r\n'.encode('latin-1'))
+                for start in range(0, len(data), 4096):
+                    chunk = data[start:start + 4096]
+                    writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                writer.write(b'0\r\n\r\n')
+            else:
+                writer.write(f'HTTP/1.1 200 OK\r\nETag: {etag}\r\n'
+                             f'Content-Length: {len(data)}\r\n\r\n'.encode('latin-1') + data)
+            await writer.drain()
+        finally:
+            self.active -= 1
+            writer.close()
+
+
+class AioTest(RootTestCase):
+    """bap.repo.aio against a stand-in server on the same event loop"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.other = os.path.join(self.tmpdir, 'other')
+        self.repodir = os.path.join(self.tmpdir, 'repo')
+        os.makedirs(os.path.join(self.repodir, 'packages'))
+        self.packages = [make_package(self.workdir, name, '1.0.0', {f'{name}/x.py': b'x' * 10000})
+                         for name in ('a', 'b', 'c', 'd')]
+        paths = [shutil.copy(path, os.path.join(self.repodir, 'packages'))
+                 for path in self.packages]
+        repodb.add_packages(os.path.join(self.repodir, 'repo.db'), paths)
+
+    def run_with_server(self, test: Callable[[_StandIn], Awaitable[None]]) -> None:
+        async def main() -> None:
+            server = _StandIn(self.repodir)
+            url = await server.start()
+            try:
+                with consts.using(self.other):
+                    repo_dir = consts.ensure_dir(consts.paths().repo_dir)
+                    with open(os.path.join(repo_dir, 'repolist'), 'w') as f:
+                        f.write(f'test {url}/repo.db {url}/packages\n')
+                    await test(server)
+            finally:
+                await server.close()
+        asyncio.run(main())
+
+    def test_sync_and_download(self) -> None:
+        async def test(server: _StandIn) -> None:
+            results = await aio.sync(aio.Client())
+            self.assertEqual([(result.status, result.error) for result in results],
+                             [(UPDATED, None)])
+            self.assertEqual(sorted(pkginfo.name for pkginfo in await aio.get_available_packages()),
+                             ['a', 'b', 'c', 'd'])
+            percents: List[int] = []
+            path = await aio.download('a', progress=percents.append)
+            self.assertTrue(path.startswith(self.other))
+            with open(path, 'rb') as f, open(self.packages[0], 'rb') as expected:
+                self.assertEqual(f.read(), expected.read())
+            self.assertEqual(percents[-1], 100)
+
+            requests = len(server.requests)
+            self.assertEqual(await aio.download('a'), path)  # cached
+            self.assertEqual([result.status for result in await aio.sync()], [NOT_MODIFIED])
+            self.assertEqual(len(server.requests), requests + 2)  # changelog and database
+        self.run_with_server(test)
+        self.assertTrue(os.path.exists(os.path.join(self.other, '.baprepos', 'test.db')))
+        self.assertFalse(os.path.exists(self.root))
+
+    def test_connection_limit(self) -> None:
+        async def test(server: _StandIn) -> None:
+            client = aio.Client(max_connections=2)
+            await aio.sync(client)
+            server.delay = 0.05
+            server.chunked = True
+            paths = await asyncio.gather(*(aio.download(name, client=client)
+                                           for name in ('a', 'b', 'c', 'd')))
+            self.assertEqual(len(set(paths)), 4)
+            self.assertEqual(server.peak, 2)
+        self.run_with_server(test)
+
+    def test_hash_mismatch(self) -> None:
+        async def test(server: _StandIn) -> None:
+            await aio.sync()
+            with open(os.path.join(self.repodir, 'packages', 'a-1.0.0.bap'), 'ab') as f:
+                f.write(b'garbage')
+            with self.assertRaises(HashMismatch):
+                await aio.download('a')
+            cache_dir = consts.paths().cache_dir
+            self.assertEqual(os.listdir(cache_dir), [])
+        self.run_with_server(test)
+
+
+if __name__ == '__main__':
+    unittest.main()
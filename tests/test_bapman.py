@@ -0,0 +1,149 @@
+import gc
+import os
+import sys
+import weakref
+import threading
+import unittest
+from unittest import mock
+
+import bap
+
+from tests.util import RootTestCase, make_package
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs'))
+
+import ba  # noqa: E402  # the stand-in from tests/stubs
+from bapman.ui import search, installedbrowser  # noqa: E402
+
+PACKAGES = 3 * search.PAGE_SIZE + 5
+
+
+class SearchWindowTest(RootTestCase):
+    """SearchWindow must create widgets for one page of rows, whatever the
+    number of packages, and reuse them for other pages"""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        assert hasattr(ba, 'process_calls'), 'ba must be the stand-in from tests/stubs'
+
+    def setUp(self) -> None:
+        super().setUp()
+        ba.reset()
+        self.addCleanup(ba.reset)
+        self.names = sorted(f'pkg{i:03d}' for i in range(PACKAGES))
+        self.add_repository('test', [make_package(self.workdir, name, '1.0.0', {})
+                                     for name in self.names])
+        bap.repo.sync()
+
+    def shown(self, window: search.SearchWindow) -> list:
+        return [name.settings['text'] for _, _, name, _ in window._rows
+                if name.settings['text']]
+
+    def test_widgets_created_once(self) -> None:
+        window = search.SearchWindow()
+        chrome = dict(ba.created)
+        ba.process_calls()
+        self.assertEqual(self.shown(window), self.names[:search.PAGE_SIZE])
+        first_page = dict(ba.created)
+        self.assertEqual(first_page['container'] - chrome['container'], search.PAGE_SIZE + 1)
+        self.assertEqual(first_page['image'] - chrome.get('image', 0), search.PAGE_SIZE)
+        self.assertEqual(first_page['text'] - chrome['text'], 2 * search.PAGE_SIZE)
+        self.assertEqual(first_page['scroll'], 1)
+
+        for page in range(1, 4):
+            window._next_page()
+            ba.process_calls()
+            self.assertEqual(self.shown(window),
+                             self.names[page * search.PAGE_SIZE:(page + 1) * search.PAGE_SIZE])
+        window._next_page()  # there is no fifth page
+        window._prev_page()
+        ba.process_calls()
+        self.assertEqual(self.shown(window),
+                         self.names[2 * search.PAGE_SIZE:3 * search.PAGE_SIZE])
+        self.assertEqual(dict(ba.created), first_page)
+
+    def test_row_activation(self) -> None:
+        window = search.SearchWindow()
+        ba.process_calls()
+        window._next_page()
+        ba.process_calls()
+        before = len(ba.widgets)
+        window._on_row_activated(2)
+        ba.process_calls()  # installed version of the package is loaded
+        texts = [widget.settings.get('text') for widget in ba.widgets[before:]]
+        labels = [widget.settings.get('label') for widget in ba.widgets[before:]]
+        self.assertIn(f'{self.names[search.PAGE_SIZE + 2]} ver. 1.0.0', texts)
+        self.assertIn('Install', labels)
+
+
+class ShowPkgInfoWindowTest(RootTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        ba.reset()
+        self.addCleanup(ba.reset)
+
+    def test_closed_window_is_freed_while_loading(self) -> None:
+        started = threading.Event()
+        release = threading.Event()
+        snapshot = bap.installed.snapshot
+
+        def slow_snapshot():  # type: ignore
+            started.set()
+            release.wait(10)
+            return snapshot()
+
+        with mock.patch.object(bap.installed, 'snapshot', slow_snapshot):
+            try:
+                window = search.ShowPkgInfoWindow(
+                    bap.PkgInfo(name='a', version=bap.Version(1, 0, 0), desc='test'))
+                self.assertTrue(started.wait(10))
+                window._back()
+                ref = weakref.ref(window)
+                del window
+                gc.collect()
+                self.assertIsNone(ref())
+            finally:
+                release.set()
+
+
+@mock.patch('bapman.ui.menu.MenuWindow', mock.Mock())
+class InstalledBrowserWindowTest(RootTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        ba.reset()
+        self.addCleanup(ba.reset)
+        bap.install(make_package(self.workdir, 'a', '1.0.0', {}))
+        self.snapshot = bap.installed.snapshot()
+
+    def test_unsubscribes_on_close(self) -> None:
+        window = installedbrowser.InstalledBrowserWindow()
+        ba.process_calls()
+        self.assertEqual([entry.name for entry in window._entries], ['a'])
+        self.assertEqual(len(self.snapshot._subscribers), 1)
+        window._back()
+        self.assertEqual(self.snapshot._subscribers, [])
+
+    def test_closed_window_is_freed_while_loading(self) -> None:
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_snapshot():  # type: ignore
+            started.set()
+            release.wait(10)
+            return self.snapshot
+
+        with mock.patch.object(bap.installed, 'snapshot', slow_snapshot):
+            try:
+                window = installedbrowser.InstalledBrowserWindow()
+                self.assertTrue(started.wait(10))
+                window._back()
+                ref = weakref.ref(window)
+                del window
+                gc.collect()
+                self.assertIsNone(ref())
+            finally:
+                release.set()
+            ba.process_calls()  # result of the load, dropped
+        self.assertEqual(self.snapshot._subscribers, [])
+
@@ -0,0 +1,130 @@
+import os
+import json
+import shutil
+import sqlite3
+import hashlib
+import unittest
+import contextlib
+from typing import Any, List, Sequence, Tuple
+
+import bap
+from bap import consts
+from bap.repo import changelog, repodb
+from bap.repo.sync import UPDATED, NOT_MODIFIED
+
+from tests.util import RootTestCase, StandIn, make_package
+
+
+def _rows(dbpath: str) -> Tuple[int, List[Tuple[Any, ...]]]:
+    """Return sequence number and packages of repository database"""
+    with contextlib.closing(sqlite3.connect(dbpath)) as conn:
+        return (conn.execute('PRAGMA user_version').fetchone()[0],
+                conn.execute('SELECT * FROM packages ORDER BY name').fetchall())
+
+
+class ChangelogTest(RootTestCase):
+    """Sync patches the local database from the published changelog"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.server = StandIn()
+        url = self.enter_context(self.server.serve())
+        self.list_repository('test', f'{url}/repo.db', f'{url}/packages')
+        self.published = os.path.join(self.workdir, 'repo.db')
+        self.changes = self.published + changelog.CHANGELOG_SUFFIX
+
+    def release(self, packages: Sequence[Tuple[str, str]], keep: int = changelog.CHANGELOG_KEEP,
+                remove: Sequence[str] = ()) -> None:
+        """Publish database with (name, version) packages added and names removed"""
+        new = os.path.join(self.workdir, 'new.db')
+        if os.path.exists(self.published):
+            shutil.copy(self.published, new)
+        repodb.add_packages(new, [make_package(self.workdir, name, version, {})
+                                  for name, version in packages])
+        with contextlib.closing(sqlite3.connect(new)) as conn, conn:
+            conn.executemany('DELETE FROM packages WHERE name = ?', [(name,) for name in remove])
+        changelog.publish(self.published, new, self.changes, keep=keep)
+        os.replace(new, self.published)
+        self.serve()
+
+    def serve(self) -> None:
+        for path, name in ((self.published, '/repo.db'), (self.changes, '/repo.db.changes')):
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.server.files[name] = (data, '"' + hashlib.sha256(data).hexdigest() + '"')
+
+    def sync(self) -> Tuple[str, bool]:
+        self.server.requests.clear()
+        result, = bap.repo.sync()
+        self.assertIsNone(result.error)
+        return result.status, result.incremental
+
+    def paths(self) -> List[str]:
+        return [path for _, path, _ in self.server.requests]
+
+    def assert_local_matches(self) -> None:
+        local = os.path.join(consts.paths().repo_dir, 'test.db')
+        self.assertEqual(_rows(local), _rows(self.published))
+
+    def test_patch_chain(self) -> None:
+        self.release([('a', '1.0.0'), ('b', '1.0.0')])
+        self.assertEqual(self.sync(), (UPDATED, False))
+        self.release([('a', '1.1.0')])
+        self.release([('c', '1.0.0')], remove=['b'])
+        self.release([('a', '1.2.0')])
+        self.assertEqual(self.sync(), (UPDATED, True))
+        self.assertEqual(self.paths(), ['/repo.db.changes'])
+        self.assert_local_matches()
+        self.assertEqual(sorted((pkginfo.name, pkginfo.version.to_string())
+                                for pkginfo in bap.repo.get_available_packages()),
+                         [('a', '1.2.0'), ('c', '1.0.0')])
+
+    def test_changelog_not_modified(self) -> None:
+        self.release([('a', '1.0.0')])
+        self.sync()
+        self.release([('a', '1.1.0')])
+        self.assertEqual(self.sync(), (UPDATED, True))
+        self.assertEqual(self.sync(), (NOT_MODIFIED, False))
+        (_, path, headers), = self.server.requests
+        self.assertEqual(path, '/repo.db.changes')
+        self.assertEqual(headers['If-None-Match'], self.server.files[path][1])
+        self.assert_local_matches()
+
+    def test_sequence_gap(self) -> None:
+        self.release([('a', '1.0.0')], keep=1)
+        self.sync()
+        self.release([('a', '1.1.0')], keep=1)
+        self.release([('a', '1.2.0')], keep=1)  # changes of 1.1.0 are gone
+        self.assertEqual(self.sync(), (UPDATED, False))
+        self.assertEqual(self.paths(), ['/repo.db.changes', '/repo.db'])
+        self.assert_local_matches()
+
+    def test_bad_patch(self) -> None:
+        self.release([('a', '1.0.0')])
+        self.sync()
+        self.release([('a', '1.1.0')])
+        with open(self.changes) as f:
+            log = json.load(f)
+        log['changes'].append({'seq': log['seq'], 'op': 'put', 'table': 'evil',
+                               'row': {'name': 'x'}})
+        with open(self.changes, 'w') as f:
+            json.dump(log, f)
+        self.serve()
+        local = os.path.join(consts.paths().repo_dir, 'test.db')
+        before = _rows(local)
+        self.assertEqual(self.sync(), (UPDATED, False))
+        self.assertEqual(self.paths(), ['/repo.db.changes', '/repo.db'])
+        self.assertNotEqual(_rows(local), before)
+        self.assert_local_matches()
+
+    def test_pending(self) -> None:
+        log = {'seq': 5, 'first': 3, 'changes': [{'seq': seq} for seq in range(3, 6)]}
+        self.assertEqual(changelog.pending(log, 3), [{'seq': 4}, {'seq': 5}])
+        self.assertEqual(changelog.pending(log, 2), log['changes'])
+        self.assertEqual(changelog.pending(log, 5), [])
+        self.assertIsNone(changelog.pending(log, 1))  # changes of 2 are gone
+        self.assertIsNone(changelog.pending(log, 6))  # database newer than changelog
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import unittest
+
+import bap
+from bap import consts
+from bap.repo.sync import UPDATED
+
+from tests.util import RootTestCase, make_package
+
+
+class UsingTest(RootTestCase):
+    """Root chosen with consts.using() must apply to work done in bap's thread pools"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.other = os.path.join(self.tmpdir, 'other')
+        packages = [make_package(self.workdir, 'a', '1.0.0', {'a/x.py': b'a'}, depends=['b']),
+                    make_package(self.workdir, 'b', '1.0.0', {'b/x.py': b'b'})]
+        with consts.using(self.other):
+            self.add_repository('test', packages)
+
+    def test_sync(self) -> None:
+        with consts.using(self.other):
+            results = bap.repo.sync()
+        self.assertEqual([(result.status, result.error) for result in results], [(UPDATED, None)])
+        self.assertTrue(os.path.exists(os.path.join(self.other, '.baprepos', 'test.db')))
+        self.assertFalse(os.path.exists(self.root))
+
+    def test_install(self) -> None:
+        with consts.using(self.other):
+            bap.repo.sync()
+            installed = bap.repo.install(['a'])
+            self.assertEqual(bap.owner(os.path.join(self.other, 'a', 'x.py')), 'a')
+        self.assertEqual([pkginfo.name for pkginfo in installed], ['b', 'a'])
+        self.assertTrue(os.path.exists(os.path.join(self.other, 'b', 'x.py')))
+        self.assertFalse(os.path.exists(self.root))
+
+    def test_paths_restored(self) -> None:
+        with consts.using(self.other) as paths:
+            self.assertEqual(paths.root, self.other)
+            self.assertEqual(consts.ROOT_DIR, self.other)
+        self.assertEqual(consts.paths().root, self.root)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import io
+import os
+import json
+import random
+import sqlite3
+import hashlib
+import zipfile
+import unittest
+import contextlib
+from typing import Any, Callable, Dict, Optional
+
+import bap
+from bap import delta, package
+from bap.repo import repodb
+from bap.repo.download import download, find_archive
+
+from tests.util import RootTestCase, make_package, drain
+
+OLD_FILES = {
+    'a/keep.py': b'keep = 1\n' * 100,
+    'a/change.py': b''.join(b'line %d\n' % i for i in range(1000)),
+    'a/drop.py': b'dropped\n',
+}
+NEW_FILES = {
+    'a/keep.py': OLD_FILES['a/keep.py'],
+    'a/change.py': OLD_FILES['a/change.py'].replace(b'line 500\n', b'changed line\n'),
+    'a/add.py': b'added\n',
+}
+
+
+class PatchTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        rng = random.Random(1)
+        old = bytes(rng.getrandbits(8) for _ in range(100000))
+        new = old[:30000] + b'inserted' * 10 + old[30000:70000] + old[80000:]
+        patch = delta.make_patch(old, new)
+        self.assertLess(len(patch), 1000)
+        self.assertEqual(delta.apply_patch(old, patch), new)
+        self.assertEqual(delta.apply_patch(old, delta.make_patch(old, b'')), b'')
+        self.assertEqual(delta.apply_patch(b'', delta.make_patch(b'', new)), new)
+
+    def test_truncated(self) -> None:
+        patch = delta.make_patch(b'', b'literal data')
+        with self.assertRaises(delta.DeltaError):
+            delta.apply_patch(b'', patch[:-3])
+        with self.assertRaises(delta.DeltaError):
+            delta.apply_patch(b'', patch[:2])
+
+
+class DeltaTestCase(RootTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.old = make_package(self.workdir, 'a', '1.0.0', OLD_FILES)
+        self.new = make_package(self.workdir, 'a', '1.1.0', NEW_FILES)
+        self.delta = os.path.join(self.workdir, 'a-1.0.0-1.1.0.bapdelta')
+        bap.gendelta(self.old, self.new, self.delta)
+        bap.install(self.old)
+
+    def rewrite_delta(self, path: str, **members: bytes) -> None:
+        """Replace members of delta package at path"""
+        with zipfile.ZipFile(path) as zf:
+            contents = {info.filename: zf.read(info) for info in zf.infolist()}
+        contents.update(members)
+        with zipfile.ZipFile(path, 'w') as zf:
+            for name, data in contents.items():
+                zf.writestr(name, data)
+
+    def edit_manifest(self, path: str, files: Dict[str, Any]) -> None:
+        """Add files to DELTA manifest of delta package at path"""
+        with zipfile.ZipFile(path) as zf:
+            manifest = delta.read_manifest(zf)
+        manifest['files'].update(files)
+        self.rewrite_delta(path, DELTA=json.dumps(manifest).encode())
+
+
+class ApplyTest(DeltaTestCase):
+    def test_apply(self) -> None:
+        with zipfile.ZipFile(self.delta) as zf:
+            manifest = delta.read_manifest(zf)
+        self.assertEqual({path: entry['op'] for path, entry in manifest['files'].items()},
+                         {'/a/keep.py': 'keep', '/a/change.py': 'patch', '/a/add.py': 'add'})
+        output = os.path.join(self.workdir, 'rebuilt.bap')
+        delta.apply(self.delta, output, self.root)
+        pkginfo, entries = package.inspect(output)
+        expected_info, expected = package.inspect(self.new)
+        self.assertEqual(pkginfo.version, expected_info.version)
+        self.assertEqual(sorted((entry.path, entry.sha256) for entry in entries),
+                         sorted((entry.path, entry.sha256) for entry in expected))
+
+    def test_modified_base(self) -> None:
+        with open(os.path.join(self.root, 'a', 'change.py'), 'ab') as f:
+            f.write(b'local edit\n')
+        output = os.path.join(self.workdir, 'rebuilt.bap')
+        with self.assertRaises(delta.DeltaError):
+            delta.apply(self.delta, output, self.root)
+        self.assertFalse(os.path.exists(output))
+
+    def test_unsafe_path(self) -> None:
+        outside = os.path.join(self.tmpdir, 'secret')
+        with open(outside, 'wb') as f:
+            f.write(b'secret')
+        self.edit_manifest(self.delta, {'/../secret': {'op': 'keep', 'crc': 0, 'size': 6}})
+        with self.assertRaises(delta.DeltaError):
+            delta.apply(self.delta, os.path.join(self.workdir, 'rebuilt.bap'), self.root)
+
+    def test_manifest_mismatch(self) -> None:
+        # CRC and size agree with the delta, but not sha256 in MANIFEST
+        with zipfile.ZipFile(self.delta) as zf:
+            manifest_data = zf.read(package.MANIFEST_NAME).decode()
+        sha256 = hashlib.sha256(NEW_FILES['a/add.py']).hexdigest()
+        self.rewrite_delta(self.delta, MANIFEST=manifest_data.replace(sha256, '0' * 64).encode())
+        with self.assertRaises(delta.DeltaError):
+            delta.apply(self.delta, os.path.join(self.workdir, 'rebuilt.bap'), self.root)
+
+
+class DownloadTest(DeltaTestCase):
+    def publish(self, corrupt: Optional[Callable[[str], None]] = None,
+                rehash: bool = True) -> None:
+        """Publish new version with delta, corrupted by corrupt(path) if given"""
+        repodir = self.add_repository('test', [self.new], [self.delta])
+        if corrupt is not None:
+            path = os.path.join(repodir, 'packages', os.path.basename(self.delta))
+            corrupt(path)
+            if rehash:  # as if the repository published the corrupt delta
+                with contextlib.closing(sqlite3.connect(os.path.join(repodir, 'repo.db'))) as conn:
+                    with conn:
+                        conn.execute('UPDATE deltas SET sha256 = ?', (repodb.file_sha256(path),))
+        bap.repo.sync()
+
+    def assert_installs_new_version(self, path: str) -> None:
+        bap.install(path, upgrade=True)
+        for name, data in NEW_FILES.items():
+            with open(os.path.join(self.root, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'a', 'drop.py')))
+
+    def test_rebuilt_from_delta(self) -> None:
+        self.publish()
+        archive = find_archive('a')
+        path = drain(download('a'))
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        # rebuilt archive differs from the published one, so it is kept under its own hash
+        self.assertNotEqual(digest, archive.sha256)
+        self.assertEqual(os.path.basename(path), digest + '.bap')
+        self.assertFalse(os.path.exists(archive.path))
+        self.assertFalse(archive.is_cached())
+        with open(path + '.json') as f:
+            self.assertEqual(json.load(f)['sha256'], digest)
+        self.assert_installs_new_version(path)
+
+    def assert_falls_back(self) -> None:
+        archive = find_archive('a')
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            path = drain(download('a'))
+        self.assertIn('delta for a not used', output.getvalue())
+        self.assertEqual(path, archive.path)
+        with open(path, 'rb') as f, open(self.new, 'rb') as expected:
+            self.assertEqual(f.read(), expected.read())
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         [os.path.basename(path), os.path.basename(path) + '.json'])
+        self.assert_installs_new_version(path)
+
+    def test_fallback_on_hash_mismatch(self) -> None:
+        self.publish(lambda path: self.rewrite_delta(path, DELTA=b'{}'), rehash=False)
+        self.assert_falls_back()
+
+    def test_fallback_on_corrupt_archive(self) -> None:
+        def corrupt(path: str) -> None:
+            with open(path, 'wb') as f:
+                f.write(b'garbage')
+        self.publish(corrupt)
+        self.assert_falls_back()
+
+    def test_fallback_on_bad_manifest(self) -> None:
+        self.publish(lambda path: self.rewrite_delta(path, DELTA=b'{'))
+        self.assert_falls_back()
+
+    def test_fallback_on_missing_member(self) -> None:
+        self.publish(lambda path: self.edit_manifest(
+            path, {'/a/other.py': {'op': 'add', 'crc': 0, 'size': 0}}))
+        self.assert_falls_back()
+
+    def test_fallback_on_unsafe_path(self) -> None:
+        self.publish(lambda path: self.edit_manifest(
+            path, {'/../secret': {'op': 'add', 'crc': 0, 'size': 0}}))
+        self.assert_falls_back()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import hashlib
+import unittest
+from typing import Dict, List, Optional
+from unittest import mock
+
+from bap.repo.download import HashMismatch, _download, _download_segmented
+
+from tests.util import RootTestCase, StandIn, drain
+
+SIZE = 300 * 1024
+
+
+def _content(seed: bytes, size: int = SIZE) -> bytes:
+    return b''.join(hashlib.sha256(seed + b'%d' % i).digest() for i in range(size // 32))
+
+
+class DownloadTestCase(RootTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.server = StandIn()
+        self.data = _content(b'a')
+        self.server.files['/a.bap'] = (self.data, '"v1"')
+        self.url = self.enter_context(self.server.serve()) + '/a.bap'
+        self.dest = os.path.join(self.workdir, 'a.bap')
+
+    def read_dest(self) -> bytes:
+        with open(self.dest, 'rb') as f:
+            return f.read()
+
+    def get_headers(self) -> List[Dict[str, str]]:
+        return [headers for method, _, headers in self.server.requests if method == 'GET']
+
+
+class ResumeTest(DownloadTestCase):
+    """Interrupted downloads are resumed with Range and If-Range"""
+
+    def interrupt(self, after: int = 100 * 1024) -> None:
+        self.server.cut_after = after
+        with self.assertRaisesRegex(IOError, 'connection closed'):
+            drain(_download(self.url, self.dest))
+        self.assertEqual(os.path.getsize(self.dest + '.part'), after)
+        self.server.requests.clear()
+
+    def test_resume(self) -> None:
+        self.interrupt()
+        drain(_download(self.url, self.dest, sha256=hashlib.sha256(self.data).hexdigest()))
+        headers, = self.get_headers()
+        self.assertEqual((headers.get('Range'), headers.get('If-Range')),
+                         (f'bytes={100 * 1024}-', '"v1"'))
+        self.assertEqual(self.read_dest(), self.data)
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+        self.assertFalse(os.path.exists(self.dest + '.part.json'))
+
+    def test_changed_etag(self) -> None:
+        self.interrupt()
+        changed = _content(b'b')
+        self.server.files['/a.bap'] = (changed, '"v2"')
+        drain(_download(self.url, self.dest, sha256=hashlib.sha256(changed).hexdigest()))
+        self.assertEqual(self.read_dest(), changed)
+
+    def test_weak_etag(self) -> None:
+        self.server.files['/a.bap'] = (self.data, 'W/"v1"')
+        self.interrupt()
+        drain(_download(self.url, self.dest))
+        self.assertNotIn('Range', self.get_headers()[0])  # weak ETags can not be used in If-Range
+        self.assertEqual(self.read_dest(), self.data)
+
+    def test_range_not_satisfiable(self) -> None:
+        self.interrupt()
+        shorter = self.data[:50 * 1024]
+        self.server.files['/a.bap'] = (shorter, '"v1"')  # ETag wrongly kept
+        drain(_download(self.url, self.dest))
+        first, second = self.get_headers()
+        self.assertIn('Range', first)
+        self.assertNotIn('Range', second)
+        self.assertEqual(self.read_dest(), shorter)
+
+    def test_hash_mismatch_after_resume(self) -> None:
+        self.interrupt()
+        corrupt = self.data[:-1] + b'\0'
+        self.server.files['/a.bap'] = (corrupt, '"v1"')  # ETag wrongly kept
+        with self.assertRaises(HashMismatch):
+            drain(_download(self.url, self.dest, sha256=hashlib.sha256(self.data).hexdigest()))
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+        self.assertFalse(os.path.exists(self.dest + '.part.json'))
+        # nothing is resumed from the discarded part
+        self.server.requests.clear()
+        self.server.files['/a.bap'] = (self.data, '"v1"')
+        drain(_download(self.url, self.dest, sha256=hashlib.sha256(self.data).hexdigest()))
+        self.assertNotIn('Range', self.get_headers()[0])
+        self.assertEqual(self.read_dest(), self.data)
+
+
+@mock.patch('bap.repo.download.MIN_SEGMENT_SIZE', 64 * 1024)
+class SegmentedTest(DownloadTestCase):
+    """Large downloads are split into byte ranges fetched in parallel"""
+
+    def download(self, segments: int = 4) -> None:
+        drain(_download_segmented(self.url, self.dest, segments,
+                                  sha256=hashlib.sha256(self.data).hexdigest()))
+        self.assertEqual(self.read_dest(), self.data)
+        self.assertEqual(os.listdir(self.workdir), ['a.bap'])
+
+    def ranges(self) -> List[Optional[str]]:
+        return sorted((headers.get('Range') for headers in self.get_headers()), key=str)
+
+    def test_segments(self) -> None:
+        self.download()
+        size = len(self.data)
+        self.assertEqual(self.server.requests[0][0], 'HEAD')
+        self.assertEqual(self.ranges(), sorted(
+            f'bytes={size * i // 4}-{size * (i + 1) // 4 - 1}' for i in range(4)))
+
+    def test_small_file(self) -> None:
+        self.data = self.data[:100 * 1024]
+        self.server.files['/a.bap'] = (self.data, '"v1"')
+        self.download()
+        self.assertEqual(self.ranges(), [None])
+
+    def test_ranges_not_advertised(self) -> None:
+        self.server.accept_ranges = False
+        self.download()
+        self.assertEqual(self.ranges(), [None])
+
+    def test_ranges_ignored(self) -> None:
+        self.server.ranges = False  # Accept-Ranges sent, but Range answered with 200
+        self.download()
+        ranges = self.ranges()
+        self.assertIn(None, ranges)  # fell back to a single stream
+        self.assertGreater(len(ranges), 1)
+
+    def test_no_content_length(self) -> None:
+        self.server.content_length = False
+        self.download()
+        self.assertEqual(self.ranges(), [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import io
+import os
+import random
+import sqlite3
+import unittest
+import contextlib
+from typing import Sequence, Tuple
+
+import bap
+from bap.repo import index
+
+from tests.util import RootTestCase
+
+PRERELEASES = ['1.0.0-1', '1.0.0-2', '1.0.0-10', '1.0.0-alpha', '1.0.0-alpha.1',
+               '1.0.0-alpha.beta', '1.0.0-beta', '1.0.0-beta.2', '1.0.0-beta.11',
+               '1.0.0-rc.1', '1.0.0', '1.0.1', '1.2.0', '1.10.0', '2.0.0', '10.0.0']
+
+
+class IndexTest(RootTestCase):
+    """Merged index of packages from every listed repository"""
+
+    def publish(self, repo: str, rows: Sequence[Tuple[str, str, str]]) -> None:
+        """List repository holding (name, version, desc) rows"""
+        repodir = self.add_repository(repo, [])
+        with contextlib.closing(sqlite3.connect(os.path.join(repodir, 'repo.db'))) as conn:
+            with conn:
+                conn.executemany('INSERT INTO packages (name, version, desc, file)'
+                                 ' VALUES (?, ?, ?, ?)',
+                                 [(name, version, desc, f'{name}-{version}.bap')
+                                  for name, version, desc in rows])
+
+    def sync(self) -> None:
+        for result in bap.repo.sync():
+            self.assertIsNone(result.error)
+
+    def test_newest_across_repos(self) -> None:
+        self.publish('first', [('a', '1.0.0', ''), ('b', '2.0.0', ''), ('c', '1.0.0', '')])
+        self.publish('second', [('a', '1.1.0', ''), ('b', '1.9.0', ''), ('c', '1.0.0', '')])
+        self.sync()
+        self.assertEqual([(pkginfo.name, pkginfo.version.to_string())
+                          for pkginfo in bap.repo.get_available_packages()],
+                         [('a', '1.1.0'), ('b', '2.0.0'), ('c', '1.0.0')])
+        self.assertEqual(bap.repo.get_provider('a'), 'second')
+        self.assertEqual(bap.repo.get_provider('b'), 'first')
+        self.assertEqual(bap.repo.get_provider('c'), 'first')  # listed first wins a tie
+        self.assertEqual(bap.repo.get_provider('a', '1.0.0'), 'first')
+        self.assertTrue(bap.repo.get_download_url('a').endswith('/a-1.1.0.bap'))
+        self.assertEqual(index.versions('c'), [('1.0.0', 'first'), ('1.0.0', 'second')])
+        self.assertEqual(bap.repo.get_versions('c'), [bap.Version(1, 0, 0)])
+
+    def test_version_order(self) -> None:
+        shuffled = PRERELEASES[:]
+        random.Random(1).shuffle(shuffled)
+        half = len(shuffled) // 2
+        self.publish('first', [('a', version, '') for version in shuffled[:half]])
+        self.publish('second', [('a', version, '') for version in shuffled[half:]])
+        self.sync()
+        self.assertEqual([version.to_string() for version in bap.repo.get_versions('a')],
+                         PRERELEASES[::-1])
+        self.assertEqual(bap.repo.get_package_info('a').version, bap.Version(10, 0, 0))
+
+    def test_prerelease_is_older(self) -> None:
+        self.publish('first', [('a', '1.0.0', '')])
+        self.publish('second', [('a', '1.0.0-rc.1', ''), ('a', '1.0.0-rc.1+build', '')])
+        self.sync()
+        self.assertEqual(bap.repo.get_provider('a'), 'first')
+
+    def search(self) -> None:
+        def names(query: str) -> Sequence[str]:
+            return [pkginfo.name for pkginfo in bap.repo.search(query)]
+
+        self.assertEqual(names('http'), ['httpie', 'requests'])  # name weighted over desc
+        self.assertEqual(names('HUM'), ['requests'])
+        self.assertEqual(names('http humans'), ['requests'])
+        self.assertEqual(names('nothing'), [])
+        self.assertEqual(names(''), ['colors', 'httpie', 'requests'])
+        self.assertEqual(names('" - ()'), ['colors', 'httpie', 'requests'])  # no words
+        self.assertEqual(len(bap.repo.search('', limit=2, offset=2)), 1)
+        for query in ('"bold"', "it's", 'ansi:', '(and', 'more)', 'colours*', '-100',
+                      'NOT bold', 'bold OR', 'colours:bold', '100%_', '^ansi', '"bold" (and'):
+            with self.subTest(query=query):
+                self.assertEqual(names(query), ['colors'])
+
+    def publish_for_search(self) -> None:
+        self.publish('first', [
+            ('requests', '1.0.0', 'HTTP for humans'),
+            ('httpie', '1.0.0', 'terminal client'),
+            ('colors', '1.0.0', "ANSI colours: it's \"bold\" (and more) NOT 100%_done OR"),
+        ])
+        self.sync()
+
+    def test_search(self) -> None:
+        self.publish_for_search()
+        self.search()
+        self.assertEqual(bap.repo.search('ttp'), [])  # words match by prefix only
+
+    def test_search_without_fts(self) -> None:
+        self.publish_for_search()
+        # pylint: disable=protected-access
+        with index._connection() as conn:  # as if sqlite was built without FTS5
+            conn.execute('UPDATE state SET value = 0 WHERE key = ?', (index._FTS_AVAILABLE,))
+        self.search()
+
+    def test_invalid_version_skipped(self) -> None:
+        self.publish('first', [('a', '1.0', ''), ('b', 'latest', ''), ('c', '1.0.0', '')])
+        self.publish('second', [('a', '0.9.0', '')])
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.sync()
+            packages = [(pkginfo.name, pkginfo.version.to_string())
+                        for pkginfo in bap.repo.get_available_packages()]
+        self.assertEqual(packages, [('a', '0.9.0'), ('c', '1.0.0')])
+        self.assertIn("first: a has invalid version '1.0'", output.getvalue())
+        self.assertIn("first: b has invalid version 'latest'", output.getvalue())
+        self.assertEqual(bap.repo.get_provider('a'), 'second')
+
+
+if __name__ == '__main__':
+    unittest.main()
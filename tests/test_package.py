@@ -0,0 +1,34 @@
+import os
+import zipfile
+import unittest
+
+import bap
+from bap import package
+
+from tests.util import RootTestCase, make_package
+
+FILES = {'a/x.py': b'x = 1\n', 'a/sub/y.py': b'y = 2\n'}
+
+
+class PackTest(RootTestCase):
+    def test_without_manifest(self) -> None:
+        with_manifest = make_package(self.workdir, 'a', '1.0.0', FILES)
+        output = os.path.join(self.workdir, 'a-no-manifest.bap')
+        package.pack(os.path.join(self.workdir, 'a-1.0.0'), output, use_cache=False,
+                     manifest=False)
+        with zipfile.ZipFile(with_manifest) as zf:
+            self.assertEqual(zf.namelist()[-1], package.MANIFEST_NAME)
+        with zipfile.ZipFile(output) as zf:
+            self.assertNotIn(package.MANIFEST_NAME, zf.namelist())
+            self.assertEqual(zf.namelist(), [package.PKGINFO_NAME, 'a/sub/y.py', 'a/x.py'])
+
+        _, entries = package.inspect(output)
+        self.assertEqual([(entry.path, entry.sha256) for entry in entries],
+                         [('/a/sub/y.py', None), ('/a/x.py', None)])
+        bap.install(output)
+        self.assertEqual(sorted(bap.files('a')), ['/a/sub/y.py', '/a/x.py'])
+        self.assertFalse(os.path.exists(os.path.join(self.root, package.MANIFEST_NAME)))
+
+
+if __name__ == '__main__':
+    unittest.main()
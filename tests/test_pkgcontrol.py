@@ -0,0 +1,168 @@
+import os
+import time
+import threading
+import unittest
+from unittest import mock
+from typing import Any, List, Dict, Optional
+
+import bap
+from bap import db, package
+from bap.pkgcontrol import FileConflictError
+
+from tests.util import RootTestCase, make_package
+
+THREADS = 8
+# Extraction of each package is slowed down this much (as on slow storage)
+STAGE_DELAY = 0.5
+
+
+_extract_members = package.extract_members
+
+
+def _slow_extract_members(zf, members, dest, before_write=None):  # type: ignore
+    if members:
+        time.sleep(STAGE_DELAY)
+    _extract_members(zf, members, dest, before_write)
+
+
+class ConcurrentInstallTest(RootTestCase):
+    """Installs in several threads must not wait for each other's extraction"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        # Busy timeout far below the time all extractions take one after
+        # another, so installs holding the write lock while extracting fail
+        patcher = mock.patch.object(db, '_BUSY_TIMEOUT', STAGE_DELAY * THREADS / 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(package, 'extract_members', _slow_extract_members)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_threads(self, paths: List[str], upgrade: bool = False) -> Dict[str, object]:
+        results: Dict[str, object] = {}
+        barrier = threading.Barrier(len(paths))
+
+        def target(path: str) -> None:
+            barrier.wait()
+            try:
+                results[path] = bap.install(path, upgrade=upgrade).name
+            except Exception as e:  # pylint: disable=broad-except
+                results[path] = e
+
+        threads = [threading.Thread(target=target, args=(path,)) for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_installs_overlap(self) -> None:
+        paths = [make_package(self.workdir, f'p{i}', '1.0.0',
+                              {f'p{i}/m{j}.py': os.urandom(20000) for j in range(20)})
+                 for i in range(THREADS)]
+        started = time.monotonic()
+        results = self.run_threads(paths)
+        elapsed = time.monotonic() - started
+        self.assertEqual(results, {path: f'p{i}' for i, path in enumerate(paths)})
+        self.assertLess(elapsed, STAGE_DELAY * THREADS / 2)
+        self.assertEqual(len(list(bap.Database().installed())), THREADS)
+        for i in range(THREADS):
+            self.assertEqual(len(bap.files(f'p{i}')), 20)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_conflicting_installs(self) -> None:
+        paths = [make_package(self.workdir, f'q{i}', '1.0.0',
+                              {'shared/x.py': str(i).encode(), f'q{i}/own.py': b'own'})
+                 for i in range(THREADS)]
+        results = self.run_threads(paths)
+        winners = [name for name in results.values() if isinstance(name, str)]
+        self.assertEqual(len(winners), 1, results)
+        for result in results.values():
+            if not isinstance(result, str):
+                self.assertIsInstance(result, FileConflictError)
+        with open(os.path.join(self.root, 'shared', 'x.py')) as f:
+            self.assertEqual(f'q{f.read()}', winners[0])
+        self.assertEqual(bap.owner(os.path.join(self.root, 'shared', 'x.py')), winners[0])
+        self.assertFalse(any(os.path.exists(os.path.join(self.root, f'q{i}'))
+                             for i in range(THREADS) if f'q{i}' != winners[0]))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_concurrent_upgrades(self) -> None:
+        names = [f'u{i}' for i in range(THREADS)]
+        for name in names:
+            bap.install(make_package(self.workdir, name, '1.0.0',
+                                     {f'{name}/keep.py': b'keep', f'{name}/old.py': b'old',
+                                      f'{name}/changed.py': b'1'}))
+        paths = [make_package(self.workdir, name, '2.0.0',
+                              {f'{name}/keep.py': b'keep', f'{name}/new.py': b'new',
+                               f'{name}/changed.py': b'2'})
+                 for name in names]
+        results = self.run_threads(paths, upgrade=True)
+        self.assertEqual(results, dict(zip(paths, names)))
+        for name in names:
+            self.assertEqual(sorted(os.listdir(os.path.join(self.root, name))),
+                             ['changed.py', 'keep.py', 'new.py'])
+            with open(os.path.join(self.root, name, 'changed.py')) as f:
+                self.assertEqual(f.read(), '2')
+            pkginfo = bap.Database().query(name)
+            assert pkginfo is not None
+            self.assertEqual(pkginfo.version.to_string(), '2.0.0')
+        self.assertEqual(self.leftovers(), [])
+
+
+class InstallTest(RootTestCase):
+    def test_reinstall(self) -> None:
+        path = make_package(self.workdir, 'a', '1.0.0', {'a/x.py': b'x'})
+        bap.install(path)
+        for paths in ([path], [make_package(self.workdir, 'b', '1.0.0', {'b/y.py': b'y'}), path]):
+            with self.subTest(paths=paths):
+                with self.assertRaisesRegex(db.PackageAlreadyExists, 'package a already exists'):
+                    bap.install_many(paths)
+        self.assertEqual(bap.files('a'), ['/a/x.py'])
+        self.assertIsNone(bap.Database().query('b'))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'b')))
+        self.assertEqual(bap.install(path, upgrade=True).name, 'a')
+        self.assertEqual(self.leftovers(), [])
+
+    def tree(self) -> Dict[str, Optional[bytes]]:
+        """Contents of files (None for directories) under root, but the database"""
+        tree: Dict[str, Optional[bytes]] = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in dirnames:
+                tree[os.path.relpath(os.path.join(dirpath, name), self.root)] = None
+            for name in filenames:
+                if not name.startswith('.bap.db'):
+                    with open(os.path.join(dirpath, name), 'rb') as f:
+                        tree[os.path.relpath(os.path.join(dirpath, name), self.root)] = f.read()
+        return tree
+
+    def test_batch_rollback(self) -> None:
+        bap.install(make_package(self.workdir, 'a', '1.0.0', {'a/x.py': b'1', 'a/old.py': b''}))
+        os.makedirs(os.path.join(self.root, 'shared', 'empty'))
+        before = self.tree()
+        paths = [
+            make_package(self.workdir, 'a', '2.0.0', {'a/x.py': b'2', 'a/new/dir/n.py': b''}),
+            make_package(self.workdir, 'b', '1.0.0', {'b/deep/nested/y.py': b'',
+                                                      'shared/b/z.py': b''}),
+            make_package(self.workdir, 'c', '1.0.0', {'c/z.py': b''}),
+        ]
+        add = db.Database.add
+
+        def failing_add(self: db.Database, pkginfo: bap.PkgInfo, *args: Any) -> None:
+            if pkginfo.name == 'c':
+                raise OSError('disk full')
+            add(self, pkginfo, *args)
+
+        with mock.patch.object(db.Database, 'add', failing_add):
+            with self.assertRaisesRegex(OSError, 'disk full'):
+                bap.install_many(paths, upgrade=True)
+        self.assertEqual(self.tree(), before)
+        pkginfo = bap.Database().query('a')
+        assert pkginfo is not None
+        self.assertEqual(pkginfo.version.to_string(), '1.0.0')
+        self.assertIsNone(bap.Database().query('b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import time
+import random
+import sqlite3
+import unittest
+from typing import List, Tuple
+
+import bap
+from bap import consts, installed
+from bap.pkginfo import PkgInfo, Version, InvalidVersion
+
+from tests.util import RootTestCase
+
+BENCHMARK_SIZE = 100000
+# Generous bounds, to catch regressions to the old re-splitting parser
+# without failing on slow machines
+MAX_PARSE_SECONDS = 5.0
+MAX_SORT_SECONDS = 2.0
+
+
+def _version_strings(count: int) -> List[str]:
+    rnd = random.Random(19)
+    strings = []
+    for _ in range(count):
+        string = f'{rnd.randrange(20)}.{rnd.randrange(100)}.{rnd.randrange(1000)}'
+        if rnd.random() < 0.3:
+            string += '-' + rnd.choice(['alpha', 'beta', 'rc']) + f'.{rnd.randrange(10)}'
+        if rnd.random() < 0.1:
+            string += f'+build.{rnd.randrange(1000)}'
+        strings.append(string)
+    return strings
+
+
+def benchmark(count: int = BENCHMARK_SIZE) -> Tuple[float, float, float]:
+    """Return seconds taken to parse count mostly distinct version strings,
+    to parse count strings repeating a few hundred ones (as listings do, hitting
+    the cache) and to sort the parsed versions"""
+    strings = _version_strings(count)
+    started = time.perf_counter()
+    versions = [Version.from_string(string) for string in strings]
+    parsed = time.perf_counter()
+    for string in strings[:500] * (count // 500):
+        Version.from_string(string)
+    reparsed = time.perf_counter()
+    sorted(versions)
+    ordered = time.perf_counter()
+    return parsed - started, reparsed - parsed, ordered - reparsed
+
+
+class VersionTest(unittest.TestCase):
+    def test_semver_precedence(self) -> None:
+        ordered = ['1.0.0-alpha', '1.0.0-alpha.1', '1.0.0-alpha.beta', '1.0.0-beta',
+                   '1.0.0-beta.2', '1.0.0-beta.11', '1.0.0-rc.1', '1.0.0', '1.0.1',
+                   '1.1.0', '2.0.0', '10.0.0']
+        versions = [Version.from_string(string) for string in ordered]
+        shuffled = list(versions)
+        random.Random(1).shuffle(shuffled)
+        self.assertEqual(sorted(shuffled), versions)
+        self.assertEqual(sorted(shuffled, key=lambda version: version.key), versions)
+
+    def test_strict_parsing(self) -> None:
+        for string in ('1.0', '01.2.3', '1.0.0-rc_1', '1.0.0-01', 'x.y.z', ''):
+            with self.assertRaises(InvalidVersion, msg=string):
+                Version.from_string(string)
+        self.assertIs(Version.from_string('1.2.3-rc.1+b5'), Version.from_string('1.2.3-rc.1+b5'))
+
+    def test_stored_parsing(self) -> None:
+        self.assertIs(Version.from_stored('1.2.3'), Version.from_string('1.2.3'))
+        self.assertEqual(Version.from_stored('1.0.0-rc_1').to_string(), '1.0.0-rc_1')
+        self.assertEqual(Version.from_stored('01.2.3').to_string(), '1.2.3')
+        self.assertEqual(Version.from_stored('1.0').to_string(), '0.0.0-error+error')
+        self.assertLess(Version.from_stored('1.0.0-rc_1'), Version.from_string('1.0.0'))
+
+    def test_benchmark(self) -> None:
+        parse, reparse, order = benchmark()
+        self.assertLess(parse, MAX_PARSE_SECONDS)
+        self.assertLess(reparse, parse)
+        self.assertLess(order, MAX_SORT_SECONDS)
+
+
+class StoredVersionTest(RootTestCase):
+    """Rows written before versions were validated must stay readable"""
+
+    def test_invalid_stored_versions(self) -> None:
+        db = bap.Database()
+        for name in ('a', 'b', 'c'):
+            db.add(PkgInfo(name=name, version=Version.from_string('1.0.0'), desc='',
+                           files=[]), {})
+        db.commit()
+        with sqlite3.connect(consts.paths().db_file) as connection:
+            connection.executemany('UPDATE packages SET version = ? WHERE name = ?',
+                                   [('1.0.0-rc_1', 'a'), ('01.2.3', 'b'), ('1.0', 'c')])
+        expected = {'a': '1.0.0-rc_1', 'b': '1.2.3', 'c': '0.0.0-error+error'}
+        self.assertEqual({pkginfo.name: pkginfo.version.to_string()
+                          for pkginfo in bap.Database().installed()}, expected)
+        pkginfo = bap.Database().query('a')
+        assert pkginfo is not None
+        self.assertEqual(pkginfo.version.to_string(), '1.0.0-rc_1')
+        self.assertEqual({pkginfo.name: pkginfo.version.to_string()
+                          for pkginfo in installed.snapshot().packages()}, expected)
+
+
+if __name__ == '__main__':
+    parse_seconds, reparse_seconds, sort_seconds = benchmark()
+    print(f'{BENCHMARK_SIZE} versions: parse {BENCHMARK_SIZE / parse_seconds:.0f}/s,'
+          f' cached {BENCHMARK_SIZE / reparse_seconds:.0f}/s,'
+          f' sort {sort_seconds * 1000:.0f} ms')
@@ -0,0 +1,81 @@
+import os
+import unittest
+from typing import List, Sequence, Tuple
+
+import bap
+from bap.repo.resolve import resolve, DependencyError, DependencyConflict, DependencyCycle
+
+from tests.util import RootTestCase, make_package
+
+
+class ResolveTest(RootTestCase):
+    def publish(self, name: str, packages: Sequence[Tuple[str, str, Sequence[str]]]) -> None:
+        """Publish (name, version, depends) packages in repository name"""
+        self.add_repository(name, [make_package(self.workdir, pkgname, version,
+                                                {f'{pkgname}/{version}.py': b''}, depends)
+                                   for pkgname, version, depends in packages])
+
+    def plan(self, requirements: Sequence[str]) -> List[Tuple[str, str]]:
+        return [(step.pkginfo.name, step.pkginfo.version.to_string())
+                for step in resolve(requirements)]
+
+    def test_pin_found_late(self) -> None:
+        # c 2.0.0 is the newest, but b needs 1.0.0: a accepts either
+        self.publish('old', [('c', '1.0.0', [])])
+        self.publish('new', [('a', '1.0.0', ['c']), ('b', '1.0.0', ['c=1.0.0']),
+                             ('c', '2.0.0', [])])
+        bap.repo.sync()
+        self.assertEqual(self.plan(['a', 'b']), [('c', '1.0.0'), ('a', '1.0.0'), ('b', '1.0.0')])
+        self.assertEqual(self.plan(['b', 'a']), [('c', '1.0.0'), ('b', '1.0.0'), ('a', '1.0.0')])
+        self.assertEqual(self.plan(['a']), [('c', '2.0.0'), ('a', '1.0.0')])
+
+    def test_pin_requested(self) -> None:
+        self.publish('old', [('c', '1.0.0', [])])
+        self.publish('new', [('a', '1.0.0', ['c']), ('c', '2.0.0', [])])
+        bap.repo.sync()
+        self.assertEqual(self.plan(['a', 'c=1.0.0']), [('c', '1.0.0'), ('a', '1.0.0')])
+
+    def test_conflicting_pins(self) -> None:
+        self.publish('old', [('c', '1.0.0', [])])
+        self.publish('new', [('a', '1.0.0', ['c=1.0.0']), ('b', '1.0.0', ['c=2.0.0']),
+                             ('c', '2.0.0', [])])
+        bap.repo.sync()
+        for requirements in (['a', 'b'], ['b', 'a']):
+            with self.subTest(requirements=requirements):
+                with self.assertRaises(DependencyConflict):
+                    resolve(requirements)
+
+    def test_unavailable_pin(self) -> None:
+        self.publish('test', [('a', '1.0.0', ['c=3.0.0']), ('c', '2.0.0', [])])
+        bap.repo.sync()
+        with self.assertRaisesRegex(DependencyConflict, 'not available'):
+            resolve(['a'])
+
+    def test_invalid_pin(self) -> None:
+        self.publish('test', [('a', '1.0.0', ['c=1.0']), ('c', '2.0.0', [])])
+        bap.repo.sync()
+        for requirements in (['a'], ['c=latest']):
+            with self.subTest(requirements=requirements):
+                with self.assertRaises(DependencyError):
+                    resolve(requirements)
+
+    def test_cycle(self) -> None:
+        self.publish('test', [('a', '1.0.0', ['b']), ('b', '1.0.0', ['a'])])
+        bap.repo.sync()
+        with self.assertRaisesRegex(DependencyCycle, 'a -> b -> a'):
+            resolve(['a'])
+
+    def test_installed_dependency(self) -> None:
+        self.publish('old', [('c', '1.0.0', [])])
+        self.publish('new', [('a', '1.0.0', ['c']), ('b', '1.0.0', ['c=2.0.0']),
+                             ('c', '2.0.0', [])])
+        bap.install(os.path.join(self.workdir, 'c-1.0.0.bap'))
+        bap.repo.sync()
+        self.assertEqual(self.plan(['a']), [('a', '1.0.0')])
+        plan = resolve(['b', 'a'])
+        self.assertEqual([(step.pkginfo.name, step.upgrade) for step in plan],
+                         [('c', True), ('b', False), ('a', False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
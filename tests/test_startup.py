@@ -0,0 +1,73 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+from typing import Dict, Set
+
+from tests import SRC_DIR
+
+# Generous bound on cumulative import time of bap, well above its usual
+# cost (mostly re and typing) and far below an eager import of the
+# database, archive and network modules
+MAX_IMPORT_MICROSECONDS = 100000
+RUNS = 3
+# Modules only used when packages are actually managed
+DEFERRED_MODULES = ('sqlite3', 'zipfile', 'urllib.request', 'http.client', 'distutils',
+                    'bap.db', 'bap.package', 'bap.pkgcontrol', 'bap.repo')
+
+
+def _run(statement: str, home: str, *options: str) -> subprocess.CompletedProcess:  # type: ignore
+    env = dict(os.environ, PYTHONPATH=SRC_DIR, HOME=home)
+    env.pop('BAP_CACHE_DIR', None)
+    return subprocess.run([sys.executable, *options, '-c', statement], env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+                          universal_newlines=True)
+
+
+def _modules(statement: str, home: str) -> Set[str]:
+    """Return modules loaded after running statement in a new interpreter"""
+    return set(_run(statement + '; import sys; print(*sys.modules)', home).stdout.split())
+
+
+def _import_times(statement: str, home: str) -> Dict[str, int]:
+    """Return {module: cumulative import microseconds} of import statements
+    run by statement in a new interpreter"""
+    stderr = _run(statement, home, '-X', 'importtime').stderr
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+class StartupTest(unittest.TestCase):
+    """Importing bap is on the game's startup path (through bapman)"""
+
+    def setUp(self) -> None:
+        self.home = tempfile.mkdtemp(prefix='bap-test-home-')
+        self.addCleanup(shutil.rmtree, self.home, ignore_errors=True)
+
+    def test_import_is_lazy(self) -> None:
+        modules = _modules('import bap', self.home)
+        self.assertIn('bap', modules)
+        for module in DEFERRED_MODULES:
+            self.assertNotIn(module, modules)
+
+    def test_import_time(self) -> None:
+        best = min(_import_times('import bap', self.home)['bap'] for _ in range(RUNS))
+        self.assertLess(best, MAX_IMPORT_MICROSECONDS)
+
+    def test_import_has_no_side_effects(self) -> None:
+        _run('import bap; bap.Version; bap.consts.paths()', self.home)
+        self.assertEqual(os.listdir(self.home), [])
+
+    def test_attributes_load_on_use(self) -> None:
+        self.assertIn('bap.pkgcontrol', _modules('import bap; bap.install', self.home))
+
+
+if __name__ == '__main__':
+    unittest.main()
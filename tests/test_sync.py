@@ -0,0 +1,83 @@
+import os
+import json
+import unittest
+
+import bap
+from bap import consts
+from bap.repo import repodb
+from bap.repo.sync import UPDATED, NOT_MODIFIED, FAILED
+
+from tests.util import RootTestCase, StandIn, make_package
+
+
+class SyncTest(RootTestCase):
+    """Blocking sync against a stand-in server sending ETags"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.server = StandIn()
+        url = self.enter_context(self.server.serve())
+        for name in ('one', 'two'):
+            self.publish(name, '1.0.0', '"1"')
+            self.list_repository(name, f'{url}/{name}/repo.db', f'{url}/{name}/packages')
+
+    def publish(self, name: str, version: str, etag: str) -> None:
+        """Serve repository name holding package of the same name at version"""
+        dbpath = os.path.join(self.workdir, f'{name}-{version}.db')
+        repodb.add_packages(dbpath, [make_package(self.workdir, name, version, {})])
+        with open(dbpath, 'rb') as f:
+            self.server.files[f'/{name}/repo.db'] = (f.read(), etag)
+
+    def local(self, name: str) -> bytes:
+        with open(os.path.join(consts.paths().repo_dir, name + '.db'), 'rb') as f:
+            return f.read()
+
+    def etag(self, name: str) -> str:
+        with open(os.path.join(consts.paths().repo_dir, name + '.meta.json')) as f:
+            etag: str = json.load(f)['etag']
+            return etag
+
+    def sync(self) -> dict:
+        self.server.requests.clear()
+        return {result.repo.name: (result.status, result.error) for result in bap.repo.sync()}
+
+    def test_not_modified(self) -> None:
+        self.assertEqual(self.sync(), {'one': (UPDATED, None), 'two': (UPDATED, None)})
+        self.assertEqual(self.local('one'), self.server.files['/one/repo.db'][0])
+        self.assertEqual(self.etag('one'), '"1"')
+
+        self.assertEqual(self.sync(), {'one': (NOT_MODIFIED, None), 'two': (NOT_MODIFIED, None)})
+        conditional = [headers.get('If-None-Match') for _, _, headers in self.server.requests]
+        self.assertEqual(conditional.count('"1"'), 2)
+        self.assertEqual(self.local('one'), self.server.files['/one/repo.db'][0])
+        self.assertEqual(self.etag('one'), '"1"')
+
+    def test_modified(self) -> None:
+        self.sync()
+        self.publish('one', '2.0.0', '"2"')
+        self.assertEqual(self.sync(), {'one': (UPDATED, None), 'two': (NOT_MODIFIED, None)})
+        self.assertEqual(self.local('one'), self.server.files['/one/repo.db'][0])
+        self.assertEqual(self.etag('one'), '"2"')
+        self.assertEqual(bap.repo.get_package_info('one').version, bap.Version(2, 0, 0))
+
+    def test_failed(self) -> None:
+        self.sync()
+        previous = self.local('one')
+        self.publish('one', '2.0.0', '"2"')
+        self.publish('two', '2.0.0', '"2"')
+        self.server.errors['/one/repo.db'] = 500
+        results = self.sync()
+        self.assertEqual(results['one'][0], FAILED)
+        self.assertIn('500', str(results['one'][1]))
+        self.assertEqual(results['two'], (UPDATED, None))
+        # the previous database of the failed repository is kept and still used
+        self.assertEqual(self.local('one'), previous)
+        self.assertEqual(self.etag('one'), '"1"')
+        self.assertEqual(bap.repo.get_package_info('one').version, bap.Version(1, 0, 0))
+        self.assertEqual(bap.repo.get_package_info('two').version, bap.Version(2, 0, 0))
+        self.assertEqual([name for name in os.listdir(consts.paths().repo_dir)
+                          if name.endswith('.tmp')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
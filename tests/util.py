@@ -0,0 +1,203 @@
+"""Helpers shared by tests"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+import functools
+import contextlib
+import http.server
+from typing import Any, Dict, Generator, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from bap import consts, package
+from bap.repo import repodb
+
+T = TypeVar('T')
+
+
+def make_package(workdir: str, name: str, version: str, files: Dict[str, bytes],
+                 depends: Sequence[str] = ()) -> str:
+    """Build package of files (paths relative to root) in workdir, return its path"""
+    srcdir = os.path.join(workdir, f'{name}-{version}')
+    os.makedirs(srcdir)
+    with open(os.path.join(srcdir, package.PKGINFO_SOURCE_NAME), 'w') as f:
+        f.write(f'pkginfo = PkgInfo(name={name!r}, version=Version.from_string({version!r}),'
+                f' desc="test package", depends={list(depends)!r},'
+                f' author=Person.from_string("Test <test@example.com>"),'
+                f' maintainer=Person.from_string("Test <test@example.com>"))\n')
+    for path, data in files.items():
+        os.makedirs(os.path.join(srcdir, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(srcdir, path), 'wb') as f:
+            f.write(data)
+    output = os.path.join(workdir, f'{name}-{version}.bap')
+    package.pack(srcdir, output, use_cache=False)
+    return output
+
+
+def drain(generator: Generator[Any, None, T]) -> T:
+    """Run generator (e.g. bap.repo.download) to the end, return its value"""
+    while True:
+        try:
+            next(generator)
+        except StopIteration as stop:
+            result: T = stop.value
+            return result
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+@contextlib.contextmanager
+def serve(directory: str) -> Iterator[str]:
+    """Serve directory over HTTP on localhost, yield its URL"""
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(_QuietHandler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+class StandIn:
+    """HTTP server for files held in memory, answering If-None-Match, Range
+    and If-Range.
+
+    Setting ``ranges``, ``accept_ranges`` or ``content_length`` to False
+    turns off support of byte ranges, advertising it or sending of
+    Content-Length. ``cut_after`` makes the next response break off after
+    that many bytes of body; paths in ``errors`` are answered with the
+    given status.
+    """
+
+    def __init__(self) -> None:
+        self.files: Dict[str, Tuple[bytes, str]] = {}  # path: (data, ETag)
+        self.ranges = True
+        self.accept_ranges = True
+        self.content_length = True
+        self.cut_after: Optional[int] = None
+        self.errors: Dict[str, int] = {}
+        self.requests: List[Tuple[str, str, Dict[str, str]]] = []  # method, path, headers
+        self._lock = threading.Lock()
+
+    def handle(self, handler: http.server.BaseHTTPRequestHandler, body: bool) -> None:
+        with self._lock:
+            self.requests.append((handler.command, handler.path, dict(handler.headers)))
+            found = self.files.get(handler.path)
+            status = self.errors.get(handler.path, 200 if found else 404)
+            cut_after, self.cut_after = self.cut_after, None
+        if found is None or status != 200:
+            handler.send_response(status)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        data, etag = found
+        if handler.headers.get('If-None-Match') == etag:
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.end_headers()
+            return
+        start, end, status = 0, len(data) - 1, 200
+        requested = handler.headers.get('Range')
+        if_range = handler.headers.get('If-Range')
+        if requested and self.ranges and if_range in (None, etag):
+            first, _, last = requested[len('bytes='):].partition('-')
+            start = int(first)
+            if start >= len(data):
+                handler.send_response(416)
+                handler.send_header('Content-Range', f'bytes */{len(data)}')
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+            end, status = min(int(last) if last else end, end), 206
+        handler.send_response(status)
+        handler.send_header('ETag', etag)
+        if self.accept_ranges:
+            handler.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            handler.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        if self.content_length:
+            handler.send_header('Content-Length', str(end - start + 1))
+        handler.end_headers()
+        if body:
+            handler.wfile.write(data[start:end + 1][:cut_after])
+
+    @contextlib.contextmanager
+    def serve(self) -> Iterator[str]:
+        """Serve files on localhost, yield the URL"""
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:  # pylint: disable=invalid-name
+                stand_in.handle(self, body=True)
+
+            def do_HEAD(self) -> None:  # pylint: disable=invalid-name
+                stand_in.handle(self, body=False)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield f'http://127.0.0.1:{server.server_address[1]}'
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+class RootTestCase(unittest.TestCase):
+    """Runs every test with a fresh bap root.
+
+    The root is configured for the whole process, so threads started by
+    tests use it too.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp(prefix='bap-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+        self.root = os.path.join(self.tmpdir, 'root')
+        self.workdir = os.path.join(self.tmpdir, 'work')
+        os.makedirs(self.workdir)
+        saved = consts._default  # pylint: disable=protected-access
+        consts.configure(self.root)
+        self.addCleanup(setattr, consts, '_default', saved)
+
+    def add_repository(self, name: str, packages: Sequence[str],
+                       deltas: Sequence[str] = ()) -> str:
+        """Publish packages and deltas in a repository served over HTTP, list
+        it in the repolist of the current root and return its directory"""
+        repodir = os.path.join(self.tmpdir, 'repo-' + name)
+        os.makedirs(os.path.join(repodir, 'packages'))
+        paths = [shutil.copy(path, os.path.join(repodir, 'packages')) for path in packages]
+        repodb.add_packages(os.path.join(repodir, 'repo.db'), paths)
+        if deltas:
+            paths = [shutil.copy(path, os.path.join(repodir, 'packages')) for path in deltas]
+            repodb.add_deltas(os.path.join(repodir, 'repo.db'), paths)
+        url = self.enter_context(serve(repodir))
+        self.list_repository(name, f'{url}/repo.db', f'{url}/packages')
+        return repodir
+
+    def list_repository(self, name: str, url_repo_database: str, url_packages_root: str) -> None:
+        """Add repository to the repolist of the current root"""
+        repo_dir = consts.ensure_dir(consts.paths().repo_dir)
+        with open(os.path.join(repo_dir, 'repolist'), 'a') as f:
+            f.write(f'{name} {url_repo_database} {url_packages_root}\n')
+
+    def enter_context(self, context: Any) -> Any:
+        """Enter context manager until the end of the test"""
+        result = context.__enter__()
+        self.addCleanup(context.__exit__, None, None, None)
+        return result
+
+    def leftovers(self) -> Sequence[str]:
+        """Staging and backup directories left in the root"""
+        return [name for name in os.listdir(self.root) if name.startswith(('.bapnew', '.baptxn'))]